@@ -476,6 +476,29 @@ class ReservoirReplay(object):  # sl
 
             self.top += 1
 
+    def add_batch(self, state_history, state_card, action):
+        """ same as calling add for every row, in order """
+        n = len(action)
+        fill = min(n, self.flags.sl_len - self.size)
+        if fill > 0:
+            self.state_history_buffer[self.top:self.top + fill] = state_history[:fill]
+            self.state_card_buffer[self.top:self.top + fill] = state_card[:fill]
+            self.action_buffer[self.top:self.top + fill] = action[:fill]
+            self.top += fill
+            self.size += fill
+        if fill < n:
+            # row with stream position t is kept with probability sl_len / (t + 1), as in add
+            prob_add = float(self.flags.sl_len) / (self.top + 1 + np.arange(n - fill))
+            src = fill + np.nonzero(np.random.rand(n - fill) < prob_add)[0]
+            index = np.random.randint(0, self.flags.sl_len, len(src))
+            # when two rows hit the same slot the later one wins
+            index, last = np.unique(index[::-1], return_index=True)
+            src = src[::-1][last]
+            self.state_history_buffer[index] = np.take(state_history, src, axis=0)
+            self.state_card_buffer[index] = np.take(state_card, src, axis=0)
+            self.action_buffer[index] = np.take(action, src)
+            self.top += n - fill
+
     def get_random_batch(self):
         indices = np.random.randint(0, self.size, self.flags.batch)
         batch_state_history_buffer = np.take(self.state_history_buffer, indices, axis=0)
@@ -488,41 +511,83 @@ class CircularReplay(object):  # rl
     def __init__(self, flags, env):
         self.flags = flags
         self.env = env
-        self.state_history_buffer = np.zeros([self.flags.rl_len] + self.env.state_history_space, np.int8)
-        self.state_card_buffer = np.zeros([self.flags.rl_len] + self.env.state_card_space, np.int8)
-        self.action_buffer = np.zeros([self.flags.rl_len], np.int8)
-        self.reward_buffer = np.zeros([self.flags.rl_len], np.int8)
-        self.terminal_buffer = np.zeros([self.flags.rl_len], np.int8)
+        # one record per transition; 'next' is the slot of the next state (-1 until it is written)
+        self.dtype = np.dtype([('state_history', np.int8, tuple(self.env.state_history_space)),
+                               ('state_card', np.int8, tuple(self.env.state_card_space)),
+                               ('action', np.int8),
+                               ('reward', np.int8),
+                               ('terminal', np.int8),
+                               ('next', np.int32)])
+        self.buffer = np.zeros([self.flags.rl_len], self.dtype)
+        self.buffer['next'] = -1
+        self.state_history_buffer = self.buffer['state_history']
+        self.state_card_buffer = self.buffer['state_card']
+        self.action_buffer = self.buffer['action']
+        self.reward_buffer = self.buffer['reward']
+        self.terminal_buffer = self.buffer['terminal']
+        self.next_buffer = self.buffer['next']
+        self.batch = np.zeros([self.flags.batch], self.dtype)
+        self.batch2 = np.zeros([self.flags.batch], self.dtype)
         self.size = 0
         self.top = 0
         self.bottom = 0
 
     def add(self, state_history, state_card, action, reward, terminal):
+        last_top = (self.top - 1) % self.flags.rl_len
+        if self.size > 0 and not self.terminal_buffer[last_top]:
+            self.next_buffer[last_top] = self.top
         self.state_history_buffer[self.top] = state_history
         self.state_card_buffer[self.top] = state_card
         self.action_buffer[self.top] = action
         self.reward_buffer[self.top] = reward
         self.terminal_buffer[self.top] = terminal
+        self.next_buffer[self.top] = self.top if terminal else -1
         if self.size == self.flags.rl_len:
             self.bottom = (self.bottom + 1) % self.flags.rl_len
         else:
             self.size += 1
         self.top = (self.top + 1) % self.flags.rl_len
 
+    def add_batch(self, state_history, state_card, action, reward, terminal):
+        """ same as calling add for every row, in order; rows older than rl_len are dropped """
+        n = len(action)
+        rl_len = self.flags.rl_len
+        skip = max(0, n - rl_len)
+        start = (self.top + skip) % rl_len
+        first = min(n - skip, rl_len - start)
+        last_top = (self.top - 1) % rl_len
+        if self.size > 0 and not self.terminal_buffer[last_top]:
+            self.next_buffer[last_top] = start
+        terminal = np.asarray(terminal)
+        slots = (start + np.arange(n - skip)) % rl_len
+        next_slots = np.where(terminal[skip:], slots, np.roll(slots, -1))
+        if n > skip and not terminal[-1]:
+            next_slots[-1] = -1
+        for buffer, data in ((self.state_history_buffer, state_history), (self.state_card_buffer, state_card),
+                             (self.action_buffer, action), (self.reward_buffer, reward),
+                             (self.terminal_buffer, terminal), (self.next_buffer, np.pad(next_slots, (skip, 0)))):
+            buffer[start:start + first] = data[skip:skip + first]
+            buffer[:n - skip - first] = data[skip + first:]
+        overflow = max(0, self.size + n - rl_len)
+        self.bottom = (self.bottom + overflow) % rl_len
+        self.size = min(self.size + n, rl_len)
+        self.top = (self.top + n) % rl_len
+
     def add_terminal(self, reward):
         last_top = (self.top - 1) % self.flags.rl_len
         self.reward_buffer[last_top] = reward
         self.terminal_buffer[last_top] = True
+        self.next_buffer[last_top] = last_top
 
     def get_random_batch(self):
-        indices = np.random.randint(0, self.size, self.flags.batch)
-        indices2 = indices + 1
-        batch_state_history_buffer = np.take(self.state_history_buffer, indices, axis=0)
-        batch_state_card_buffer = np.take(self.state_card_buffer, indices, axis=0)
-        batch_state_history_buffer2 = np.take(self.state_history_buffer, indices2, axis=0, mode='wrap')
-        batch_state_card_buffer2 = np.take(self.state_card_buffer, indices2, axis=0, mode='wrap')
-        batch_action_buffer = np.take(self.action_buffer, indices)
-        batch_reward_buffer = np.take(self.reward_buffer, indices)
-        batch_terminal_buffer = np.take(self.terminal_buffer, indices)
-        return batch_state_history_buffer, batch_state_card_buffer, batch_action_buffer, batch_reward_buffer, \
-               batch_terminal_buffer, batch_state_history_buffer2, batch_state_card_buffer2
+        """ the returned arrays are views of preallocated batch buffers, overwritten by the next call """
+        # the newest transition has no next state yet unless it is terminal
+        newest = (self.top - 1) % self.flags.rl_len
+        count = self.size if self.next_buffer[newest] >= 0 else self.size - 1
+        if count <= 0:
+            raise ValueError('no transition with a next state to sample yet')
+        indices = (self.bottom + np.random.randint(0, count, self.flags.batch)) % self.flags.rl_len
+        np.take(self.buffer, indices, out=self.batch, mode='clip')
+        np.take(self.buffer, self.batch['next'], out=self.batch2, mode='clip')
+        return self.batch['state_history'], self.batch['state_card'], self.batch['action'], self.batch['reward'], \
+               self.batch['terminal'], self.batch2['state_history'], self.batch2['state_card']
@@ -9,23 +9,35 @@ class MCTS():
     This class handles the MCTS tree.
     """
 
-    def __init__(self, game, nnet):
+    def __init__(self, game, nnet, capacity=64):
         self.game = game
         self.nnet = nnet
-        self.Qsa = {}  # stores Q values for s,a (as defined in the paper)
-        self.Nsa = {}  # stores #times edge s,a was visited
-        self.Ns = {}  # stores #times board s was visited
-        self.Ps = {}  # stores initial policy (returned by neural net)
-
         self.numMCTSSims = 25
         self.cpuct = 1
         self.actionSize = 3
 
+        # node table: state key -> row of the statistics arrays, a state gets a row when it is expanded
+        self.nodeIds = {}
+        self.Qsa = np.zeros([capacity, self.actionSize])  # stores Q values for s,a (as defined in the paper)
+        self.Nsa = np.zeros([capacity, self.actionSize])  # stores #times edge s,a was visited
+        self.Ns = np.zeros([capacity])  # stores #times board s was visited
+        self.Ps = np.zeros([capacity, self.actionSize])  # stores initial policy (returned by neural net)
+
     def getStateRepresentation(self, position, history, card):
-        a = str(position)
-        b = ''.join([str(x) for x in history.flatten().tolist()])
-        c = ''.join([str(x) for x in card.flatten().tolist()])
-        return a + b + c
+        # history codes and card ids (<= 52) fit in int8, shapes are fixed so the bytes are unambiguous
+        return bytes(bytearray([position])) + np.asarray(history, np.int8).tobytes() + \
+            np.asarray(card, np.int8).tobytes()
+
+    def addNode(self, s, ps):
+        n = len(self.nodeIds)
+        if n == self.Ns.shape[0]:
+            self.Qsa = np.concatenate([self.Qsa, np.zeros_like(self.Qsa)])
+            self.Nsa = np.concatenate([self.Nsa, np.zeros_like(self.Nsa)])
+            self.Ns = np.concatenate([self.Ns, np.zeros_like(self.Ns)])
+            self.Ps = np.concatenate([self.Ps, np.zeros_like(self.Ps)])
+        self.nodeIds[s] = n
+        self.Ps[n] = ps
+        return n
 
     def numToAction(self, n):
         if n == 0:
@@ -50,7 +62,10 @@ class MCTS():
             self.search(position, history, card, data)
 
         s = self.getStateRepresentation(position, history, card)
-        counts = [self.Nsa[(s, a)] if (s, a) in self.Nsa else 0 for a in range(self.actionSize)]
+        if s in self.nodeIds:
+            counts = self.Nsa[self.nodeIds[s]].tolist()
+        else:
+            counts = [0] * self.actionSize
 
         if temp == 0:
             bestA = np.argmax(counts)
@@ -99,30 +114,19 @@ class MCTS():
 
         s = self.getStateRepresentation(position, history, card)
 
-        if s not in self.Ps:       #never visited
+        if s not in self.nodeIds:       #never visited
             # leaf node
-            self.Ps[s], v = self.nnet.choose_action_avg(position, history, card)   # 0 1 2   c r f
-
-            sum_Ps_s = np.sum(self.Ps[s])
-            self.Ps[s] /= sum_Ps_s  # renormalize
-
-            self.Ns[s] = 0
+            ps, v = self.nnet.choose_action_avg(position, history, card)   # 0 1 2   c r f
+            self.addNode(s, ps / np.sum(ps))  # renormalize
             return v
 
-        cur_best = -float('inf')
-        best_act = -1
+        n = self.nodeIds[s]
 
-        # pick the action with the highest upper confidence bound
-        for a in range(self.actionSize):
-            if (s, a) in self.Qsa:
-                u = self.Qsa[(s, a)] + self.cpuct * self.Ps[s][a] * math.sqrt(self.Ns[s]) / (
-                1 + self.Nsa[(s, a)])
-            else:
-                u = self.cpuct * self.Ps[s][a] * math.sqrt(self.Ns[s] + EPS)  # Q = 0 ?
-
-            if u > cur_best:
-                cur_best = u
-                best_act = a
+        # pick the action with the highest upper confidence bound, unvisited edges have Q = 0
+        nsa = self.Nsa[n]
+        u = self.Qsa[n] + self.cpuct * self.Ps[n] * np.where(
+            nsa > 0, math.sqrt(self.Ns[n]) / (1 + nsa), math.sqrt(self.Ns[n] + EPS))
+        best_act = int(np.argmax(u))
 
         a = best_act
 
@@ -147,13 +151,7 @@ class MCTS():
                 v = self.search(next_position, next_history, next_card, next_data)
 
         #####
-        if (s, a) in self.Qsa:
-            self.Qsa[(s, a)] = (self.Nsa[(s, a)] * self.Qsa[(s, a)] + v) / (self.Nsa[(s, a)] + 1)
-            self.Nsa[(s, a)] += 1
-
-        else:
-            self.Qsa[(s, a)] = v
-            self.Nsa[(s, a)] = 1
-
-        self.Ns[s] += 1
+        self.Qsa[n, a] = (self.Nsa[n, a] * self.Qsa[n, a] + v) / (self.Nsa[n, a] + 1)
+        self.Nsa[n, a] += 1
+        self.Ns[n] += 1
         return v
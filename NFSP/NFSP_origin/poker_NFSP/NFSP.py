@@ -1,11 +1,12 @@
 import numpy as np
 import tensorflow as tf
 import tensorflow.contrib as tfc
-from XFP import XFP, LeducRLEnv
+from XFP import XFP, LeducRLEnv, LeducBatchRLEnv
 from functools import reduce  ###
 import threading
 import socket
 import matplotlib.pyplot as plt
+from acpc import MessageReader, MatchStateParser, Result
 
 
 
@@ -99,25 +100,27 @@ class myThread(threading.Thread):
         y_axis = [[],[],[],[]]
         out_log = False
         score_log = 0
+        reader = MessageReader(clientSocket)
+        parser = MatchStateParser(card_num=self.nfsp.flags.card_num)
         while True:
 
             # print('准备接受服务器消息')
-            recvData = ''
-            while len(recvData) == 0:
-                # print("666")
-                recvData = clientSocket.recv(4096).decode('utf-8')
-            # recvData = recvData.strip('\r\n')
-
-            if recvData[-1] == '%':
-                # print(self.name + '收到结果消息:%s' % (recvData[:-1]))              #1
+            recvData = reader.read()
+            if recvData is None:
+                break
+            turn = 0 if cnt % 2 == 0 else 1
+            observation = parser.parse(recvData, turn)
+
+            if isinstance(observation, Result):
+                # print(self.name + '收到结果消息:%s' % (observation.message))              #1
                 cnt += 1
-                score = recvData[recvData.rfind(':') + 1:-1]
+                score = observation.score
                 if out_log:
                     print('=====第%d局比赛%s得分:%s=====\n' % (cnt, self.name, score))     #1
                     score_log += int(score[:score.find('.')])
 
                 # 9月27日改动
-                clientSocket.send(recvData.encode())
+                reader.send(recvData, terminator='')  # echoed as received
                 # print(self.name + '发送结果消息（多余）:%s\n' % (recvData[:-1]))
                 # 9月27日改动
 
@@ -160,9 +163,8 @@ class myThread(threading.Thread):
                 # print(self.name + '调试:%s' % (recvData))
                 # print('当前状态信息:%s' % (recvData[recvData.rfind(':') + 4:]))
 
-                turn = 0 if cnt % 2 == 0 else 1
-                myState = getState(recvData[recvData.rfind(':') + 4:], turn)
-                myCard = getCard(recvData[:recvData.rfind(':')])
+                myState = observation.state  # getState / getCard, reused by the parser
+                myCard = observation.card
                 myTurn = self.id - 1  ##
 
                 action, tag = self.nfsp.choose_action(myTurn, myState, myCard)
@@ -186,7 +188,7 @@ class myThread(threading.Thread):
             # fcr (limit)
 
             # 手动
-            recvData = recvData[:recvData.rfind(':')]
+            recvData = observation.prefix
 
             recvData += ':'
             if self.name == "player1" and (cnt < -1):
@@ -211,11 +213,9 @@ class myThread(threading.Thread):
                 if action == 2:
                     recvData += 'f'
 
-
-            recvData += '\r\n'
             # 手动
 
-            clientSocket.send(recvData.encode())
+            reader.send(recvData)
             # print(self.name + '发送消息:%s\n' % (recvData[:-2]))          #1
 
         clientSocket.close()
@@ -244,14 +244,13 @@ class myThread2(threading.Thread):
 
         cnt = 0
         ix = 0
+        reader = MessageReader(clientSocket)
         while True:
 
             # print('准备接受服务器消息')
-            recvData = ''
-            while len(recvData) == 0:
-                # print("666")
-                recvData = clientSocket.recv(4096).decode('utf-8')
-            # recvData = recvData.strip('\r\n')
+            recvData = reader.read()
+            if recvData is None:
+                break
 
             if recvData[-1] == '%':
                 print(self.name + '收到结果消息:%s' % (recvData[:-1]))        ##
@@ -288,10 +287,9 @@ class myThread2(threading.Thread):
             recvData += ':'
             recvData += getAction(cnt, ix)
             ix += 1
-            recvData += '\r\n'
             # 手动
 
-            clientSocket.send(recvData.encode())
+            reader.send(recvData)
             # print(self.name + '发送消息:%s\n' % (recvData[:-2]))
 
         clientSocket.close()
@@ -442,6 +440,51 @@ class NFSP(object):
             action = np.random.choice(self.env.action_space, p=prob[0])
             return action, 'avg'  # average
 
+    def choose_actions(self, position, state_history, state_card):
+        """ choose_action for a batch of observations of one position, with one forward """
+        n = len(state_history)
+        q_logits_s, prob = self.sess.run([self.ops[position]['q_logits_s'], self.ops[position]['pi_logits_s']],
+                                         feed_dict={self.ops[position]['state_history_ph']: state_history,
+                                                    self.ops[position]['state_card_ph']: state_card})
+        greedy = np.where(np.random.rand(n) < self.epsilon, np.random.randint(0, self.env.action_space, n),
+                          np.argmax(q_logits_s, axis=1))
+        cum = np.cumsum(prob, axis=1)
+        average = np.minimum((cum < np.random.rand(n, 1) * cum[:, -1:]).sum(axis=1), self.env.action_space - 1)
+        br = np.random.rand(n) < self.flags.anticipatory
+        return np.where(br, greedy, average), br
+
+    def play_batch(self, env):
+        """ plays env.batch_size hands of self-play in lockstep on a LeducBatchRLEnv and stores and
+            trains on them as the socket threads do, hand after hand """
+        ob = env.reset()
+        records = [[], []]  # per position: (hand, state_history, state_card, action, br) of each decision
+        while not env.done.all():
+            actions = np.zeros([env.batch_size], np.int64)
+            for position in range(2):
+                hands = np.nonzero(ob['turn'] == position)[0]
+                if len(hands):
+                    action, br = self.choose_actions(position, ob['state'][hands], ob['card'][hands])
+                    actions[hands] = action
+                    records[position].append((hands, ob['state'][hands], ob['card'][hands], action, br))
+            ob = env.act(actions)
+
+        for position in range(2):
+            hand, state_history, state_card, action, br = [np.concatenate(x) for x in zip(*records[position])]
+            order = np.argsort(hand, kind='stable')  # decisions of a hand stay in play order
+            hand, state_history, state_card, action, br = \
+                hand[order], state_history[order], state_card[order], action[order], br[order]
+            terminal = np.append(hand[1:] != hand[:-1], True)
+            reward = np.where(terminal, ob['payoff'][hand, position], 0).astype(np.int8)  # no decimals
+            self.sl_replay[position].add_batch(state_history[br], state_card[br], action[br])
+            self.rl_replay[position].add_batch(state_history, state_card, action, reward, terminal)
+            self.epsilon *= 0.99 ** terminal.sum()
+
+            previous = self.iter[position]
+            self.iter[position] += len(action)
+            for it in range(previous + 1, self.iter[position] + 1):
+                if it % self.flags.train_frequency == 0 and it > self.flags.train_start:
+                    self.train(position)
+
     def play_game(self):
 
         player1 = myThread(1, "player1", 8000, self)                  #
@@ -502,6 +545,20 @@ class NFSP(object):
 
         # print 'train policy {:d} at step {:d}, global_step={:d}, epsilon={:.4f}'.format(position, self.iter[position],global_step, self.epsilon)
 
+    def compute_tree_policy(self, env):
+        """ both policies on env.tree (a LeducBatchRLEnv) as [pC, pB] infoset arrays, mixed with
+            the greedy best response as compute_self_policy """
+        policy = []
+        for player in range(2):
+            state_history, state_card, facing = env.infoset_observations(player)
+            q_logits_s, prob = self.sess.run([self.ops[player]['q_logits_s'], self.ops[player]['pi_logits_s']],
+                                             feed_dict={self.ops[player]['state_history_ph']: state_history,
+                                                        self.ops[player]['state_card_ph']: state_card})
+            prob = prob * (1 - self.flags.anticipatory)
+            prob[np.arange(len(prob)), np.argmax(q_logits_s, axis=1)] += self.flags.anticipatory * 1.0
+            policy.append(env.tree_policy(prob, facing))
+        return policy
+
     def My_compute_self_policy(self):
         policy = [{}, {}]
         cards = [[],[],[],[]]     ## c52_2(1326),c48_3,c45_1,c44_1
@@ -602,6 +659,29 @@ class ReservoirReplay(object):  # sl
 
             self.top += 1
 
+    def add_batch(self, state_history, state_card, action):
+        """ same as calling add for every row, in order """
+        n = len(action)
+        fill = min(n, self.flags.sl_len - self.size)
+        if fill > 0:
+            self.state_history_buffer[self.top:self.top + fill] = state_history[:fill]
+            self.state_card_buffer[self.top:self.top + fill] = state_card[:fill]
+            self.action_buffer[self.top:self.top + fill] = action[:fill]
+            self.top += fill
+            self.size += fill
+        if fill < n:
+            # row with stream position t is kept with probability sl_len / (t + 1), as in add
+            prob_add = float(self.flags.sl_len) / (self.top + 1 + np.arange(n - fill))
+            src = fill + np.nonzero(np.random.rand(n - fill) < prob_add)[0]
+            index = np.random.randint(0, self.flags.sl_len, len(src))
+            # when two rows hit the same slot the later one wins
+            index, last = np.unique(index[::-1], return_index=True)
+            src = src[::-1][last]
+            self.state_history_buffer[index] = np.take(state_history, src, axis=0)
+            self.state_card_buffer[index] = np.take(state_card, src, axis=0)
+            self.action_buffer[index] = np.take(action, src)
+            self.top += n - fill
+
     def get_random_batch(self):
         indices = np.random.randint(0, self.size, self.flags.batch)
         batch_state_history_buffer = np.take(self.state_history_buffer, indices, axis=0)
@@ -614,41 +694,83 @@ class CircularReplay(object):  # rl
     def __init__(self, flags, env):
         self.flags = flags
         self.env = env
-        self.state_history_buffer = np.zeros([self.flags.rl_len] + self.env.state_history_space, np.int8)
-        self.state_card_buffer = np.zeros([self.flags.rl_len] + self.env.state_card_space, np.int8)
-        self.action_buffer = np.zeros([self.flags.rl_len], np.int8)
-        self.reward_buffer = np.zeros([self.flags.rl_len], np.int8)
-        self.terminal_buffer = np.zeros([self.flags.rl_len], np.int8)
+        # one record per transition; 'next' is the slot of the next state (-1 until it is written)
+        self.dtype = np.dtype([('state_history', np.int8, tuple(self.env.state_history_space)),
+                               ('state_card', np.int8, tuple(self.env.state_card_space)),
+                               ('action', np.int8),
+                               ('reward', np.int8),
+                               ('terminal', np.int8),
+                               ('next', np.int32)])
+        self.buffer = np.zeros([self.flags.rl_len], self.dtype)
+        self.buffer['next'] = -1
+        self.state_history_buffer = self.buffer['state_history']
+        self.state_card_buffer = self.buffer['state_card']
+        self.action_buffer = self.buffer['action']
+        self.reward_buffer = self.buffer['reward']
+        self.terminal_buffer = self.buffer['terminal']
+        self.next_buffer = self.buffer['next']
+        self.batch = np.zeros([self.flags.batch], self.dtype)
+        self.batch2 = np.zeros([self.flags.batch], self.dtype)
         self.size = 0
         self.top = 0
         self.bottom = 0
 
     def add(self, state_history, state_card, action, reward, terminal):
+        last_top = (self.top - 1) % self.flags.rl_len
+        if self.size > 0 and not self.terminal_buffer[last_top]:
+            self.next_buffer[last_top] = self.top
         self.state_history_buffer[self.top] = state_history
         self.state_card_buffer[self.top] = state_card
         self.action_buffer[self.top] = action
         self.reward_buffer[self.top] = reward
         self.terminal_buffer[self.top] = terminal
+        self.next_buffer[self.top] = self.top if terminal else -1
         if self.size == self.flags.rl_len:
             self.bottom = (self.bottom + 1) % self.flags.rl_len
         else:
             self.size += 1
         self.top = (self.top + 1) % self.flags.rl_len
 
+    def add_batch(self, state_history, state_card, action, reward, terminal):
+        """ same as calling add for every row, in order; rows older than rl_len are dropped """
+        n = len(action)
+        rl_len = self.flags.rl_len
+        skip = max(0, n - rl_len)
+        start = (self.top + skip) % rl_len
+        first = min(n - skip, rl_len - start)
+        last_top = (self.top - 1) % rl_len
+        if self.size > 0 and not self.terminal_buffer[last_top]:
+            self.next_buffer[last_top] = start
+        terminal = np.asarray(terminal)
+        slots = (start + np.arange(n - skip)) % rl_len
+        next_slots = np.where(terminal[skip:], slots, np.roll(slots, -1))
+        if n > skip and not terminal[-1]:
+            next_slots[-1] = -1
+        for buffer, data in ((self.state_history_buffer, state_history), (self.state_card_buffer, state_card),
+                             (self.action_buffer, action), (self.reward_buffer, reward),
+                             (self.terminal_buffer, terminal), (self.next_buffer, np.pad(next_slots, (skip, 0)))):
+            buffer[start:start + first] = data[skip:skip + first]
+            buffer[:n - skip - first] = data[skip + first:]
+        overflow = max(0, self.size + n - rl_len)
+        self.bottom = (self.bottom + overflow) % rl_len
+        self.size = min(self.size + n, rl_len)
+        self.top = (self.top + n) % rl_len
+
     def add_terminal(self, reward):
         last_top = (self.top - 1) % self.flags.rl_len
         self.reward_buffer[last_top] = reward
         self.terminal_buffer[last_top] = True
+        self.next_buffer[last_top] = last_top
 
     def get_random_batch(self):
-        indices = np.random.randint(0, self.size, self.flags.batch)
-        indices2 = indices + 1
-        batch_state_history_buffer = np.take(self.state_history_buffer, indices, axis=0)
-        batch_state_card_buffer = np.take(self.state_card_buffer, indices, axis=0)
-        batch_state_history_buffer2 = np.take(self.state_history_buffer, indices2, axis=0, mode='wrap')
-        batch_state_card_buffer2 = np.take(self.state_card_buffer, indices2, axis=0, mode='wrap')
-        batch_action_buffer = np.take(self.action_buffer, indices)
-        batch_reward_buffer = np.take(self.reward_buffer, indices)
-        batch_terminal_buffer = np.take(self.terminal_buffer, indices)
-        return batch_state_history_buffer, batch_state_card_buffer, batch_action_buffer, batch_reward_buffer, \
-               batch_terminal_buffer, batch_state_history_buffer2, batch_state_card_buffer2
+        """ the returned arrays are views of preallocated batch buffers, overwritten by the next call """
+        # the newest transition has no next state yet unless it is terminal
+        newest = (self.top - 1) % self.flags.rl_len
+        count = self.size if self.next_buffer[newest] >= 0 else self.size - 1
+        if count <= 0:
+            raise ValueError('no transition with a next state to sample yet')
+        indices = (self.bottom + np.random.randint(0, count, self.flags.batch)) % self.flags.rl_len
+        np.take(self.buffer, indices, out=self.batch, mode='clip')
+        np.take(self.buffer, self.batch['next'], out=self.batch2, mode='clip')
+        return self.batch['state_history'], self.batch['state_card'], self.batch['action'], self.batch['reward'], \
+               self.batch['terminal'], self.batch2['state_history'], self.batch2['state_card']
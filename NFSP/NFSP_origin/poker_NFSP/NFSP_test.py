@@ -2,7 +2,7 @@ import numpy as np
 import tensorflow as tf
 import pickle
 import copy
-from XFP import XFP, LeducRLEnv
+from XFP import XFP, LeducRLEnv, LeducBatchRLEnv
 from NFSP import NFSP
 import matplotlib.pyplot as plt
 import argparse
@@ -12,7 +12,7 @@ FLAGS = tf.app.flags.FLAGS
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--seed', help='seed', default='33')
-args = parser.parse_args()
+args, _ = parser.parse_known_args()  # the other flags are tf.app.flags
 
 # Experiment settings
 tf.app.flags.DEFINE_integer('seed', 33, 'seed')
@@ -28,6 +28,7 @@ tf.app.flags.DEFINE_integer('train_start', 1024, 'training start')
 tf.app.flags.DEFINE_integer('rl_len', 200000, 'buffer length for rl')
 tf.app.flags.DEFINE_integer('sl_len', 2000000, 'buffer length for sl')
 tf.app.flags.DEFINE_integer('refit', 300, 'refit target network')
+tf.app.flags.DEFINE_integer('local_batch', 0, 'hands per lockstep batch of local self-play, 0 plays over ACPC')
 FLAGS.seed = int(args.seed)
 
 # # 已改写到NFSP中
@@ -77,7 +78,13 @@ if __name__ == '__main__':
     # some_tests()
     agent = NFSP(FLAGS)
     played_games = 0
-    agent.play_game()  ## epsilon
+    if FLAGS.local_batch:
+        env = LeducBatchRLEnv(FLAGS.local_batch, card_num=FLAGS.card_num, seed=FLAGS.seed)
+        while played_games < FLAGS.fsp_iter:
+            agent.play_batch(env)
+            played_games += FLAGS.local_batch
+    else:
+        agent.play_game()  ## epsilon
     # while True:
     #     agent.play_game()
     #     agent.epsilon *= 0.99
@@ -1,27 +1,28 @@
 import numpy as np
+from leduc_tree import LeducTree, CACHE_DIR
 
 
 class XFP(object):
     possible_cards_list = None
     ending = None
+    invest = None
     player1_states_set = None
     player2_states_set = None
     round1_states_set = None
+    tree = None
     bool_init = False
 
-    def __init__(self, verbose=False, card_num=6, seed=None):
+    def __init__(self, verbose=False, card_num=6, seed=None, cache_dir=CACHE_DIR):
         self.verbose = verbose
         if seed is not None:
             np.random.seed(seed)
-        self.player1_states_set = set()
-        self.player2_states_set = set()
-        self.round1_states_set = set()
-
-        self.ending = {}
-        # build the tree
-        self.dfs(1, 0, "", 1, 1)
+        # the tree is built by build_tree once per card_num and then memory-mapped from cache_dir
+        XFP.tree = LeducTree.load(card_num, lambda: self.build_tree(card_num), cache_dir)
+        self.ending, self.invest, self.player1_states_set, self.player2_states_set, \
+            self.round1_states_set, self.possible_cards = XFP.tree.xfp_sets()
 
         XFP.ending = self.ending
+        XFP.invest = self.invest
         XFP.player1_states_set = self.player1_states_set
         XFP.player2_states_set = self.player2_states_set
         XFP.round1_states_set = self.round1_states_set
@@ -30,21 +31,10 @@ class XFP(object):
             print (sorted(self.player1_states_set, key=lambda x: len(x)))
             print (sorted(self.player2_states_set, key=lambda x: len(x)))
             print (sorted(self.round1_states_set, key=lambda x: len(x)))
-
-        self.possible_cards = set()
-        for i in range(card_num):
-            for j in range(card_num):
-                for k in range(card_num):
-                    if i == j or j == k or i == k:
-                        continue
-                    self.possible_cards.add(str(i % (card_num >> 1)) + str(j % (card_num >> 1)) + str(k % (card_num >> 1)))
-        if verbose:
             print (len(self.possible_cards), sorted(self.possible_cards))
             print ('ending=', XFP.ending.keys())
-        XFP.possible_cards_list = list(self.possible_cards)
+        XFP.possible_cards_list = list(XFP.tree.deals)
 
-        self.q_value1 = {}
-        self.q_value2 = {}
         self.q_value1_final = {}
         self.q_value2_final = {}
 
@@ -56,9 +46,27 @@ class XFP(object):
 
         XFP.bool_init = True
 
+    def build_tree(self, card_num):
+        """ walks the betting tree and enumerates the deals, for LeducTree to compile """
+        self.player1_states_set = set()
+        self.player2_states_set = set()
+        self.round1_states_set = set()
+
+        self.ending = {}
+        self.invest = {}  # history -> [invest1, invest2] before acting there
+        self.dfs(1, 0, "", 1, 1)
+        XFP.ending = self.ending  # compute_payoff reads the class attribute
+
+        self.possible_cards = set()
+        for i in range(card_num):
+            for j in range(card_num):
+                for k in range(card_num):
+                    if i == j or j == k or i == k:
+                        continue
+                    self.possible_cards.add(str(i % (card_num >> 1)) + str(j % (card_num >> 1)) + str(k % (card_num >> 1)))
+        return self
+
     def finish(self):
-        self.q_value1 = {}
-        self.q_value2 = {}
         self.q_value1_final = {}
         self.q_value2_final = {}
 
@@ -100,170 +108,45 @@ class XFP(object):
         else:
             q[card_state + state] = {action: value}
 
-    def dynamic_dfs_p1(self, card_state, state, action):
-        if self.get_q_s_a(self.q_value1, card_state, state, action) is not None:
-            return self.get_q_s_a(self.q_value1, card_state, state, action)
-
-        if state in self.ending:
-            value, _ = self.compute_payoff(card_state, state)
-            self.update_q_s_a(self.q_value1, card_state, state, action, value)
-            return value
-        else:
-            state_next = state + action
-            if state_next in self.ending:
-                value, _ = self.compute_payoff(card_state, state_next)
-            elif state_next in self.player1_states_set:
-                value = max(self.dynamic_dfs_p1(card_state, state_next, 'C'), self.dynamic_dfs_p1(card_state, state_next, 'B'))
-            elif state_next in self.player2_states_set:
-                if state_next in self.round1_states_set:
-                    rd = 1
-                else:
-                    rd = 2
-                prob = self.compute_opponent_policy(1, rd, state_next, card_state)
-                value = prob[0] * max(self.dynamic_dfs_p1(card_state, state_next + 'C', 'C'),
-                                      self.dynamic_dfs_p1(card_state, state_next + 'C', 'B'))
-                value += prob[1] * max(self.dynamic_dfs_p1(card_state, state_next + 'B', 'C'),
-                                       self.dynamic_dfs_p1(card_state, state_next + 'B', 'B'))
-            else:
-                assert False
-        self.update_q_s_a(self.q_value1, card_state, state, action, value)
-
-        if state in XFP.player1_states_set:
-            if state in XFP.round1_states_set:
-                card = card_state[0]
-            else:
-                card = card_state[:2]
-            if self.get_q_s_a(self.q_value1_final, card, state, action) is not None:
-                item = self.get_q_s_a(self.q_value1_final, card, state, action)
-            else:
-                item = [0.0, 0.0]
-            item = [item[0] + value, item[1] + 1.0]
-            self.update_q_s_a(self.q_value1_final, card, state, action, item)
-        return value
-
-    def dynamic_dfs_p2(self, card_state, state, action):
-        if self.get_q_s_a(self.q_value2, card_state, state, action) is not None:
-            return self.get_q_s_a(self.q_value2, card_state, state, action)
-
-        if state in self.ending:
-            _, value = self.compute_payoff(card_state, state)
-            self.update_q_s_a(self.q_value2, card_state, state, action, value)
-            return value
-        else:
-            state_next = state + action
-            if state_next in self.ending:
-                _, value = self.compute_payoff(card_state, state_next)
-            elif state_next in self.player2_states_set:
-                value = max(self.dynamic_dfs_p2(card_state, state_next, 'C'), self.dynamic_dfs_p2(card_state, state_next, 'B'))
-            elif state_next in self.player1_states_set:
-                if state_next in self.round1_states_set:
-                    rd = 1
-                else:
-                    rd = 2
-                prob = self.compute_opponent_policy(2, rd, state_next, card_state)
-                value = prob[0] * max(self.dynamic_dfs_p2(card_state, state_next + 'C', 'C'),
-                                      self.dynamic_dfs_p2(card_state, state_next + 'C', 'B'))
-                value += prob[1] * max(self.dynamic_dfs_p2(card_state, state_next + 'B', 'C'),
-                                       self.dynamic_dfs_p2(card_state, state_next + 'B', 'B'))
-            else:
-                assert False
-        self.update_q_s_a(self.q_value2, card_state, state, action, value)
-
-        if state in XFP.player2_states_set:
-            if state in XFP.round1_states_set:
-                card = card_state[2]
-            else:
-                card = card_state[1:]
-            if self.get_q_s_a(self.q_value2_final, card, state, action) is not None:
-                item = self.get_q_s_a(self.q_value2_final, card, state, action)
-            else:
-                item = [0.0, 0.0]
-            item = [item[0] + value, item[1] + 1.0]
-            self.update_q_s_a(self.q_value2_final, card, state, action, item)
-        return value
-
     def get_random_policy(self):
-        if len(self.q_value1_final) == 0:
-            self.compute_p1_best_response()
-        if len(self.q_value2_final) == 0:
-            self.compute_p2_best_response()
         policy_p1 = {}
         policy_p2 = {}
 
-        for key, _ in self.q_value1_final.iteritems():
+        for key in XFP.tree.infoset_keys[0]:
             p = np.random.rand()
             policy_p1[key] = [p, 1.0 - p]
 
-        for key, _ in self.q_value2_final.iteritems():
+        for key in XFP.tree.infoset_keys[1]:
             p = np.random.rand()
             policy_p2[key] = [p, 1.0 - p]
         return policy_p1, policy_p2
 
     def get_uniform_policy(self):
-        if len(self.q_value1_final) == 0:
-            self.compute_p1_best_response()
-        if len(self.q_value2_final) == 0:
-            self.compute_p2_best_response()
-        policy_p1 = {}
-        policy_p2 = {}
+        return XFP.tree.policy_to_dict(0, XFP.tree.uniform_policy(0)), \
+            XFP.tree.policy_to_dict(1, XFP.tree.uniform_policy(1))
 
-        for key, _ in self.q_value1_final.iteritems():
-            policy_p1[key] = [0.5, 0.5]
-
-        for key, _ in self.q_value2_final.iteritems():
-            policy_p2[key] = [0.5, 0.5]
-        return policy_p1, policy_p2
-
-    def compute_opponent_policy(self, player, rd, opponent_state, card_state):
-        #  use policy
+    def opponent_policy_array(self, opponent):
+        """ opponent (0 for p1, 1 for p2) policy as a [n_infoset, 2] array over XFP.tree infosets """
         if not self.opponent_realization_enable:
-            if player == 1:
-                if self.opponent_policy_p2 is None:
-                    return 0.37, 0.63
-                if rd == 1:
-                    return self.opponent_policy_p2[card_state[2] + opponent_state]
-                if rd == 2:
-                    return self.opponent_policy_p2[card_state[1:] + opponent_state]
-            else:
-                if self.opponent_policy_p1 is None:
-                    return 0.37, 0.63
-                if rd == 1:
-                    return self.opponent_policy_p1[card_state[0] + opponent_state]
-                if rd == 2:
-                    return self.opponent_policy_p1[card_state[:2] + opponent_state]
-        #  use realization
+            policy = self.opponent_policy_p1 if opponent == 0 else self.opponent_policy_p2
         else:
-            if player == 1:
-                if self.opponent_realization_p2 is None:
-                    return 0.37, 0.63
-                if rd == 1:
-                    v1 = self.opponent_realization_p2[card_state[2] + opponent_state]['C'][0]
-                    v2 = self.opponent_realization_p2[card_state[2] + opponent_state]['B'][0]
-                if rd == 2:
-                    v1 = self.opponent_realization_p2[card_state[1:] + opponent_state]['C'][0]
-                    v2 = self.opponent_realization_p2[card_state[1:] + opponent_state]['B'][0]
-            else:
-                if self.opponent_realization_p1 is None:
-                    return 0.37, 0.63
-                if rd == 1:
-                    v1 = self.opponent_realization_p1[card_state[0] + opponent_state]['C'][0]
-                    v2 = self.opponent_realization_p1[card_state[0] + opponent_state]['B'][0]
-                if rd == 2:
-                    v1 = self.opponent_realization_p1[card_state[:2] + opponent_state]['C'][0]
-                    v2 = self.opponent_realization_p1[card_state[:2] + opponent_state]['B'][0]
-            return [v1 / (v1 + v2), v2 / (v1 + v2)]
+            policy = self.opponent_realization_p1 if opponent == 0 else self.opponent_realization_p2
+        if policy is None:
+            return XFP.tree.constant_policy(opponent, [0.37, 0.63])
+        return XFP.tree.policy_from_dict(opponent, policy)
+
+    def compute_best_response(self, player, q_value_final):
+        opponent_realization = XFP.tree.realization_plan(1 - player, self.opponent_policy_array(1 - player))
+        _, q, _ = XFP.tree.best_response(player, opponent_realization)
+        count = XFP.tree.infoset_count[player]
+        for i, key in enumerate(XFP.tree.infoset_keys[player]):
+            q_value_final[key] = {'C': [q[i, 0], count[i]], 'B': [q[i, 1], count[i]]}
 
     def compute_p1_best_response(self):
-        for cards in self.possible_cards_list:
-            for state in self.player1_states_set:
-                self.dynamic_dfs_p1(cards, state, 'C')
-                self.dynamic_dfs_p1(cards, state, 'B')
+        self.compute_best_response(0, self.q_value1_final)
 
     def compute_p2_best_response(self):
-        for cards in self.possible_cards_list:
-            for state in self.player2_states_set:
-                self.dynamic_dfs_p2(cards, state, 'C')
-                self.dynamic_dfs_p2(cards, state, 'B')
+        self.compute_best_response(1, self.q_value2_final)
 
     def choose_action_p1(self, state, incomplete_card, pround):
         if pround == 1:
@@ -286,6 +169,7 @@ class XFP(object):
             return 'C' if vc > vb else 'B'
 
     def dfs(self, pround, ranking, history, invest1, invest2, betting1=2, betting2=4):
+        self.invest[history.upper()] = [invest1, invest2]
         if pround == 1:
             if ranking == 0:
                 assert history == ""
@@ -356,40 +240,25 @@ class XFP(object):
             policy[key] = [p, 1.0 - p]
         return policy
 
+    @staticmethod
+    def tournament_payoffs(seed, games, p1_policy, p2_policy, batch=1 << 20):
+        """ player 1 payoff of every hand; policies could be realizations """
+        rng = np.random.RandomState(seed)
+        policy_p1 = XFP.tree.policy_from_dict(0, p1_policy)
+        policy_p2 = XFP.tree.policy_from_dict(1, p2_policy)
+        return np.concatenate([XFP.tree.play(policy_p1, policy_p2, min(batch, games - i), rng)
+                               for i in range(0, games, batch)])
+
     @staticmethod
     def tournament(seed, games, p1_policy, p2_policy):
-        np.random.seed(seed)
-        pay1 = pay2 = 0.0
-        for i in range(games):
-            cards = XFP.possible_cards_list[np.random.randint(len(XFP.possible_cards_list))]
-            game_state = ""
-            while True:
-                if game_state in XFP.ending:
-                    v1, v2 = XFP.compute_payoff(cards, game_state)
-                    pay1 += v1
-                    pay2 += v2
-                    break
-                if game_state in XFP.player1_states_set:
-                    if game_state in XFP.round1_states_set:
-                        prob = p1_policy[cards[0] + game_state]
-                    else:
-                        prob = p1_policy[cards[:2] + game_state]
-
-                    if type(prob) == dict:  # this is a realization
-                        prob = [prob['C'][0] / (prob['C'][0] + prob['B'][0]), ]
-                    action = 'C' if np.random.rand() < prob[0] else 'B'
-                    game_state = game_state + action
-                else:
-                    assert game_state in XFP.player2_states_set
-                    if game_state in XFP.round1_states_set:
-                        prob = p2_policy[cards[2] + game_state]
-                    else:
-                        prob = p2_policy[cards[1:] + game_state]
-                    if type(prob) == dict:  # this is a realization
-                        prob = [prob['C'][0] / (prob['C'][0] + prob['B'][0]), ]
-                    action = 'C' if np.random.rand() < prob[0] else 'B'
-                    game_state = game_state + action
-        return pay1, pay2
+        pay1 = XFP.tournament_payoffs(seed, games, p1_policy, p2_policy).sum()
+        return pay1, -pay1
+
+    @staticmethod
+    def tournament_confidence(seed, games, p1_policy, p2_policy, z=1.96):
+        """ mean player 1 payoff per hand and the half width of its confidence interval (z=1.96 for 95%) """
+        payoff = XFP.tournament_payoffs(seed, games, p1_policy, p2_policy)
+        return payoff.mean(), z * payoff.std(ddof=1) / np.sqrt(games)
 
     @staticmethod
     def dfs_realization_forward(realization_func, card_state, state, action, realization, policy1, policy2):
@@ -519,8 +388,6 @@ class LeducRLEnv(object):
         self.state_card_space = [card_num]
         self.action_space = 3                                #### 2->3
         self.card_num = card_num
-        self.bet_num = np.zeros([2, 2], np.int32)
-        self.dfs_state_history = np.zeros([2, 2, 2, 2], np.int32)
         if seed is not None:
             np.random.seed(seed)
 
@@ -532,33 +399,14 @@ class LeducRLEnv(object):
         self.current_player = 0
         self.history_string = ""
 
-        self.dfs("")
+        # read-only views of the cached XFP.tree history vectors
+        tree = XFP.tree
+        LeducRLEnv.history_string2vector = {h: tree.history_vector[i] for i, h in enumerate(tree.histories)
+                                            if not tree.terminal[i]}
         if verbose:
             for key in LeducRLEnv.history_string2vector:
                 print (key, np.reshape(LeducRLEnv.history_string2vector[key], [-1]))
 
-    def dfs(self, history):
-        if history in XFP.ending:
-            return
-        if history in LeducRLEnv.history_string2vector:
-            assert np.allclose(self.dfs_state_history, LeducRLEnv.history_string2vector[history])
-        else:
-            LeducRLEnv.history_string2vector[history] = self.dfs_state_history.copy()
-        player = 0 if history in XFP.player1_states_set else 1
-        pround = 1 if history in XFP.round1_states_set else 2
-
-        self.dfs_state_history[player, pround - 1, self.bet_num[player, pround - 1], 0] = 1
-        self.bet_num[player, pround - 1] += 1
-        self.dfs(history + 'C')
-        self.bet_num[player, pround - 1] -= 1
-        self.dfs_state_history[player, pround - 1, self.bet_num[player, pround - 1], 0] = 0
-
-        self.dfs_state_history[player, pround - 1, self.bet_num[player, pround - 1], 1] = 1
-        self.bet_num[player, pround - 1] += 1
-        self.dfs(history + 'B')
-        self.bet_num[player, pround - 1] -= 1
-        self.dfs_state_history[player, pround - 1, self.bet_num[player, pround - 1], 1] = 0
-
     def set_card_vectors(self):
         self.p0_card_vector[int(self.cards[0])] = 1
         self.p1_card_vector[int(self.cards[2])] = 1
@@ -616,6 +464,115 @@ class LeducRLEnv(object):
                     'history_str': self.history_string}
 
 
+class LeducBatchRLEnv(object):
+    """ B hands of LeducRLEnv stepped at once over the integer histories of XFP.tree.
+
+        Observations are in the ACPC layout read by NFSP.getState/getCard:
+            state: (B, 4, 6, 2) per round and action, [action (1 c, 2 r, 3 f), 1 if own action]
+            card:  (B, card_num) own hole card then board card, as suit * 13 + rank + 1
+        Actions are ACPC actions 0 'c', 1 'r', 2 'f' as in NFSP.choose_action; a raise facing
+        a bet calls and a fold not facing a bet checks, as the ACPC server does.
+    """
+    acpc_ranks = 'JQK'  # rank_dict of NFSP.getCard: J 9, Q 10, K 11
+
+    def __init__(self, batch_size, card_num=7, seed=None):
+        assert XFP.bool_init
+        tree = XFP.tree
+        self.tree = tree
+        self.batch_size = batch_size
+        self.card_num = card_num
+        self.state_history_space = [4, 6, 2]
+        self.state_card_space = [card_num]
+        self.action_space = 3
+        self.rng = np.random.RandomState(seed)
+
+        # child of every history for the ACPC actions c, r, f
+        actor = np.maximum(tree.player, 0)
+        index = np.arange(tree.n_history)
+        facing = tree.invest[index, actor] < tree.invest[index, 1 - actor]
+        self.facing = facing & ~tree.terminal
+        c_child, b_child = tree.child[:, 0], tree.child[:, 1]
+        self.acpc_child = np.stack([np.where(facing, b_child, c_child), b_child, c_child], axis=1)
+        self.acpc_child[tree.terminal] = -1
+
+        # betting of every history as seen by each player
+        self.state_table = np.zeros([tree.n_history, 2] + self.state_history_space, np.int8)
+        for h, i in tree.history_index.items():
+            count = [0, 0]
+            for k, a in enumerate(h):
+                j = tree.history_index[h[:k]]
+                rnd = tree.round[j] - 1
+                actor = tree.player[j]
+                if facing[j]:
+                    code = 3 if a == 'C' else 1
+                else:
+                    code = 1 if a == 'C' else 2
+                self.state_table[i, :, rnd, count[rnd], 0] = code
+                self.state_table[i, actor, rnd, count[rnd], 1] = 1
+                count[rnd] += 1
+
+        # cards of every deal as seen by each player in each round: the own hole card is a spade,
+        # the board the next suit if it pairs it; never depends on the opponent's hole card
+        self.card_table = np.zeros([tree.n_deal, 2, 2, card_num], np.int8)
+        for d, cards in enumerate(tree.deals):
+            for player, hole in ((0, 0), (1, 2)):
+                board_suit = 1 if cards[1] == cards[hole] else 0
+                self.card_table[d, player, :, 0] = 9 + int(cards[hole]) + 1
+                self.card_table[d, player, 1, 1] = board_suit * 13 + 9 + int(cards[1]) + 1
+
+        self.deal = np.zeros([batch_size], np.int64)
+        self.history = np.zeros([batch_size], np.int64)
+        self.reset()
+
+    def observe(self):
+        """ observations of the player to act in every hand; finished hands have turn -1,
+            their payoff and the observations of player 0 """
+        turn = self.tree.player[self.history]
+        observer = np.maximum(turn, 0)
+        rnd = self.tree.round[self.history] - 1
+        u = np.where(self.tree.terminal[self.history], self.tree.utility[self.deal, self.history], 0.0)
+        return {'state': self.state_table[self.history, observer],
+                'card': self.card_table[self.deal, observer, rnd],
+                'turn': turn,
+                'payoff': np.stack([u, -u], axis=1)}
+
+    def reset(self, mask=None):
+        """ deals new hands everywhere, or where mask is set """
+        index = np.arange(self.batch_size) if mask is None else np.nonzero(mask)[0]
+        self.deal[index] = self.rng.randint(self.tree.n_deal, size=len(index))
+        self.history[index] = self.tree.history_index['']
+        return self.observe()
+
+    def act(self, actions):
+        """ applies actions[i] to every unfinished hand i; finished hands ignore their action """
+        live = ~self.tree.terminal[self.history]
+        self.history[live] = self.acpc_child[self.history[live], np.asarray(actions)[live]]
+        return self.observe()
+
+    @property
+    def done(self):
+        return self.tree.terminal[self.history]
+
+    def infoset_observations(self, player):
+        """ the observation of player at every tree infoset of player, in infoset order, and
+            whether it faces a bet there """
+        tree = self.tree
+        deal, history = np.nonzero((tree.player == player)[None, :] & (tree.infoset >= 0))
+        infoset = tree.infoset[deal, history]
+        state = self.state_table[history, player]
+        card = self.card_table[deal, player, tree.round[history] - 1]
+        _, first = np.unique(infoset, return_index=True)
+        # every (deal, history) of an infoset is observed alike, so its policy is the one played
+        assert np.array_equal(state, state[first][infoset]) and np.array_equal(card, card[first][infoset])
+        return state[first], card[first], self.facing[history[first]]
+
+    @staticmethod
+    def tree_policy(acpc_probs, facing):
+        """ [pC, pB] per infoset from ACPC action probabilities (c, r, f) at the observations
+            of infoset_observations """
+        p_c = np.where(facing, acpc_probs[:, 2], acpc_probs[:, 0] + acpc_probs[:, 2])
+        return np.stack([p_c, 1.0 - p_c], axis=1)
+
 if __name__ == "__main__":
     env_xfp = XFP(True)
     env = LeducRLEnv(True, seed=100)
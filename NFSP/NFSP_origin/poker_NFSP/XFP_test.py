@@ -2,6 +2,8 @@ import matplotlib.pyplot as plt
 from matplotlib.ticker import EngFormatter
 import numpy as np
 from XFP import XFP
+from xfp_engine import SequenceFormXFP
+from cfr_engine import SequenceFormCFR
 
 
 def visualize(thing, realization=False):
@@ -84,7 +86,24 @@ def fictitious_play_realization(env, realization):  # much faster
     return realization
 
 
+def fictitious_play_sequence_form(env, policy_p1, policy_p2):  # realization plans as arrays, fastest
+    solver = SequenceFormXFP(XFP.tree, XFP.tree.policy_from_dict(0, policy_p1), XFP.tree.policy_from_dict(1, policy_p2))
+    for iteration in range(tot_iter):
+        exploitability_performance[iteration] = solver.iterate()
+        print 'iteration', iteration, 'exploitability=', exploitability_performance[iteration]
+    return solver.policy_dicts()
+
+
+def cfr_sequence_form(variant='cfr+', threshold=1e-4):  # exact baseline, converges in seconds
+    solver = SequenceFormCFR(XFP.tree, variant)
+    exploitability = solver.solve(threshold)
+    print variant, 'iterations', solver.iteration, 'exploitability=', exploitability
+    return solver.policy_dicts()
+
+
 # fictitious_play(env, policy_p1, policy_p2)
+# fictitious_play_sequence_form(env, policy_p1, policy_p2)
+# cfr_sequence_form('discounted')
 
 realization_start = XFP.compute_realization(policy_p1, policy_p2)
 realization_end = fictitious_play_realization(env, realization_start)
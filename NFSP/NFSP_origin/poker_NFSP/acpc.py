@@ -0,0 +1,139 @@
+import collections
+
+import numpy as np
+
+# an action request: reply with prefix + ':' + action; state and card are reused by the parser
+MatchState = collections.namedtuple('MatchState', 'prefix state card')
+# the end of a hand: the whole message (without '%') and the score after its last ':'
+Result = collections.namedtuple('Result', 'message score')
+
+RANKS = {r: i for i, r in enumerate('23456789TJQKA')}
+SUITS = {s: i for i, s in enumerate('shdc')}
+
+
+def _trailer_end(data, start):
+    """ end of the betting trailer '<round>.<numActions>,<type><player>...' of the relay that
+        begins at data[start], or -1 while it is incomplete """
+    def number(i):
+        j = i
+        while j < len(data) and 48 <= data[j] <= 57:  # digits
+            j += 1
+        return (int(data[i:j]), j) if j > i else (None, j)
+
+    rounds, i = number(start)
+    if rounds is None:
+        return -1
+    for _ in range(rounds + 1):
+        if i >= len(data) or data[i] != 46:  # '.'
+            return -1
+        actions, i = number(i + 1)
+        if actions is None:
+            return -1
+        i += 3 * actions  # ',' action type, acting player
+        if i > len(data):
+            return -1
+    return i
+
+
+class MessageReader(object):
+    """ Messages of the relay of project_acpc_server/example_player.c over a persistent
+        buffer of a connected socket, returned whole however recv splits them.
+
+        The relay writes two kinds of messages without a trailing newline:
+            results:  <match state>:<value>%
+            requests: <match state>:<its own action>\r\n<round>.<numActions>,<type><player>...
+        so a message ends at a '%' or once the betting trailer after '\r\n' is complete.
+    """
+
+    def __init__(self, sock, bufsize=4096):
+        self.sock = sock
+        self.bufsize = bufsize
+        self.buffer = bytearray()
+
+    def _frame(self):
+        end = self.buffer.find(b'%')
+        separator = self.buffer.find(b'\r\n')
+        if separator >= 0 and (end < 0 or separator < end):
+            return _trailer_end(self.buffer, separator + 2)
+        return end + 1 if end >= 0 else -1
+
+    def read(self):
+        """ next message, None once the peer closed """
+        while True:
+            end = self._frame()
+            if end >= 0:
+                message = self.buffer[:end].decode('utf-8')
+                del self.buffer[:end]
+                return message
+            chunk = self.sock.recv(self.bufsize)
+            if not chunk:
+                return None
+            self.buffer += chunk
+
+    def send(self, message, terminator='\r\n'):
+        self.sock.sendall((message + terminator).encode('utf-8'))
+
+
+class MatchStateParser(object):
+    """ NFSP.getState / NFSP.getCard over the messages of one client, parsed incrementally.
+
+        While a message extends the betting or the cards of the previous one (the same hand),
+        only the new characters are applied to the state and card arrays; otherwise they are
+        cleared and parsed from scratch. The arrays are reused and valid until the next call.
+    """
+
+    def __init__(self, state_shape=(4, 6, 2), card_num=7):
+        self.state = np.zeros(state_shape, np.int32)
+        self.card = np.zeros([card_num], np.int32)
+        self._turn = None
+        self._betting = None
+        self._cards = None
+        self._round = -1  # '.'-segment after the first one, as data.split('.')[1:]
+        self._entry = -1  # ','-segment after the first one of the round
+        self._char = 0  # characters of the current entry seen
+
+    def parse(self, message, turn):
+        """ typed observation of a message of MessageReader; turn is the seat parity of NFSP.getState """
+        if message[-1] == '%':
+            return Result(message[:-1], message[message.rfind(':') + 1:-1])
+        split = message.rfind(':')
+        self._parse_betting(message[split + 4:], turn)
+        prefix = message[:split]
+        self._parse_cards(prefix[prefix.rfind(':') + 1:].replace('|', '').replace('/', ''))
+        return MatchState(prefix, self.state, self.card)
+
+    def _parse_betting(self, data, turn):
+        if turn == self._turn and self._betting is not None and data.startswith(self._betting):
+            start = len(self._betting)
+        else:
+            self.state.fill(0)
+            self._round = self._entry = -1
+            self._char = 0
+            start = 0
+        for ch in data[start:]:
+            if ch == '.':
+                self._round += 1
+                self._entry = -1
+                self._char = 0
+            elif ch == ',':
+                if self._round >= 0:
+                    self._entry += 1
+                    self._char = 0
+            elif self._entry >= 0:
+                if self._char == 0:
+                    self.state[self._round, self._entry, 0] = int(ch)  # action 1:c 2:r 3:f
+                elif self._char == 1:
+                    self.state[self._round, self._entry, 1] = int((ch == '1') == (turn == 0))
+                self._char += 1
+        self._turn = turn
+        self._betting = data
+
+    def _parse_cards(self, cards):
+        if self._cards is not None and cards.startswith(self._cards) and len(self._cards) % 2 == 0:
+            start = len(self._cards)
+        else:
+            self.card.fill(0)
+            start = 0
+        for i in range(start, len(cards) - 1, 2):
+            self.card[i // 2] = SUITS[cards[i + 1]] * 13 + RANKS[cards[i]] + 1
+        self._cards = cards[:len(cards) - len(cards) % 2]
@@ -0,0 +1,97 @@
+import numpy as np
+
+
+class SequenceFormCFR(object):
+    """ Tabular counterfactual regret minimization on a compiled LeducTree.
+
+        Regrets and average strategies are [n_infoset, 2] arrays per player, updated for one
+        player after the other (alternating updates) from the counterfactual values of
+        LeducTree.counterfactual_values. variant selects how iteration t is weighted:
+            'cfr':        plain regrets, uniform average
+            'cfr+':       regrets floored at zero, average weighted by t
+            'linear':     regrets and average weighted by t
+            'discounted': positive / negative regrets discounted by t^alpha / (t^alpha + 1) and
+                          t^beta / (t^beta + 1), average by (t / (t + 1))^gamma
+    """
+
+    variants = ('cfr', 'cfr+', 'linear', 'discounted')
+
+    def __init__(self, tree, variant='cfr+', alpha=1.5, beta=0.0, gamma=2.0):
+        assert variant in self.variants
+        self.tree = tree
+        self.variant = variant
+        self.alpha, self.beta, self.gamma = alpha, beta, gamma
+        self.regret = [np.zeros([tree.n_infoset[p], 2]) for p in range(2)]
+        # average strategies as accumulated realization plans
+        self.average = [np.zeros([tree.root_seq[p] + 1]) for p in range(2)]
+        self.current = [tree.uniform_policy(p) for p in range(2)]
+        self.iteration = 0
+
+    @staticmethod
+    def regret_matching(regret):
+        positive = np.maximum(regret, 0.0)
+        total = positive.sum(axis=1, keepdims=True)
+        return np.where(total > 0.0, positive / np.where(total > 0.0, total, 1.0), 0.5)
+
+    def update(self, player):
+        """ one regret and average strategy update of player against the current opponent """
+        t = self.iteration + 1
+        tree = self.tree
+        opponent_realization = tree.realization_plan(1 - player, self.current[1 - player])
+        q, _ = tree.counterfactual_values(player, self.current[player], opponent_realization)
+        instant = q - (self.current[player] * q).sum(axis=1, keepdims=True)
+        regret = self.regret[player]
+        realization = tree.realization_plan(player, self.current[player])
+        if self.variant == 'cfr':
+            regret += instant
+            self.average[player] += realization
+        elif self.variant == 'cfr+':
+            np.maximum(regret + instant, 0.0, out=regret)
+            self.average[player] += t * realization
+        elif self.variant == 'linear':
+            regret += t * instant
+            self.average[player] += t * realization
+        else:
+            regret += instant
+            regret *= np.where(regret > 0.0, t ** self.alpha / (t ** self.alpha + 1.0),
+                               t ** self.beta / (t ** self.beta + 1.0))
+            self.average[player] += realization
+            self.average[player] *= (t / (t + 1.0)) ** self.gamma
+        self.current[player] = self.regret_matching(regret)
+
+    def iterate(self):
+        self.update(0)
+        self.update(1)
+        self.iteration += 1
+
+    def exploitability(self):
+        """ of the average strategies """
+        realization = [self.tree.realization_plan(p, self.policy(p)) for p in range(2)]
+        _, _, e1 = self.tree.best_response(0, realization[1])
+        _, _, e2 = self.tree.best_response(1, realization[0])
+        return (e1 + e2) / 2.0
+
+    def run(self, iterations, eval_every=1):
+        """ returns the exploitability after every eval_every iterations """
+        exploitability = np.zeros([iterations // eval_every])
+        for i in range(iterations):
+            self.iterate()
+            if (i + 1) % eval_every == 0:
+                exploitability[i // eval_every] = self.exploitability()
+        return exploitability
+
+    def solve(self, threshold=1e-4, max_iterations=100000, eval_every=10):
+        """ iterates until the exploitability is at most threshold, returns it """
+        exploitability = self.exploitability()
+        while exploitability > threshold and self.iteration < max_iterations:
+            for _ in range(eval_every):
+                self.iterate()
+            exploitability = self.exploitability()
+        return exploitability
+
+    def policy(self, player):
+        return self.tree.policy_from_realization(player, self.average[player])
+
+    def policy_dicts(self):
+        """ average strategies in the {infoset key: [pC, pB]} format used by XFP """
+        return self.tree.policy_to_dict(0, self.policy(0)), self.tree.policy_to_dict(1, self.policy(1))
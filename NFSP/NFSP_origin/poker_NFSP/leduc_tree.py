@@ -0,0 +1,280 @@
+import hashlib
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'leduc_cache')
+
+# arrays of a compiled tree as written to the cache; the ones ending in 0 / 1 are per player
+TABLES = ('histories', 'deals', 'terminal', 'player', 'round', 'invest', 'child', 'utility', 'history_vector',
+          'infoset', 'infoset_keys0', 'infoset_keys1', 'infoset_parent0', 'infoset_parent1',
+          'infoset_level0', 'infoset_level1', 'last_seq0', 'last_seq1')
+# bump when the compiled arrays change meaning; part of the cache path with a digest of TABLES
+TABLES_VERSION = 1
+
+
+def cache_key(card_num):
+    digest = hashlib.sha1(' '.join(TABLES).encode('utf-8')).hexdigest()[:8]
+    return 'card_num_%d_v%d_%s' % (card_num, TABLES_VERSION, digest)
+
+
+class LeducTree(object):
+    """ The XFP betting tree compiled into arrays over (deal, history) and sequence-form
+        realization plans.
+
+        histories: every decision state and ending of the betting tree, indexed by int
+        infosets:  per player, keyed like the XFP policy dicts (card + history)
+        sequences: per player, sequence 2 * infoset + action (0 'C', 1 'B'); the extra
+                   last entry of a realization plan is the empty sequence (always 1.0)
+
+        The compiled arrays are kept in self.tables; load shares them between processes as
+        read-only memory maps of a per card_num cache.
+    """
+
+    actions = 'CB'
+
+    def __init__(self, xfp=None, tables=None):
+        """ compiles the tree of an XFP, or wraps the tables of a compiled one """
+        if tables is None:
+            tables = self._compile(xfp)
+        self.tables = tables
+        self.histories = [str(h) for h in tables['histories']]
+        self.history_index = {h: i for i, h in enumerate(self.histories)}
+        self.deals = [str(d) for d in tables['deals']]
+        self.n_history = len(self.histories)
+        self.n_deal = len(self.deals)
+        for name in ('terminal', 'player', 'round', 'invest', 'child', 'utility', 'history_vector', 'infoset'):
+            setattr(self, name, tables[name])
+
+        self.infoset_keys = [[str(k) for k in tables['infoset_keys%d' % p]] for p in range(2)]
+        self.infoset_index = [{k: i for i, k in enumerate(keys)} for keys in self.infoset_keys]
+        self.n_infoset = [len(keys) for keys in self.infoset_keys]
+        self.root_seq = [2 * n for n in self.n_infoset]
+        self.infoset_parent = [tables['infoset_parent%d' % p] for p in range(2)]
+        self.levels = [[np.nonzero(level == lv)[0] for lv in range(level.max() + 1)]
+                       for level in (tables['infoset_level0'], tables['infoset_level1'])]
+        self.last_seq = [tables['last_seq0'], tables['last_seq1']]
+        # number of deals sharing each infoset
+        self.infoset_count = [np.bincount(self.infoset[:, self.player == p].ravel(),
+                                          minlength=self.n_infoset[p]).astype(np.float64) for p in range(2)]
+
+        # offset of the acting player's infosets in [policy_p1; policy_p2]
+        self.infoset_offset = np.where(self.player == 1, self.n_infoset[0], 0)
+        self.terminal_index = np.nonzero(self.terminal)[0]
+        self.chance = 1.0 / self.n_deal
+        self.terminal_seq = [self.last_seq[p][:, self.terminal_index] for p in range(2)]
+        self.terminal_utility = [self.utility[:, self.terminal_index], -self.utility[:, self.terminal_index]]
+
+    @classmethod
+    def load(cls, card_num, build, cache_dir=CACHE_DIR):
+        """ the tree of card_num, memory-mapped read-only from cache_dir; on a cache miss (or a
+            cache of another layout, see cache_key) it is compiled from build() (an XFP) and
+            written there first """
+        path = None if cache_dir is None else os.path.join(cache_dir, cache_key(card_num))
+        if path is None or not os.path.isdir(path):
+            tables = cls._compile(build())
+            if path is None:
+                return cls(tables=tables)
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            staging = tempfile.mkdtemp(dir=cache_dir)
+            for name in TABLES:
+                np.save(os.path.join(staging, name + '.npy'), tables[name])
+            try:
+                os.rename(staging, path)  # atomic, a concurrent writer may have won
+            except OSError:
+                shutil.rmtree(staging)
+        return cls(tables={name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in TABLES})
+
+    def xfp_sets(self):
+        """ ending, invest, player1 / player2 / round1 state sets and possible cards as XFP builds them """
+        ending = {h: [int(v) for v in self.invest[i]] for i, h in enumerate(self.histories) if self.terminal[i]}
+        invest = {h: [int(v) for v in self.invest[i]] for i, h in enumerate(self.histories)}
+        player_states = [set(h for i, h in enumerate(self.histories) if self.player[i] == p) for p in range(2)]
+        round1 = set(h for i, h in enumerate(self.histories) if self.round[i] == 1)
+        return ending, invest, player_states[0], player_states[1], round1, set(self.deals)
+
+    @classmethod
+    def _compile(cls, xfp):
+        """ the tables of the tree of an XFP built by its dfs """
+        self = cls.__new__(cls)
+        player_states = [xfp.player1_states_set, xfp.player2_states_set]
+        self.histories = sorted(set(xfp.ending) | player_states[0] | player_states[1], key=lambda x: (len(x), x))
+        self.history_index = {h: i for i, h in enumerate(self.histories)}
+        self.deals = sorted(xfp.possible_cards)
+        self.n_history = len(self.histories)
+        self.n_deal = len(self.deals)
+
+        self.terminal = np.array([h in xfp.ending for h in self.histories])
+        self.player = np.array([-1 if h in xfp.ending else (0 if h in player_states[0] else 1)
+                                for h in self.histories], np.int32)
+        self.round = np.array([1 if h in xfp.round1_states_set else 2 for h in self.histories], np.int32)
+        self.invest = np.array([xfp.invest[h] for h in self.histories], np.int32)  # before acting
+        self.child = np.full([self.n_history, 2], -1, np.int32)
+        for h, i in self.history_index.items():
+            if not self.terminal[i]:
+                self.child[i] = [self.history_index[h + a] for a in self.actions]
+
+        self.utility = np.zeros([self.n_deal, self.n_history], np.float64)  # player 1, zero sum
+        for d, cards in enumerate(self.deals):
+            for h in xfp.ending:
+                self.utility[d, self.history_index[h]] = xfp.compute_payoff(cards, h)[0]
+
+        # LeducRLEnv.history_string2vector: [player, round, own action count, action] of the betting
+        self.history_vector = np.zeros([self.n_history, 2, 2, 2, 2], np.int32)
+        for h, i in self.history_index.items():
+            count = np.zeros([2, 2], np.int32)
+            for k, a in enumerate(h):
+                j = self.history_index[h[:k]]
+                p, r = self.player[j], self.round[j] - 1
+                self.history_vector[i, p, r, count[p, r], self.actions.index(a)] = 1
+                count[p, r] += 1
+
+        tables = self._compile_infosets()
+        tables.update(histories=np.array(self.histories), deals=np.array(self.deals), terminal=self.terminal,
+                      player=self.player, round=self.round, invest=self.invest, child=self.child,
+                      utility=self.utility, history_vector=self.history_vector, infoset=self.infoset)
+        return tables
+
+    def infoset_key(self, cards, history):
+        i = self.history_index[history]
+        if self.round[i] == 1:
+            card = cards[0] if self.player[i] == 0 else cards[2]
+        else:
+            card = cards[:2] if self.player[i] == 0 else cards[1:]
+        return card + history
+
+    def _compile_infosets(self):
+        root = -1  # empty sequence, replaced by the sentinel index once infosets are numbered
+        parent = [{}, {}]
+        level = [{}, {}]
+        path = {}  # (deal, history) -> (key, last own sequence of both players as (key, action))
+        for d, cards in enumerate(self.deals):
+            stack = [("", (root, root))]
+            while stack:
+                h, last = stack.pop()
+                i = self.history_index[h]
+                if self.terminal[i]:
+                    path[d, i] = (None, last)
+                    continue
+                p = self.player[i]
+                key = self.infoset_key(cards, h)
+                if key in parent[p]:
+                    assert parent[p][key] == last[p]
+                else:
+                    parent[p][key] = last[p]
+                    level[p][key] = 0 if last[p] == root else level[p][last[p][0]] + 1
+                path[d, i] = (key, last)
+                for a in range(2):
+                    nxt = list(last)
+                    nxt[p] = (key, a)
+                    stack.append((h + self.actions[a], tuple(nxt)))
+
+        infoset_keys = [sorted(parent[p], key=lambda k: (level[p][k], len(k), k)) for p in range(2)]
+        infoset_index = [{k: i for i, k in enumerate(keys)} for keys in infoset_keys]
+        root_seq = [2 * len(keys) for keys in infoset_keys]
+
+        def seq(p, s):
+            return root_seq[p] if s == root else 2 * infoset_index[p][s[0]] + s[1]
+
+        self.infoset = np.full([self.n_deal, self.n_history], -1, np.int64)  # of the player to act
+        last_seq = [np.zeros([self.n_deal, self.n_history], np.int64) for _ in range(2)]
+        for (d, i), (key, last) in path.items():
+            if key is not None:
+                self.infoset[d, i] = infoset_index[self.player[i]][key]
+            for p in range(2):
+                last_seq[p][d, i] = seq(p, last[p])
+
+        tables = {}
+        for p in range(2):
+            tables['infoset_keys%d' % p] = np.array(infoset_keys[p])
+            tables['infoset_parent%d' % p] = np.array([seq(p, parent[p][k]) for k in infoset_keys[p]], np.int64)
+            tables['infoset_level%d' % p] = np.array([level[p][k] for k in infoset_keys[p]], np.int64)
+            tables['last_seq%d' % p] = last_seq[p]
+        return tables
+
+    def uniform_policy(self, player):
+        return np.full([self.n_infoset[player], 2], 0.5)
+
+    def constant_policy(self, player, prob):
+        return np.tile(np.asarray(prob, np.float64), [self.n_infoset[player], 1])
+
+    def policy_from_dict(self, player, policy):
+        """ policy maps infoset keys to [pC, pB] or to a realization entry {'C': [v, n], 'B': [v, n]} """
+        pi = np.zeros([self.n_infoset[player], 2])
+        for i, key in enumerate(self.infoset_keys[player]):
+            prob = policy[key]
+            if type(prob) == dict:  # this is a realization
+                v1, v2 = prob['C'][0], prob['B'][0]
+                prob = [v1 / (v1 + v2), v2 / (v1 + v2)] if v1 + v2 > 0.0 else [0.5, 0.5]
+            pi[i] = prob[0], prob[1]
+        return pi
+
+    def policy_to_dict(self, player, pi):
+        return {key: [pi[i, 0], pi[i, 1]] for i, key in enumerate(self.infoset_keys[player])}
+
+    def realization_plan(self, player, pi):
+        x = np.zeros([self.root_seq[player] + 1])
+        x[-1] = 1.0
+        parent = self.infoset_parent[player]
+        for infosets in self.levels[player]:
+            reach = x[parent[infosets]]
+            x[2 * infosets] = reach * pi[infosets, 0]
+            x[2 * infosets + 1] = reach * pi[infosets, 1]
+        return x
+
+    def policy_from_realization(self, player, x):
+        seq = x[:-1].reshape([-1, 2])
+        total = seq.sum(axis=1, keepdims=True)
+        safe = np.where(total > 0.0, total, 1.0)
+        return np.where(total > 0.0, seq / safe, 0.5)
+
+    def _terminal_values(self, player, opponent_realization):
+        """ per sequence of player, the payoff of the endings it leads to directly, weighted by
+            chance and the opponent realization """
+        opponent = 1 - player
+        weight = self.chance * opponent_realization[self.terminal_seq[opponent]] * self.terminal_utility[player]
+        return np.bincount(self.terminal_seq[player].ravel(), weights=weight.ravel(),
+                           minlength=self.root_seq[player] + 1)
+
+    def best_response(self, player, opponent_realization):
+        """ returns (greedy policy, action values per infoset, expected payoff of the best response) """
+        v = self._terminal_values(player, opponent_realization)
+        parent = self.infoset_parent[player]
+        for infosets in reversed(self.levels[player]):
+            np.add.at(v, parent[infosets], np.maximum(v[2 * infosets], v[2 * infosets + 1]))
+        q = v[:-1].reshape([-1, 2])
+        br = np.zeros_like(q)
+        choose_c = q[:, 0] > q[:, 1]
+        br[choose_c, 0] = 1.0
+        br[~choose_c, 1] = 1.0
+        return br, q, v[-1]
+
+    def counterfactual_values(self, player, pi, opponent_realization):
+        """ returns (counterfactual action values per infoset, expected payoff) of policy pi of
+            player against the opponent realization """
+        v = self._terminal_values(player, opponent_realization)
+        parent = self.infoset_parent[player]
+        for infosets in reversed(self.levels[player]):
+            np.add.at(v, parent[infosets], pi[infosets, 0] * v[2 * infosets] + pi[infosets, 1] * v[2 * infosets + 1])
+        return v[:-1].reshape([-1, 2]), v[-1]
+
+    def expected_payoff(self, realization_p1, realization_p2):
+        u = self.chance * np.sum(realization_p1[self.terminal_seq[0]] * realization_p2[self.terminal_seq[1]] *
+                                 self.terminal_utility[0])
+        return np.array([u, -u])
+
+    def play(self, policy_p1, policy_p2, games, rng=np.random):
+        """ plays games hands in lockstep, returns player 1 payoff of every hand """
+        prob_c = np.concatenate([policy_p1[:, 0], policy_p2[:, 0]])
+        deal = rng.randint(self.n_deal, size=games)
+        history = np.full([games], self.history_index[""], np.int64)
+        live = np.arange(games)
+        while live.size > 0:
+            h = history[live]
+            p_c = prob_c[self.infoset[deal[live], h] + self.infoset_offset[h]]
+            history[live] = self.child[h, (rng.random_sample(live.size) >= p_c).astype(np.int64)]
+            live = live[~self.terminal[history[live]]]
+        return self.utility[deal, history]
@@ -1,16 +1,6 @@
-import subprocess
+from sweep import sweep
 
-template = 'python NFSP_test.py --seed={}'
-
-args = [i for i in range(50)]
-
-processes = []
-
-for arg in args:
-    print("arg",arg)
-    command = template.format(arg)
-    print(command)
-    process = subprocess.Popen(command, shell=True)
-    processes.append(process)
-
-output = [p.wait() for p in processes]
+# seeds 0 .. 49 on a process pool sized to the machine instead of 50 concurrent NFSP_test.py shells;
+# see sweep.py for the command line
+if __name__ == '__main__':
+    sweep(range(50))
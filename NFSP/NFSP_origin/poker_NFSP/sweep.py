@@ -0,0 +1,90 @@
+import argparse
+import multiprocessing
+import time
+
+import numpy as np
+
+from XFP import XFP, LeducRLEnv, LeducBatchRLEnv
+from xfp_engine import SequenceFormXFP
+
+# the flags of NFSP_test.py
+DEFAULT_FLAGS = {'card_num': 7, 'batch': 128, 'lr_sl': 0.005, 'lr_rl': 0.1, 'anticipatory': 1.0, 'epsilon': 0.06,
+                 'train_frequency': 128, 'train_start': 1024, 'rl_len': 200000, 'sl_len': 2000000, 'refit': 300}
+
+
+def run_seed(seed, flags, hands, eval_every, local_batch):
+    """ trains NFSP on local lockstep self-play for one seed, returns (hands played, exploitability)
+        of the mixed policies every eval_every hands """
+    from NFSP import NFSP  # TensorFlow is imported by the workers only, once per process
+    flags = argparse.Namespace(seed=seed, **flags)
+    agent = NFSP(flags)
+    env = LeducBatchRLEnv(local_batch, card_num=flags.card_num, seed=seed)
+    played, next_eval = 0, eval_every
+    curve = []
+    while played < hands:
+        agent.play_batch(env)
+        played += local_batch
+        if played >= next_eval or played >= hands:
+            policy_p1, policy_p2 = agent.compute_tree_policy(env)
+            curve.append((played, SequenceFormXFP(env.tree, policy_p1, policy_p2).exploitability()))
+            next_eval += eval_every
+    agent.sess.__exit__(None, None, None)
+    return np.array(curve).reshape([-1, 2])
+
+
+def _run_seeds(job):
+    """ pool task: the seeds of one worker, run one after another """
+    seeds, flags, hands, eval_every, local_batch = job
+    results = []
+    for seed in seeds:
+        start = time.time()
+        curve = run_seed(seed, flags, hands, eval_every, local_batch)
+        print('seed %d: %d hands in %.0fs, exploitability %.4f' % (seed, hands, time.time() - start, curve[-1, 1]))
+        results.append((seed, curve))
+    return results
+
+
+def sweep(seeds, hands=1000000, eval_every=10000, local_batch=128, processes=None, out='log/sweep.npz', **flags):
+    """ runs seeds on a pool of at most cpu_count() workers and writes the exploitability curves
+        of all of them to out as the columns seed, hands, exploitability
+
+        The XFP tree and the LeducRLEnv history vectors are built once here and inherited by
+        the forked workers; each worker trains its share of the seeds sequentially.
+    """
+    seeds = list(seeds)
+    flags = dict(DEFAULT_FLAGS, **flags)
+    XFP(card_num=flags['card_num'])
+    LeducRLEnv(card_num=flags['card_num'])
+    processes = min(processes or multiprocessing.cpu_count(), len(seeds))
+    jobs = [(seeds[i::processes], flags, hands, eval_every, local_batch) for i in range(processes)]
+
+    columns = {'seed': [], 'hands': [], 'exploitability': []}
+    pool = multiprocessing.get_context('fork').Pool(processes)
+    try:
+        for results in pool.imap_unordered(_run_seeds, jobs):
+            for seed, curve in results:
+                columns['seed'].append(np.full([len(curve)], seed, np.int64))
+                columns['hands'].append(curve[:, 0].astype(np.int64))
+                columns['exploitability'].append(curve[:, 1])
+    finally:
+        pool.close()
+        pool.join()
+    columns = {key: np.concatenate(value) for key, value in columns.items()}
+    order = np.lexsort([columns['hands'], columns['seed']])
+    columns = {key: value[order] for key, value in columns.items()}
+    np.savez(out, **columns)
+    return columns
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seeds', type=int, default=50, help='runs seeds 0 .. seeds - 1')
+    parser.add_argument('--hands', type=int, default=1000000, help='hands of self-play per seed')
+    parser.add_argument('--eval_every', type=int, default=10000, help='hands between exploitability evaluations')
+    parser.add_argument('--local_batch', type=int, default=128, help='hands per lockstep batch')
+    parser.add_argument('--processes', type=int, default=None, help='workers, default cpu count')
+    parser.add_argument('--out', default='log/sweep.npz', help='columnar results file')
+    for name, value in DEFAULT_FLAGS.items():
+        parser.add_argument('--' + name, type=type(value), default=value)
+    args = vars(parser.parse_args())
+    sweep(range(args.pop('seeds')), **args)
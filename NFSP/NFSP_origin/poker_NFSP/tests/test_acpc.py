@@ -0,0 +1,94 @@
+import numpy as np
+
+from acpc import MessageReader, MatchStateParser, MatchState, Result
+
+# as written by project_acpc_server/example_player.c: the match state, ':', the relay's own
+# action, '\r\n' and the betting as <round>.<numActions>,<type><player>...; results end in '%'
+REQUEST_PREFLOP = b'MATCHSTATE:0:3::Ks|:c\r\n0.0'
+REQUEST_FLOP = b'MATCHSTATE:0:3:cc/r:Ks|/Qh:f\r\n1.2,10,11.1,21'
+RESULT = b'MATCHSTATE:0:3:cc/rc:Ks|Qh/Qh:-3.000000%'
+
+
+class FakeSocket(object):
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.sent = []
+
+    def recv(self, bufsize):
+        return self.chunks.pop(0) if self.chunks else b''
+
+    def sendall(self, data):
+        self.sent.append(data)
+
+
+def read_all(chunks):
+    reader = MessageReader(FakeSocket(chunks))
+    messages = []
+    while True:
+        message = reader.read()
+        if message is None:
+            return messages
+        messages.append(message)
+
+
+def test_reader_frames_relay_messages():
+    messages = [REQUEST_PREFLOP, REQUEST_FLOP, RESULT]
+    expected = [m.decode('utf-8') for m in messages]
+    assert read_all(messages) == expected
+    # split anywhere, including inside '\r\n' and the betting trailer
+    stream = b''.join(messages)
+    for cut in range(1, len(stream)):
+        assert read_all([stream[:cut], stream[cut:]]) == expected
+    assert read_all([bytes([b]) for b in stream]) == expected
+
+
+def test_reader_waits_for_complete_trailer():
+    reader = MessageReader(FakeSocket([b'MATCHSTATE:0:3:cc/r:Ks|/Qh:f\r\n1.2,10,11.1', b'']))
+    assert reader.read() is None  # the last action of the trailer never arrived
+
+
+def test_reader_send():
+    sock = FakeSocket([])
+    reader = MessageReader(sock)
+    reader.send('MATCHSTATE:0:3::Ks|:r')
+    reader.send(RESULT.decode('utf-8'), terminator='')
+    assert sock.sent == [b'MATCHSTATE:0:3::Ks|:r\r\n', RESULT]
+
+
+def test_parse_result():
+    result = MatchStateParser().parse(RESULT.decode('utf-8'), 0)
+    assert isinstance(result, Result)
+    assert result.score == '-3.000000'
+
+
+def test_parse_requests():
+    parser = MatchStateParser()
+    state = parser.parse(REQUEST_PREFLOP.decode('utf-8'), 0)
+    assert isinstance(state, MatchState)
+    assert state.prefix == 'MATCHSTATE:0:3::Ks|'
+    assert not state.state.any()
+    assert list(state.card) == [12, 0, 0, 0, 0, 0, 0]  # K of spades
+
+    state = parser.parse(REQUEST_FLOP.decode('utf-8'), 0)
+    assert state.prefix == 'MATCHSTATE:0:3:cc/r:Ks|/Qh'
+    expected = np.zeros([4, 6, 2], np.int32)
+    expected[0, 0] = [1, 0]
+    expected[0, 1] = [1, 1]  # turn 0 marks player '1' as own, as NFSP.getState
+    expected[1, 0] = [2, 1]
+    np.testing.assert_array_equal(state.state, expected)
+    assert list(state.card) == [12, 24, 0, 0, 0, 0, 0]  # Q of hearts on the board
+
+
+def test_incremental_parse_matches_fresh_parse():
+    messages = [b'MATCHSTATE:1:4:r:|Qh:c\r\n0.1,20',
+                b'MATCHSTATE:1:4:rrc/:|Qh/Kd:c\r\n1.3,20,21,10.0',
+                b'MATCHSTATE:1:4:rrc/cr:|Qh/Kd:r\r\n1.3,20,21,10.2,10,21',
+                b'MATCHSTATE:1:5:c:|Js:r\r\n0.1,10']
+    incremental = MatchStateParser()
+    for message in messages:
+        message = message.decode('utf-8')
+        state = incremental.parse(message, 1)
+        fresh = MatchStateParser().parse(message, 1)
+        np.testing.assert_array_equal(state.state, fresh.state)
+        np.testing.assert_array_equal(state.card, fresh.card)
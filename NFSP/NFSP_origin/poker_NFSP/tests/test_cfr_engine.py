@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from XFP import XFP
+from cfr_engine import SequenceFormCFR
+from xfp_engine import SequenceFormXFP
+
+
+@pytest.fixture
+def tree():
+    XFP(card_num=7, cache_dir=None)
+    return XFP.tree
+
+
+def test_counterfactual_values_give_expected_payoff(tree):
+    rng = np.random.RandomState(0)
+    policy = [rng.dirichlet([1.0, 1.0], size=tree.n_infoset[p]) for p in range(2)]
+    realization = [tree.realization_plan(p, policy[p]) for p in range(2)]
+    payoff = tree.expected_payoff(realization[0], realization[1])
+    for p in range(2):
+        q, value = tree.counterfactual_values(p, policy[p], realization[1 - p])
+        assert np.isclose(value, payoff[p])
+
+
+@pytest.mark.parametrize('variant, iterations', [('cfr+', 1000), ('discounted', 500)])
+def test_converges_below_1e4(tree, variant, iterations):
+    solver = SequenceFormCFR(tree, variant)
+    assert solver.solve(1e-4, max_iterations=iterations) <= 1e-4
+    assert solver.iteration <= iterations
+
+
+@pytest.mark.parametrize('variant', SequenceFormCFR.variants)
+def test_exploitability_decreases(tree, variant):
+    solver = SequenceFormCFR(tree, variant)
+    exploitability = solver.run(200, eval_every=50)
+    assert exploitability[-1] < exploitability[0] < SequenceFormCFR(tree, variant).exploitability()
+
+
+def test_policy_dicts_round_trip(tree):
+    solver = SequenceFormCFR(tree, 'cfr+')
+    solver.run(50, eval_every=50)
+    policy_p1, policy_p2 = solver.policy_dicts()
+    np.testing.assert_allclose(tree.policy_from_dict(0, policy_p1), solver.policy(0))
+    np.testing.assert_allclose(tree.policy_from_dict(1, policy_p2), solver.policy(1))
+    assert np.isclose(SequenceFormXFP(tree, solver.policy(0), solver.policy(1)).exploitability(),
+                      solver.exploitability())
+
+
+def test_xfp_exploitability_decreases(tree):
+    solver = SequenceFormXFP(tree)
+    exploitability = solver.run(100)
+    assert exploitability[-1] < 0.2 * exploitability[0]  # XFP converges at about 1 / sqrt(t)
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from XFP import XFP, LeducBatchRLEnv
+
+
+@pytest.mark.parametrize('card_num', [6, 7])
+def test_infosets_have_one_observation(card_num):
+    XFP(card_num=card_num, cache_dir=None)
+    env = LeducBatchRLEnv(1, card_num=card_num, seed=0)
+    tree = env.tree
+    for player in range(2):
+        observations = {}
+        deal, history = np.nonzero((tree.player == player)[None, :] & (tree.infoset >= 0))
+        for d, h in zip(deal, history):
+            observation = (env.state_table[h, player].tobytes(),
+                           env.card_table[d, player, tree.round[h] - 1].tobytes())
+            observations.setdefault(tree.infoset[d, h], set()).add(observation)
+        assert len(observations) == tree.n_infoset[player]
+        assert all(len(seen) == 1 for seen in observations.values())
+
+
+def test_hands_end_with_tree_payoffs():
+    XFP(card_num=7, cache_dir=None)
+    env = LeducBatchRLEnv(64, card_num=7, seed=0)
+    rng = np.random.RandomState(0)
+    ob = env.reset()
+    while not env.done.all():
+        ob = env.act(rng.randint(3, size=env.batch_size))
+    np.testing.assert_array_equal(ob['turn'], -1)
+    np.testing.assert_array_equal(ob['payoff'][:, 0], env.tree.utility[env.deal, env.history])
+    np.testing.assert_array_equal(ob['payoff'][:, 0], -ob['payoff'][:, 1])
+
+
+def test_tree_policy_of_acpc_actions():
+    XFP(card_num=7, cache_dir=None)
+    env = LeducBatchRLEnv(1, card_num=7, seed=0)
+    for player in range(2):
+        state, card, facing = env.infoset_observations(player)
+        assert len(state) == len(card) == env.tree.n_infoset[player]
+        always_call = np.zeros([len(state), 3])
+        always_call[:, 0] = 1.0
+        # calling a bet is the tree's 'B', checking its 'C'
+        np.testing.assert_array_equal(env.tree_policy(always_call, facing)[:, 1], facing)
@@ -0,0 +1,93 @@
+import os
+
+import numpy as np
+import pytest
+
+import leduc_tree
+from XFP import XFP
+
+
+def test_cache_round_trip(tmpdir):
+    cache_dir = str(tmpdir)
+    XFP(card_num=7, cache_dir=None)
+    built = XFP.tree
+    XFP(card_num=7, cache_dir=cache_dir)  # compiles and writes
+    XFP(card_num=7, cache_dir=cache_dir)  # memory-maps
+    loaded = XFP.tree
+    assert os.listdir(cache_dir) == [leduc_tree.cache_key(7)]
+    for name in leduc_tree.TABLES:
+        assert isinstance(loaded.tables[name], np.memmap)
+        assert not loaded.tables[name].flags.writeable
+        np.testing.assert_array_equal(loaded.tables[name], built.tables[name])
+    assert loaded.infoset_keys == built.infoset_keys
+    assert loaded.histories == built.histories
+
+
+def test_cache_of_another_version_is_rebuilt(tmpdir, monkeypatch):
+    cache_dir = str(tmpdir)
+    XFP(card_num=7, cache_dir=cache_dir)
+    monkeypatch.setattr(leduc_tree, 'TABLES_VERSION', leduc_tree.TABLES_VERSION + 1)
+    built = []
+
+    def build():
+        built.append(1)
+        return XFP(card_num=7, cache_dir=None).build_tree(7)
+
+    leduc_tree.LeducTree.load(7, build, cache_dir)
+    assert built == [1]
+    assert len(os.listdir(cache_dir)) == 2
+
+
+def brute_force_best_response(tree, player, opponent_policy):
+    """ best response value by walking every (deal, history) with dicts, deepest infosets first """
+    opponent_row = {key: i for i, key in enumerate(tree.infoset_keys[1 - player])}
+    br = {}
+
+    def value(cards, history):
+        i = tree.history_index[history]
+        if tree.terminal[i]:
+            u = tree.utility[tree.deals.index(cards), i]
+            return u if player == 0 else -u
+        key = tree.infoset_key(cards, history)
+        if tree.player[i] == player:
+            return value(cards, history + br[key])
+        p_c = opponent_policy[opponent_row[key], 0]
+        return p_c * value(cards, history + 'C') + (1.0 - p_c) * value(cards, history + 'B')
+
+    def opponent_reach(cards, history):
+        reach = 1.0
+        for k, a in enumerate(history):
+            i = tree.history_index[history[:k]]
+            if tree.player[i] != player:
+                reach *= opponent_policy[opponent_row[tree.infoset_key(cards, history[:k])], 'CB'.index(a)]
+        return reach
+
+    members = {}
+    for cards in tree.deals:
+        for i, history in enumerate(tree.histories):
+            if tree.player[i] == player:
+                members.setdefault(tree.infoset_key(cards, history), []).append((cards, history))
+    for key in sorted(members, key=lambda k: -len(k.lstrip('0123456789'))):
+        q = [sum(opponent_reach(c, h) * value(c, h + a) for c, h in members[key]) for a in 'CB']
+        br[key] = 'C' if q[0] > q[1] else 'B'
+    return tree.chance * sum(value(cards, '') for cards in tree.deals), br
+
+
+@pytest.mark.parametrize('card_num', [6, 7])
+def test_best_response_matches_brute_force(card_num):
+    XFP(card_num=card_num, cache_dir=None)
+    tree = XFP.tree
+    rng = np.random.RandomState(card_num)
+    for player in range(2):
+        opponent_policy = rng.dirichlet([1.0, 1.0], size=tree.n_infoset[1 - player])
+        expected, expected_br = brute_force_best_response(tree, player, opponent_policy)
+        br, _, value = tree.best_response(player, tree.realization_plan(1 - player, opponent_policy))
+        assert np.isclose(value, expected)
+        assert tree.policy_to_dict(player, br) == {k: [1.0, 0.0] if a == 'C' else [0.0, 1.0]
+                                                   for k, a in expected_br.items()}
+        # no pure strategy does better
+        opponent_realization = tree.realization_plan(1 - player, opponent_policy)
+        for _ in range(20):
+            pure = np.eye(2)[rng.randint(2, size=tree.n_infoset[player])]
+            _, payoff = tree.counterfactual_values(player, pure, opponent_realization)
+            assert payoff <= value + 1e-12
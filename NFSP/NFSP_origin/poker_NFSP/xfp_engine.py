@@ -0,0 +1,50 @@
+import numpy as np
+
+
+class SequenceFormXFP(object):
+    """ Full-width extensive-form fictitious play on a compiled LeducTree.
+
+        Both average strategies are kept as realization plans, so one iteration is two
+        best responses, two realization plans and a convex mix, all over flat arrays.
+    """
+
+    def __init__(self, tree, policy_p1=None, policy_p2=None):
+        self.tree = tree
+        policy = [tree.uniform_policy(0) if policy_p1 is None else policy_p1,
+                  tree.uniform_policy(1) if policy_p2 is None else policy_p2]
+        self.realization = [tree.realization_plan(p, policy[p]) for p in range(2)]
+        self.iteration = 0
+
+    def best_responses(self):
+        br1, _, e1 = self.tree.best_response(0, self.realization[1])
+        br2, _, e2 = self.tree.best_response(1, self.realization[0])
+        return [br1, br2], np.array([e1, e2])
+
+    def exploitability(self):
+        _, e = self.best_responses()
+        return (e[0] + e[1]) / 2.0
+
+    def iterate(self, ratio=None):
+        """ one XFP step with mixing ratio (default 1 / (t + 2)); returns the exploitability
+            of the average strategies before the step """
+        br, e = self.best_responses()
+        if ratio is None:
+            ratio = 1.0 / (self.iteration + 2)
+        for p in range(2):
+            self.realization[p] *= 1.0 - ratio
+            self.realization[p] += ratio * self.tree.realization_plan(p, br[p])
+        self.iteration += 1
+        return (e[0] + e[1]) / 2.0
+
+    def run(self, iterations, ratio=None):
+        exploitability = np.zeros([iterations])
+        for i in range(iterations):
+            exploitability[i] = self.iterate(ratio)
+        return exploitability
+
+    def policy(self, player):
+        return self.tree.policy_from_realization(player, self.realization[player])
+
+    def policy_dicts(self):
+        """ average strategies in the {infoset key: [pC, pB]} format used by XFP """
+        return self.tree.policy_to_dict(0, self.policy(0)), self.tree.policy_to_dict(1, self.policy(1))
@@ -16,6 +16,12 @@ class ReplayBuffer:
         frame_buffer {int} -- number of frames per observation (default: {1})
         n_step_size {int} -- number of steps to accumulate rewards (default: {1})
         gamma {float} -- discount factor per reward step (default: {0.9})
+
+    Transitions are written into preallocated typed columns at a cursor, the
+    columns double in size when full. n-step rewards and estimate weights are
+    computed once per finished episode, so `vectorize` only hands out views.
+    Stacked frames are gathered at indexing time, clamped at the episode start
+    of each sampled row.
     """
 
     def __init__(self,
@@ -24,33 +30,79 @@ class ReplayBuffer:
                  n_step_size=1,
                  gamma=0.9):
         self.capacity = capacity
-        self.obs = []
-        self.vec_obs = np.array([])
-        self.next_obs = []
-        self.vec_next_obs = np.array([])
-        self.actions = []
-        self.vec_actions = np.array([])
-        self.rewards = []
-        self.vec_rewards = np.array([])
-        self.done = []
-        self.vec_done = np.array([])
-        self.legal_action_masks = []
-        self.vec_legal_action_masks = np.array([])
-
-        self.n_step = np.array([])
-        self.est_rew_weights = np.array([])
+        self._size = 0
+        # rows before _finished belong to finished episodes and have n-step rewards
+        self._finished = 0
+        # first row of the episode that is being recorded
+        self._epi_begin = 0
+        self._obs = None
+        self._next_obs = None
+        self._actions = None
+        self._rewards = None
+        self._done = None
+        self._legal_action_masks = None
+        self._n_step = None
+        # n_step as assigned by the learner (e.g. reward weighted), dropped by vectorize
+        self._n_step_assigned = None
+        self._est_rew_weights = None
+        self._epi_start = None
 
         self.idcs = np.array([])
-        self.obs_idcs = np.array([])
 
         self.frame_buffer = frame_buffer
         self.n_step_size = n_step_size
         self.gamma = gamma
+        self._n_step_params = (n_step_size, gamma)
+
+    @property
+    def obs(self):
+        return self._obs[:self._size] if self._size else np.array([])
+
+    @property
+    def next_obs(self):
+        return self._next_obs[:self._size] if self._size else np.array([])
+
+    @property
+    def actions(self):
+        return self._actions[:self._size] if self._size else np.array([])
+
+    @property
+    def rewards(self):
+        return self._rewards[:self._size] if self._size else np.array([])
+
+    @property
+    def done(self):
+        return self._done[:self._size] if self._size else np.array([])
+
+    @property
+    def legal_action_masks(self):
+        return self._legal_action_masks[:self._size] if self._size else np.array([])
+
+    vec_obs = obs
+    vec_next_obs = next_obs
+    vec_actions = actions
+    vec_rewards = rewards
+    vec_done = done
+    vec_legal_action_masks = legal_action_masks
+
+    @property
+    def n_step(self):
+        if self._n_step_assigned is not None:
+            return self._n_step_assigned
+        return self._n_step[:self._finished] if self._finished else np.array([], np.float32)
+
+    @n_step.setter
+    def n_step(self, value):
+        self._n_step_assigned = np.asarray(value, np.float32)
+
+    @property
+    def est_rew_weights(self):
+        return self._est_rew_weights[:self._finished] if self._finished else np.array([], np.float32)
 
     def __getitem__(self, idcs):
 
         idcs = self.idcs[idcs]
-        obs_idcs = self.obs_idcs[idcs]
+        obs_idcs = self.__obs_idcs(idcs)
         # print('In getitem: {}'.format(idcs))
         return (self.vec_obs[obs_idcs],
                 self.vec_next_obs[obs_idcs],
@@ -62,86 +114,99 @@ class ReplayBuffer:
     def __add__(self, other):
         if not isinstance(other, ReplayBuffer):
             raise TypeError('only two replay buffers can be added together')
-
-        self.obs += other.obs
-        self.next_obs += other.next_obs
-        self.actions += other.actions
-        self.rewards += other.rewards
-        self.done += other.done
-        # self.idcs += other.idcs
-        # self.vec_obs = np.stack(self.obs).astype(np.float32)
-        # print('{}, {}'.format(len(self.vec_obs), len(self.obs)))
-        # print('In Adding: {}'.format(len(self.idcs)))
+        if other._size == 0:
+            return self
+        if self._obs is None:
+            self.__allocate(other._obs[0], other._legal_action_masks[0])
+        start, stop = self._size, self._size + other._size
+        self.__reserve(stop)
+        self._obs[start:stop] = other.obs
+        self._next_obs[start:stop] = other.next_obs
+        self._actions[start:stop] = other.actions
+        self._rewards[start:stop] = other.rewards
+        self._done[start:stop] = other.done
+        # the first episode of other continues the episode recorded here
+        self._epi_start[start:stop] = np.where(other._epi_start[:other._size] == 0, self._epi_begin,
+                                               other._epi_start[:other._size] + start)
+        if other._epi_begin:
+            self._epi_begin = other._epi_begin + start
+        self._legal_action_masks[start:stop] = other.legal_action_masks
+        self._size = stop
+        self.__finish_episodes()
         return self
 
     def __len__(self):
         if (len(self.idcs) == 0):
-            return len(self.obs)
+            return self._size
         else:
             return len(self.idcs)
 
-    def __obs_idcs(self):
-
-        # init index array
+    def __allocate(self, obs, legal_action_mask):
+        rows = max(self.capacity, 1)
+        self._obs = np.zeros((rows,) + np.shape(obs), np.float32)
+        self._next_obs = np.zeros((rows,) + np.shape(obs), np.float32)
+        self._actions = np.zeros(rows, np.int64)
+        self._rewards = np.zeros(rows, np.float32)
+        self._done = np.zeros(rows, np.int64)
+        self._legal_action_masks = np.zeros((rows,) + np.shape(legal_action_mask), np.int64)
+        self._n_step = np.zeros(rows, np.float32)
+        self._est_rew_weights = np.zeros(rows, np.float32)
+        self._epi_start = np.zeros(rows, np.int64)
+
+    def __reserve(self, rows):
+        if rows <= self._obs.shape[0]:
+            return
+        new_rows = self._obs.shape[0]
+        while new_rows < rows:
+            new_rows *= 2
+
+        def grow(column):
+            grown = np.zeros((new_rows,) + column.shape[1:], column.dtype)
+            grown[:self._size] = column[:self._size]
+            return grown
+
+        self._obs = grow(self._obs)
+        self._next_obs = grow(self._next_obs)
+        self._actions = grow(self._actions)
+        self._rewards = grow(self._rewards)
+        self._done = grow(self._done)
+        self._legal_action_masks = grow(self._legal_action_masks)
+        self._n_step = grow(self._n_step)
+        self._est_rew_weights = grow(self._est_rew_weights)
+        self._epi_start = grow(self._epi_start)
+
+    def __obs_idcs(self, idcs):
+        """Indices of the stacked frames of `idcs`, oldest first, clamped at the episode start"""
         if self.frame_buffer > 1:
-            # episode start indices
-            epi_start_idcs = np.insert(np.nonzero(
-                self.vec_done)[0][:-1] + 1, 0, 0)
-            idcs = np.repeat(np.arange(len(self.rewards)), self.frame_buffer)
-            idcs = idcs.reshape(len(self.rewards), self.frame_buffer)
-            # print('In obs_idcs: {}'.format(idcs.shape))
-            # subtract frame buffer length
-            idx_sub = np.arange(self.frame_buffer - 1, -1, -1)
-            idx_sub = np.tile(idx_sub, len(
-                self)).reshape(-1, self.frame_buffer)
-            idcs = idcs - idx_sub
-            # print('In obs_idcs: {}, {}'.format(idx_sub.shape, idcs.shape))
-            # compute frame buffer overlap insert and corresponding idcs
-            insert = np.cumsum(
-                np.ones((self.frame_buffer - 1, self.frame_buffer)), 1).astype(int)
-            # add consecutive larger number to each row
-            insert = (insert.T + np.arange(self.frame_buffer - 1)).T
-            # subtract frame buffer and clip to zero
-            insert = np.clip(insert - self.frame_buffer, 0, None)
-            # repeat for number of episodes
-            insert = np.tile(insert.T, epi_start_idcs.shape[0]).T
-            # add episode index to start insert
-            rep_epi_start = np.repeat(epi_start_idcs, self.frame_buffer - 1)
-            insert = (insert.T + rep_epi_start).T
-
-            # add frame buffer range onto insert idcs
-            insert_idcs = rep_epi_start + np.tile(np.arange(self.frame_buffer - 1),
-                                                  epi_start_idcs.shape[0])
-
-            # insert frame buffer overlap at indices
-            idcs[insert_idcs] = insert
-            self.obs_idcs = idcs
-            # self.idcs = idcs
-            # print('In obs_idcs: {}'.format(self.obs_idcs.shape))
-        else:
-            self.obs_idcs = np.arange(len(self.rewards))
-
-    def __n_step_reward(self):
-        # print('In n_step_reward')
-        # split trajactories
-        rewards = self.vec_rewards
-        idcs = np.nonzero(self.vec_done)[0] + 1
-        traj_rewards = np.split(rewards, idcs)[:-1]
-        # compute n step discount array
+            frames = idcs[..., None] - np.arange(self.frame_buffer - 1, -1, -1)
+            return np.maximum(frames, self._epi_start[idcs][..., None])
+        return idcs
+
+    def __finish_episodes(self):
+        """Computes n-step rewards and estimate weights of episodes finished since the last call"""
+        done = np.nonzero(self._done[self._finished:self._size])[0]
+        if done.shape[0] == 0:
+            return
+        start, stop = self._finished, self._finished + done[-1] + 1
+        self._n_step[start:stop], self._est_rew_weights[start:stop] = self.__n_step_reward(
+            self._rewards[start:stop], self._done[start:stop])
+        self._finished = stop
+
+    def __n_step_reward(self, rewards, done):
+        """n-step rewards sum_k gamma^k * r[t + k] for k < n_step_size, cut at the episode end,
+        accumulated as one shifted add per window offset; every trajectory is finished"""
+        n_rows = rewards.shape[0]
+        epi_ends = np.nonzero(done)[0] + 1
+        # number of steps from each row to the end of its episode (1 on the done row)
+        steps_left = np.repeat(epi_ends, np.diff(epi_ends, prepend=0)) - np.arange(n_rows)
         n_step_discount = np.power(
             np.full(self.n_step_size, self.gamma), np.arange(self.n_step_size))
-        # compute n step rewards
-        n_step = np.array([np.sum(trajectory[step_idx:step_idx + self.n_step_size] *
-                                  n_step_discount[:trajectory.shape[0] - step_idx])
-                           for trajectory in traj_rewards for step_idx in range(len(trajectory))])
-        # create array of ones for all trajectories, make last n_step_size entries 0
-        est_rew_weights = np.concatenate([
-            np.concatenate((np.ones(max(0, trajectory.shape[0] - self.n_step_size)),
-                            np.zeros(min(self.n_step_size, trajectory.shape[0]))))
-            for trajectory in traj_rewards])
-        # print("In _n_step: {}".format(n_step.shape))
-        self.n_step = n_step.astype(np.float32)
-        self.est_rew_weights = est_rew_weights.astype(np.float32)
+        n_step = rewards * n_step_discount[0]
+        for k in range(1, min(self.n_step_size, n_rows)):
+            n_step[:-k] += np.where(steps_left[:-k] > k, rewards[k:] * n_step_discount[k], 0.0)
+        # estimate weights are 1 where a state n_step_size steps ahead exists in the episode
+        est_rew_weights = steps_left > self.n_step_size
+        return n_step.astype(np.float32), est_rew_weights.astype(np.float32)
 
     def add(self, obs, next_obs, action, reward, done, legal_action_mask):
         """Adds data to replay buffer
@@ -153,12 +218,21 @@ class ReplayBuffer:
             reward {float} -- reward obtained by action
             done {bool} -- toggle if episode is done
         """
-        self.obs.append(np.array(obs, dtype=np.float32))
-        self.next_obs.append(np.array(next_obs, dtype=np.float32))
-        self.actions.append(np.array(action, dtype=np.int64))
-        self.rewards.append(np.array(reward, dtype=np.float32))
-        self.done.append(np.array(done, dtype=np.int64))
-        self.legal_action_masks.append(np.array(legal_action_mask, dtype=np.int64))
+        if self._obs is None:
+            self.__allocate(obs, legal_action_mask)
+        self.__reserve(self._size + 1)
+        i = self._size
+        self._obs[i] = obs
+        self._next_obs[i] = next_obs
+        self._actions[i] = action
+        self._rewards[i] = reward
+        self._done[i] = done
+        self._epi_start[i] = self._epi_begin
+        self._legal_action_masks[i] = legal_action_mask
+        self._size += 1
+        if done:
+            self._epi_begin = self._size
+            self.__finish_episodes()
 
     def curriculum(self, curric_range, mode):
         """Sets curriculum for the replay buffer
@@ -251,33 +325,19 @@ class ReplayBuffer:
             self.n_step_size = n_step_size
         if gamma:
             self.gamma = gamma
-        self.idcs = np.arange(len(self.rewards))
-        self.vec_obs = np.stack(self.obs).astype(np.float32)
-        self.vec_next_obs = np.stack(self.next_obs).astype(np.float32)
-        self.vec_actions = np.stack(self.actions).astype(np.int64)
-        self.vec_rewards = np.stack(self.rewards).astype(np.float32)
-        self.vec_done = np.stack(self.done).astype(np.int64)
-        self.vec_legal_action_masks = np.stack(self.legal_action_masks).astype(np.int64)
-        self.__obs_idcs()
-        self.__n_step_reward()
-        # print('In vectorize: {}'.format(self.obs_idcs.shape))
+        if self._n_step_params != (self.n_step_size, self.gamma):
+            # n-step rewards were computed with other parameters, redo all finished episodes
+            self._n_step_params = (self.n_step_size, self.gamma)
+            self._finished = 0
+            self.__finish_episodes()
+        self._n_step_assigned = None
+        self.idcs = np.arange(self._size)
         return self
 
     def clear(self):
-        self.obs = []
-        self.vec_obs = np.array([])
-        self.next_obs = []
-        self.vec_next_obs = np.array([])
-        self.actions = []
-        self.vec_actions = np.array([])
-        self.rewards = []
-        self.vec_rewards = np.array([])
-        self.done = []
-        self.vec_done = np.array([])
-        self.legal_action_masks = []
-        self.vec_legal_action_masks = np.array([])
-
-        self.n_step = np.array([])
-        self.est_rew_weights = np.array([])
-
+        # storage is kept for the next round of transitions
+        self._size = 0
+        self._finished = 0
+        self._epi_begin = 0
+        self._n_step_assigned = None
         self.idcs = np.array([])
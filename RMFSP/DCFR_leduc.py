@@ -11,12 +11,12 @@ import six
 
 import tensorflow.compat.v1 as tf
 
-from open_spiel.python import policy
 #from open_spiel.python.algorithms import deep_cfr
 from open_spiel.python.algorithms import expected_game_score
 from open_spiel.python.algorithms import exploitability
 import pyspiel
 import deep_cfr
+from evaluation import EvaluationService
 
 # Temporarily disable TF2 behavior until we update the code.
 tf.disable_v2_behavior()
@@ -49,7 +49,9 @@ def main(unused_argv):
         advantage_network_train_steps=300,
         reinitialize_advantage_networks=False)
     sess.run(tf.global_variables_initializer())
-    _, advantage_losses, policy_loss = deep_cfr_solver.solve(game)
+    evaluator = EvaluationService(game, num_episodes=0)
+    _, advantage_losses, policy_loss = deep_cfr_solver.solve(game, evaluator)
+    evaluator.close()
     for player, losses in six.iteritems(advantage_losses):
       logging.info("Advantage for player %d: %s", player,
                    losses[:2] + ["..."] + losses[-2:])
@@ -59,8 +61,7 @@ def main(unused_argv):
                  len(deep_cfr_solver.strategy_buffer))
     logging.info("Final policy loss: '%s'", policy_loss)
 
-    average_policy = policy.tabular_policy_from_callable(
-        game, deep_cfr_solver.action_probabilities)
+    average_policy = deep_cfr_solver.tabular_average_policy()
 
     conv = exploitability.exploitability(game, average_policy)
     logging.info("Deep CFR in '%s' - Exploitability: %s", FLAGS.game_name, conv)
@@ -44,8 +44,13 @@ class ARM(rl_agent.AbstractAgent):
                  epsilon_end=0.1,
                  epsilon_decay_duration=int(1e6),
                  optimizer_str="adam",
-                 loss_str="mse"):
-        """Initialize the agent."""
+                 loss_str="mse",
+                 retained_iterations=1):
+        """Initialize the agent.
+
+    `retained_iterations` > 1 keeps the transitions of that many learn calls (the new one
+    included) in the replay buffer as a sliding window instead of clearing it.
+    """
         self.player_id = player_id
         self._session = session
         self._num_actions = num_actions
@@ -63,11 +68,20 @@ class ARM(rl_agent.AbstractAgent):
         # TODO(author6) Allow for optional replay buffer config.
         self._replay_buffer = replay_buffer_class(replay_buffer_capacity)
         self._replay_buffer_capacity = replay_buffer_capacity
+        # sliding window of past learn calls: rows per retained segment, oldest first
+        self._retained_iterations = max(retained_iterations, 1)
+        self._segments = []
+        # advantages (q plus) of the retained rows, computed when their segment was new. They are
+        # not refreshed when learn updates the networks, so a retained row keeps the advantage
+        # of the network it was first learned with; see `invalidate_target_cache`
+        self._q_plus_cache = np.zeros([0], np.float32)
         self._prev_timestep = None
         self._prev_action = None
 
         # Step counter to keep track of learning, eps decay and target network.
         self._step_counter = 0
+        # Bumped whenever the network parameters change, see `policies.AgentPolicies`.
+        self.policy_version = 0
 
         # Iterations while training
         self.iteration = iterations
@@ -173,7 +187,9 @@ class ARM(rl_agent.AbstractAgent):
             print("callable")
         else:
             print("Not callable")
-        self._learn_step = optimizer.minimize(self._loss)
+
+        self._fused_learn = self._create_fused_learn_op(
+            state_representation_size, loss_class, optimizer)
 
     def step(self, time_step, is_evaluation=False, add_transition_record=True):
         """Returns the action to be taken and updates the network if needed.
@@ -329,113 +345,53 @@ class ARM(rl_agent.AbstractAgent):
       The average loss obtained on this batch of transitions or `None`.
     """
 
-        if (len(self._replay_buffer) < self._batch_size or
-                len(self._replay_buffer) < self._min_buffer_size_to_learn):
+        if (self.new_transitions < self._batch_size or
+                self.new_transitions < self._min_buffer_size_to_learn):
             return None
         # print(len(self._replay_buffer), self._min_buffer_size_to_learn)
 
-        cum_v_loss = 0.
-        cum_q_loss = 0.
-
-        # ----------------   compute all targets (not necessary)---------------#
-        # vectorize may have problem.
+        # n-step rewards of every finished transition are fed once; a single session run
+        # performs all `self.iteration` sampled updates and soft target updates in graph.
+        # Advantages of retained rows come from the cache, only the new segment is evaluated.
         self._replay_buffer.vectorize(frame_buffer=0, n_step_size=N_STEP_SIZE, gamma=GAMMA)
-        # print(self._replay_buffer.idcs, self._replay_buffer.n_step)
-        # change to getting all target values first
-        all_tar_v, all_tar_q, q_plus = self.__compute_targets(self._sampled_indices)
-        # if self._replay_buffer.n_step.shape == (0,):
-        #     return
-        all_v_mb, all_q_mb = self._session.run([all_tar_v, all_tar_q],
-                                               feed_dict={self._info_state_ph: self._replay_buffer.obs,
-                                                          self._n_step_ph: self._replay_buffer.n_step[self._replay_buffer.idcs],
-                                                          self._action_ph: self._replay_buffer.actions})
-
-        # ----------------every iteration, sample and compute loss-------------#
-        for i_iter in range(self.iteration):
-            # Sample (get states & ...)
-            mb_idcs = np.random.choice(len(self._replay_buffer), self._batch_size)
-            mb_info_state, _, mb_actions, *_ = self._replay_buffer[mb_idcs]  # problem
-
-            mb_est_rew_w = self._replay_buffer.est_rew_weights[self._replay_buffer.idcs[mb_idcs]]  # problem
-            mb_est_non_zero = np.nonzero(mb_est_rew_w)
-            n_step = self._replay_buffer.n_step[mb_idcs]
-
-            if len(mb_est_non_zero[0]):  # the array is not empty
-                mb_est_non_zero = np.squeeze(mb_est_non_zero)
-                mb_est_rew_idcs = (self._replay_buffer.idcs[mb_idcs][mb_est_non_zero] +
-                                   self._replay_buffer.n_step_size).reshape(-1)
-
-                # mb_v_prime_obs = next_info_state_ph
-                mb_v_prime_obs, _, _, *_ = self._replay_buffer[mb_est_rew_idcs]
-            else:
-                mb_v_prime_obs = np.zeros((32, mb_info_state[0].size))
-
-            # if self.player_id == 0:
-            #     print("In Learn Test Start: {}#################".format(i_iter))
-            #     print(self.player_id)
-            #     print(mb_info_state.shape)
-            #     print(mb_actions.shape)
-            #     print(mb_v_prime_obs.shape)
-            #     print(n_step.shape)
-            #     print(mb_est_rew_w)
-            #     print(mb_est_non_zero)
-            #     print("In
-            #     Test End: {}###################".format(i_iter))
-            tar_v_mb = all_v_mb[mb_idcs]
-            tar_q_mb = all_q_mb[mb_idcs]
-            # print("In iteration: {}".format(i_iter))
-            # print(tar_v_mb.shape, tar_q_mb.shape)
-
-            loss, _, v_loss, q_loss = self._session.run(
-                [self._loss, self._learn_step, self.v_loss, self.q_loss],
-                feed_dict={
-                    self._info_state_ph: mb_info_state,
-                    self._action_ph: mb_actions,
-                    self._next_info_state_ph: mb_v_prime_obs,
-                    self._mb_est_rew_ph: mb_est_rew_w,
-                    self._tar_q_ph: tar_q_mb,
-                    self._tar_v_ph: tar_v_mb
-                })
-
-            self._session.run(self._update_target_network)
-
-            cum_q_loss += q_loss
-            cum_v_loss += v_loss
-
-            if (i_iter + 1) % (self.iteration / 10) == 0.:
-                # print loss
-                mean_v_loss = (cum_v_loss / int(self.iteration / 10))
-                mean_q_loss = (cum_q_loss / int(self.iteration / 10))
-                print("interation: {}, v_loss: {:.6f}, q_loss: {:.6f}".format(
-                    i_iter + 1, mean_v_loss, mean_q_loss), end='\r')
-                if (i_iter + 1) == self.iteration:
-                    cum_v_loss = mean_v_loss
-                    cum_q_loss = mean_q_loss
-                else:
-                    cum_v_loss = 0.0
-                    cum_q_loss = 0.0
-
-        # transitions = self._replay_buffer.sample(self._batch_size)
-        # info_states = [t.info_state for t in transitions]
-        # actions = [t.action for t in transitions]
-        # rewards = [t.reward for t in transitions]
-        # next_info_states = [t.next_info_state for t in transitions]
-        # are_final_steps = [t.is_final_step for t in transitions]
-        # legal_actions_mask = [t.legal_actions_mask for t in transitions]
-        # loss, _ = self._session.run(
-        #     [self._loss, self._learn_step],
-        #     feed_dict={
-        #         self._info_state_ph: info_states,
-        #         self._action_ph: actions,
-        #         self._reward_ph: rewards,
-        #         self._is_final_step_ph: are_final_steps,
-        #         self._next_info_state_ph: next_info_states,
-        #         self._legal_actions_mask_ph: legal_actions_mask,
-        #     })
+        finished = len(self._replay_buffer.n_step)
+        cum_v_loss, cum_q_loss, new_q_plus = self._session.run(
+            self._fused_learn,
+            feed_dict={
+                self._buffer_info_state_ph: self._replay_buffer.obs[:finished],
+                self._buffer_action_ph: self._replay_buffer.actions[:finished],
+                self._buffer_n_step_ph: self._replay_buffer.n_step,
+                self._buffer_est_rew_ph: self._replay_buffer.est_rew_weights,
+                self._cached_q_plus_ph: self._q_plus_cache,
+                self._use_q_plus_ph: bool(self._step_counter)
+            })
+        print("interation: {}, v_loss: {:.6f}, q_loss: {:.6f}".format(
+            self.iteration, cum_v_loss, cum_q_loss), end='\r')
+
         self._last_loss_value = [cum_v_loss, cum_q_loss]
-        self.replay_buffer.clear()
+        self.policy_version += 1
+        self.__retain(finished, new_q_plus)
         return [cum_v_loss, cum_q_loss]
 
+    def __retain(self, finished, new_q_plus):
+        """Slides the replay window after a learn call over the first `finished` rows"""
+        if self._retained_iterations == 1:
+            self.replay_buffer.clear()
+            return
+        self._segments.append(finished - sum(self._segments))
+        self._q_plus_cache = np.concatenate([self._q_plus_cache, new_q_plus])
+        while len(self._segments) >= self._retained_iterations:
+            rows = self._segments.pop(0)
+            self._replay_buffer.discard(rows)
+            self._q_plus_cache = self._q_plus_cache[rows:]
+        # vectorize froze the indices at this call's size, rows added from now on count again
+        self._replay_buffer.idcs = np.array([])
+
+    def invalidate_target_cache(self):
+        """Makes the next learn call recompute the targets of every retained transition, for
+    example after the network weights were restored. The segments stay as they are."""
+        self._q_plus_cache = np.zeros([0], np.float32)
+
     # -----------------------------ARM Functions -------------------------------#
     def __compute_losses(self, sampled_indices):
         illegal_actions = 1 - self._legal_actions_mask_ph
@@ -501,75 +457,87 @@ class ARM(rl_agent.AbstractAgent):
         print("In losses: {}, {}, {}, {}".format(v, q, tar_v, tar_q))
         return v, q, tar_v, tar_q
 
-    def __compute_targets(self, sampled_indices):
-        # first_batch = not self._step_counter
-        first_batch = self._step_counter
-
-        # precompute all v and q target values
-        # evs = tf.zeros([])
-        # cfv = tf.zeros([])
-        zero = tf.constant(0, dtype=tf.int32)
-
-        def idx_nonezero_t():
-            q_values = self._q_values
-            # q_values_t = torch.from_numpy(q_values)
-            q_evs = q_values[:, self._num_actions]
-            q_cfv = q_values[:, :self._num_actions]
-            # print("In compute target_1: {}, {}, {}".format(tf.rank(self._action_ph), q_evs, self._action_ph))
-            action_indices = tf.stack(
-                [tf.range(tf.shape(q_cfv)[0]), self._action_ph], axis=-1)
-            q_cfv_t = tf.gather_nd(q_cfv, action_indices)
-            # action_one_hot = tf.one_hot(self._action_ph, 3)
-            # print(action_one_hot, q_cfv)
-            # q_cfv_t = tf.diag_part(tf.matmul(q_cfv, tf.transpose(action_one_hot)))
-            # print(mul_t)
-            # q_cfv = tf.gather_nd(q_cfv, self._action_ph, batch_dims=1)  # problem
-            evs = q_evs
-            cfv = q_cfv_t
-            # print(evs, cfv)
-            # compute advantage value and clip to 0
-            # print("In compute target_2: {}, {}".format(cfv, evs))
-            q_plus_t = cfv - evs  # q_plus_t is going to be written
-            # with open("log/q_plus.txt", 'a+') as f:
-            #    f.write("{}\n".format(q_plus_t.eval()))
-            # print("q_plus: {}".format(q_plus_t))
-            if self.clip_value:
-                q_plus_t = tf.clip_by_value(q_plus_t, clip_value_min=0, clip_value_max=1e999999)
-            q_plus = q_plus_t
-            n_step = self._n_step_ph
-
-            v_t = n_step
-            q_t = q_plus * self.q_plus_weight + n_step
-            return v_t, q_t, q_plus
-
-        def idx_zero_t():
-            n_step = self._n_step_ph
-            q_plus = tf.zeros_like(n_step)
-
-            v_t = n_step
-            q_t = n_step
-            return v_t, q_t, q_plus
-
-        v_tar, q_tar, q_plus = tf.cond(tf.equal(first_batch, zero), idx_zero_t, idx_nonezero_t)
-
-        # if first_batch:
-        # q_plus = np.zeros(self._batch_size)  # problem?
-
-        # else:
-        # compute q and v values of last iteration (problem)
-        # obs = info_state
-        # actions = actions
-        # q_values = self._session.run(
-        #     self._q_values, feed_dict={self._info_state_ph: obs})[0]  #maybe self._q_values is enough
-
-        # print(sampled_indices)
-        # n_step = self._replay_buffer.n_step[sampled_indices]  # problem
-        # sampled_indices = self._sampled_indices_ph.eval()
-        # print("sampled_indices: {}, {}".format(self._sampled_indices_ph, sampled_indices))
-        # n_step = [self._replay_buffer.n_step[i] for i in sampled_indices]
-        # n_step = np.zeros((self._batch_size, 1))
-        # print("In target: {}, {}".format(v_tar, q_tar))
-        return v_tar, q_tar, q_plus
+    def _create_fused_learn_op(self, state_representation_size, loss_class, optimizer):
+        """Builds the op running a whole `learn` call in one session run.
+
+    The finished part of the replay buffer is fed once. The v and q targets of every
+    transition are computed with the current network, then a `tf.while_loop` samples
+    `self.iteration` minibatches on device, applies the optimizer and the soft target
+    update after each of them.
+
+    Only rows after the `self._cached_q_plus_ph` ones are run through the network for
+    their targets.
+
+    Returns:
+      The mean v and q losses of the last tenth of iterations and the q plus values of
+      the rows that were not cached.
+    """
+        self._buffer_info_state_ph = tf.placeholder(
+            shape=[None, state_representation_size], dtype=tf.float32, name="buffer_info_state")
+        self._buffer_action_ph = tf.placeholder(shape=[None], dtype=tf.int32, name="buffer_action")
+        self._buffer_n_step_ph = tf.placeholder(shape=[None], dtype=tf.float32, name="buffer_n_step")
+        self._buffer_est_rew_ph = tf.placeholder(shape=[None], dtype=tf.float32, name="buffer_est_rew")
+        # advantages of the leading retained rows, cached from earlier learn calls
+        self._cached_q_plus_ph = tf.placeholder_with_default(
+            tf.zeros([0]), shape=[None], name="cached_q_plus")
+        # the very first learn call has no trained network to take advantages from
+        self._use_q_plus_ph = tf.placeholder_with_default(True, shape=[], name="use_q_plus")
+
+        obs = self._buffer_info_state_ph
+        actions = self._buffer_action_ph
+        buffer_size = tf.shape(actions)[0]
+        batch_range = tf.range(self._batch_size)
+
+        # precompute the v and q target values, advantages only for the new rows
+        cached = tf.shape(self._cached_q_plus_ph)[0]
+        values = self._q_network(obs[cached:])
+        new_q_plus = tf.gather_nd(values[:, :self._num_actions],
+                                  tf.stack([tf.range(buffer_size - cached), actions[cached:]], axis=-1))
+        new_q_plus = new_q_plus - values[:, self._num_actions]
+        if self.clip_value:
+            new_q_plus = tf.maximum(new_q_plus, 0.)
+        new_q_plus = tf.stop_gradient(new_q_plus * tf.cast(self._use_q_plus_ph, tf.float32))
+        q_plus = tf.concat([self._cached_q_plus_ph, new_q_plus], axis=0)
+        all_tar_v = tf.stop_gradient(self._buffer_n_step_ph)
+        all_tar_q = tf.stop_gradient(q_plus * self.q_plus_weight + self._buffer_n_step_ph)
+
+        q_variables = self._q_network.get_variables()
+        iterations = self.iteration
+        last_iterations = max(iterations // 10, 1)
+
+        def body(i, cum_v_loss, cum_q_loss):
+            mb_idcs = tf.random.uniform([self._batch_size], maxval=buffer_size, dtype=tf.int32)
+            # bootstrap non terminal n-step rewards with the target network
+            next_idcs = tf.minimum(mb_idcs + N_STEP_SIZE, buffer_size - 1)
+            val_est = tf.stop_gradient(
+                self._target_q_network(tf.gather(obs, next_idcs)))[:, self._num_actions]
+            val_est = tf.where(tf.gather(self._buffer_est_rew_ph, mb_idcs) > 0,
+                               val_est * GAMMA ** N_STEP_SIZE, tf.zeros_like(val_est))
+
+            mb_values = self._q_network(tf.gather(obs, mb_idcs))
+            mb_v = mb_values[:, self._num_actions]
+            mb_q = tf.gather_nd(mb_values[:, :self._num_actions],
+                                tf.stack([batch_range, tf.gather(actions, mb_idcs)], axis=-1))
+            v_loss = loss_class(labels=tf.gather(all_tar_v, mb_idcs) + val_est, predictions=mb_v,
+                                loss_collection=None)
+            q_loss = loss_class(labels=tf.gather(all_tar_q, mb_idcs) + val_est, predictions=mb_q,
+                                loss_collection=None)
+
+            learn_step = optimizer.minimize(v_loss + q_loss, var_list=q_variables)
+            with tf.control_dependencies([learn_step]):
+                update_target = self._create_target_network_update_op(
+                    self._q_network, self._target_q_network)
+            with tf.control_dependencies([update_target]):
+                last = tf.cast(i >= iterations - last_iterations, tf.float32)
+                return i + 1, cum_v_loss + last * v_loss, cum_q_loss + last * q_loss
+
+        # targets come from the network before this call's updates
+        with tf.control_dependencies([all_tar_v, all_tar_q]):
+            start = tf.identity(tf.constant(0))
+        _, cum_v_loss, cum_q_loss = tf.while_loop(
+            lambda i, *_: i < iterations, body, [start, tf.constant(0.), tf.constant(0.)],
+            back_prop=False)
+        return cum_v_loss / last_iterations, cum_q_loss / last_iterations, new_q_plus
 
     # def __sample_mini_batch(self, replay_buffer, v_tar, q_tar):
     #     # sample random batch from replay buffer indices
@@ -644,6 +612,16 @@ class ARM(rl_agent.AbstractAgent):
         # print(action, action_prob, probabilities, chosed_legal_action)
         return action, probabilities
 
+    def batch_action_probs(self, info_states, legal_actions_mask):
+        """`_action_policy` probabilities of a batch of info states from one forward."""
+        q_values = self._session.run(
+            self._q_values, feed_dict={self._info_state_ph: info_states})
+        action_values = np.maximum(
+            q_values[:, :self._num_actions] - q_values[:, self._num_actions:], 0) * legal_actions_mask
+        q_values_sum = action_values.sum(axis=1, keepdims=True)
+        uniform = legal_actions_mask / legal_actions_mask.sum(axis=1, keepdims=True)
+        return np.where(q_values_sum > 0, action_values / np.where(q_values_sum > 0, q_values_sum, 1), uniform)
+
     def temp_mode_as(self, mode):
         """Context manager to temporarily overwrite the mode."""
         previous_mode = self._mode
@@ -660,10 +638,19 @@ class ARM(rl_agent.AbstractAgent):
     def q_values(self):
         return self._q_values
 
+    @property
+    def q_network(self):
+        return self._q_network
+
     @property
     def replay_buffer(self):
         return self._replay_buffer
 
+    @property
+    def new_transitions(self):
+        """transitions recorded since the last learn call"""
+        return self._replay_buffer.size - sum(self._segments)
+
     @property
     def info_state_ph(self):
         return self._info_state_ph
@@ -0,0 +1,214 @@
+"""Exact best responses and NashConv of tabular policies on a compiled game tree.
+
+The history tree of a game is walked once and flattened into arrays: the parent, the acting
+player and the `TabularPolicy` row of every edge, the chance probabilities, the terminal
+utilities and, per player, the sequence (row, action) of its last decision before every
+terminal. The arrays are cached on disk per game string and format version. Best responses
+against a dense `[num_states, num_actions]` policy array (in `TabularPolicy` row order) are
+then a forward pass of reach probabilities by depth followed by a backward max over the
+information sets of each player by their own decision depth.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import os
+import re
+
+import numpy as np
+
+from open_spiel.python import policy
+import pyspiel
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "game_cache")
+
+_ARRAYS = ("parent", "edge_player", "edge_row", "edge_action", "edge_chance", "level_starts",
+           "terminals", "utilities", "terminal_seqs", "row_player", "row_parent_seq",
+           "row_depth", "legal_actions_mask")
+# bump whenever `_compile` changes what it stores, caches of other versions are rebuilt
+FORMAT_VERSION = 1
+
+
+def _compile(game):
+    """Walks the history tree of `game` and returns its arrays, see the module doc."""
+    if game.get_type().dynamics == pyspiel.GameType.Dynamics.SIMULTANEOUS:
+        raise ValueError("Simultaneous games are not supported.")
+    num_players = game.num_players()
+    num_actions = game.num_distinct_actions()
+    tabular = policy.TabularPolicy(game)
+    num_rows = len(tabular.states)
+    row_player = np.array([s.current_player() for s in tabular.states], np.int32)
+    row_parent_seq = np.full(num_rows, -2, np.int64)  # -2: not reached yet, -1: empty sequence
+    row_depth = np.zeros(num_rows, np.int32)
+
+    depth, parent, edge_player, edge_row, edge_action, edge_chance = [], [], [], [], [], []
+    terminals, utilities, terminal_seqs = [], [], []
+
+    def add_node(d, p, player, row, action, chance):
+        depth.append(d)
+        parent.append(p)
+        edge_player.append(player)
+        edge_row.append(row)
+        edge_action.append(action)
+        edge_chance.append(chance)
+        return len(depth) - 1
+
+    # each entry: (state, node id, depth, last sequence of every player, own depths)
+    stack = [(game.new_initial_state(), add_node(0, -1, -1, -1, -1, 1.0), 0,
+              (-1,) * num_players, (0,) * num_players)]
+    while stack:
+        state, node, d, seqs, own_depths = stack.pop()
+        if state.is_terminal():
+            terminals.append(node)
+            utilities.append(state.returns())
+            terminal_seqs.append(seqs)
+        elif state.is_chance_node():
+            for action, prob in state.chance_outcomes():
+                child = add_node(d + 1, node, -1, -1, action, prob)
+                stack.append((state.child(action), child, d + 1, seqs, own_depths))
+        else:
+            player = state.current_player()
+            row = tabular.state_index(state)
+            if row_parent_seq[row] == -2:
+                # perfect recall: every history of the info state has the same sequence
+                row_parent_seq[row] = seqs[player]
+                row_depth[row] = own_depths[player]
+            for action in state.legal_actions():
+                child = add_node(d + 1, node, player, row, action, 1.0)
+                child_seqs = seqs[:player] + (row * num_actions + action,) + seqs[player + 1:]
+                child_depths = own_depths[:player] + (own_depths[player] + 1,) + own_depths[player + 1:]
+                stack.append((state.child(action), child, d + 1, child_seqs, child_depths))
+
+    # renumber the nodes by depth, so each level is a contiguous block after its parents
+    depth = np.array(depth)
+    order = np.argsort(depth, kind="stable")
+    new_id = np.empty_like(order)
+    new_id[order] = np.arange(len(order))
+    parent = np.array(parent)[order]
+    parent[1:] = new_id[parent[1:]]
+    return dict(
+        parent=parent,
+        edge_player=np.array(edge_player, np.int32)[order],
+        edge_row=np.array(edge_row, np.int64)[order],
+        edge_action=np.array(edge_action, np.int64)[order],
+        edge_chance=np.array(edge_chance)[order],
+        level_starts=np.searchsorted(depth[order], np.arange(depth.max() + 2)),
+        terminals=new_id[np.array(terminals)],
+        utilities=np.array(utilities),
+        terminal_seqs=np.array(terminal_seqs, np.int64).reshape(-1, num_players),
+        row_player=row_player,
+        row_parent_seq=row_parent_seq,
+        row_depth=row_depth,
+        legal_actions_mask=tabular.legal_actions_mask.astype(bool))
+
+
+def _cache_path(game_string, cache_dir):
+    digest = hashlib.sha1(" ".join(_ARRAYS).encode("utf-8")).hexdigest()[:8]
+    return os.path.join(cache_dir, "%s_v%d_%s.npz" % (
+        re.sub(r"[^\w.=-]+", "_", game_string), FORMAT_VERSION, digest))
+
+
+class CompiledGame(object):
+    """Flattened history tree of a game, for repeated exact best-response queries."""
+
+    def __init__(self, game, cache_dir=CACHE_DIR):
+        if isinstance(game, str):
+            game = pyspiel.load_game(game)
+        self.num_players = game.num_players()
+        self.num_actions = game.num_distinct_actions()
+        path = None if cache_dir is None else _cache_path(str(game), cache_dir)
+        if path is not None and os.path.exists(path):
+            with np.load(path) as data:
+                arrays = {name: data[name] for name in _ARRAYS}
+        else:
+            arrays = _compile(game)
+            if path is not None:
+                if not os.path.exists(cache_dir):
+                    os.makedirs(cache_dir)
+                np.savez(path, **arrays)
+        for name in _ARRAYS:
+            setattr(self, "_" + name, arrays[name])
+        # the edges of decision nodes index the flattened policy array
+        self._edge_seq = np.where(self._edge_row >= 0,
+                                  self._edge_row * self.num_actions + self._edge_action, 0)
+
+    @property
+    def num_states(self):
+        """number of rows of the policy arrays"""
+        return len(self._row_player)
+
+    def _policy_array(self, policies):
+        if isinstance(policies, np.ndarray):
+            return policies
+        tabulate = getattr(policies, "tabulate", None)
+        return tabulate() if tabulate is not None else policies.action_probability_array
+
+    def _reaches(self, probs):
+        """[num_nodes, num_players + 1] reach probabilities: column p excludes the actions of
+        player p, the last column is the reach of the whole joint policy."""
+        edge_prob = np.where(self._edge_row >= 0, probs.ravel()[self._edge_seq], self._edge_chance)
+        factors = np.empty([len(self._parent), self.num_players + 1])
+        factors[:, :-1] = np.where(
+            self._edge_player[:, None] == np.arange(self.num_players)[None], 1.0, edge_prob[:, None])
+        factors[:, -1] = edge_prob
+        reach = factors
+        for start, end in zip(self._level_starts[1:-1], self._level_starts[2:]):
+            reach[start:end] *= reach[self._parent[start:end]]
+        return reach
+
+    def _best_response_value(self, player, weights):
+        """Value of the best response of `player` given its terminal `weights`
+        (utility times the reach of chance and the other players)."""
+        seq_values = np.zeros(self.num_states * self.num_actions)
+        seqs = self._terminal_seqs[:, player]
+        root = weights[seqs < 0].sum()
+        np.add.at(seq_values, seqs[seqs >= 0], weights[seqs >= 0])
+        rows = np.nonzero(self._row_player == player)[0]
+        depths = self._row_depth[rows]
+        for d in range(depths.max(initial=-1), -1, -1):
+            level = rows[depths == d]
+            values = np.where(self._legal_actions_mask[level],
+                              seq_values.reshape(self.num_states, self.num_actions)[level],
+                              -np.inf).max(axis=1)
+            parents = self._row_parent_seq[level]
+            root += values[parents < 0].sum()
+            np.add.at(seq_values, parents[parents >= 0], values[parents >= 0])
+        return root
+
+    def best_response_values(self, policies):
+        """Returns the best-response value of every player against `policies` (a dense policy
+        array, a `TabularPolicy` or a `policies.AgentPolicies`) and the on-policy values."""
+        probs = np.asarray(self._policy_array(policies), np.float64)
+        reach = self._reaches(probs)[self._terminals]
+        on_policy = (self._utilities * reach[:, -1:]).sum(axis=0)
+        best = np.array([self._best_response_value(p, self._utilities[:, p] * reach[:, p])
+                         for p in range(self.num_players)])
+        return best, on_policy
+
+    def nash_conv(self, policies):
+        best, on_policy = self.best_response_values(policies)
+        return (best - on_policy).sum()
+
+    def exploitability(self, policies):
+        """NashConv per player; equal to `exploitability.exploitability` on constant-sum games."""
+        return self.nash_conv(policies) / self.num_players
+
+
+_COMPILED = {}
+
+
+def compiled_game(game, cache_dir=CACHE_DIR):
+    """Returns the `CompiledGame` of `game`, kept for the lifetime of the process."""
+    key = (str(game), cache_dir)
+    if key not in _COMPILED:
+        _COMPILED[key] = CompiledGame(game, cache_dir)
+    return _COMPILED[key]
+
+
+def nash_conv(game, policies):
+    return compiled_game(game).nash_conv(policies)
+
+
+def exploitability(game, policies):
+    return compiled_game(game).exploitability(policies)
@@ -26,7 +26,6 @@ from __future__ import division
 from __future__ import print_function
 
 import collections
-import random
 import numpy as np
 import tensorflow.compat.v1 as tf
 from absl import logging
@@ -38,66 +37,16 @@ import pyspiel
 from open_spiel.python.algorithms import expected_game_score
 from open_spiel.python.algorithms import exploitability
 
+from deep_cfr_traversal import AdvantageMemory
+from deep_cfr_traversal import StrategyMemory
+from deep_cfr_traversal import TraversalEngine
+from deep_cfr_traversal import TraversalWorkers
+from deep_cfr_traversal import matched_regrets
+from reservoir_buffer import ReservoirBuffer
+
 # Temporarily Disable TF2 behavior until we update the code.
 tf.disable_v2_behavior()
 
-AdvantageMemory = collections.namedtuple(
-    "AdvantageMemory", "info_state iteration advantage action")
-
-StrategyMemory = collections.namedtuple(
-    "StrategyMemory", "info_state iteration strategy_action_probs")
-
-
-# TODO(author3) Refactor into data structures lib.
-class ReservoirBuffer(object):
-  """Allows uniform sampling over a stream of data.
-  This class supports the storage of arbitrary elements, such as observation
-  tensors, integer actions, etc.
-  See https://en.wikipedia.org/wiki/Reservoir_sampling for more details.
-  """
-
-  def __init__(self, reservoir_buffer_capacity):
-    self._reservoir_buffer_capacity = reservoir_buffer_capacity
-    self._data = []
-    self._add_calls = 0
-
-  def add(self, element):
-    """Potentially adds `element` to the reservoir buffer.
-    Args:
-      element: data to be added to the reservoir buffer.
-    """
-    if len(self._data) < self._reservoir_buffer_capacity:
-      self._data.append(element)
-    else:
-      idx = np.random.randint(0, self._add_calls + 1)
-      if idx < self._reservoir_buffer_capacity:
-        self._data[idx] = element
-    self._add_calls += 1
-
-  def sample(self, num_samples):
-    """Returns `num_samples` uniformly sampled from the buffer.
-    Args:
-      num_samples: `int`, number of samples to draw.
-    Returns:
-      An iterable over `num_samples` random elements of the buffer.
-    Raises:
-      ValueError: If there are less than `num_samples` elements in the buffer
-    """
-    if len(self._data) < num_samples:
-      raise ValueError("{} elements could not be sampled from size {}".format(
-          num_samples, len(self._data)))
-    return random.sample(self._data, num_samples)
-
-  def clear(self):
-    self._data = []
-    self._add_calls = 0
-
-  def __len__(self):
-    return len(self._data)
-
-  def __iter__(self):
-    return iter(self._data)
-
 
 class DeepCFRSolver(policy.Policy):
   """Implements a solver for the Deep CFR Algorithm.
@@ -123,7 +72,8 @@ class DeepCFRSolver(policy.Policy):
                memory_capacity: int = int(1e6),
                policy_network_train_steps: int = 1,
                advantage_network_train_steps: int = 1,
-               reinitialize_advantage_networks: bool = True):
+               reinitialize_advantage_networks: bool = True,
+               num_traversal_workers: int = 0):
     """Initialize the Deep CFR algorithm.
     Args:
       session: (tf.Session) TensorFlow session.
@@ -144,12 +94,15 @@ class DeepCFRSolver(policy.Policy):
         (per iteration).
       reinitialize_advantage_networks: Whether to re-initialize the
         advantage network before training on each iteration.
+      num_traversal_workers: Number of worker processes running traversals.
+        With 0 the traversals run concurrently in this process. Either way the
+        advantage queries of all pending traversals share one forward pass.
     """
     all_players = list(range(game.num_players()))
     super(DeepCFRSolver, self).__init__(game, all_players)
     self._game = game
     if game.get_type().dynamics == pyspiel.GameType.Dynamics.SIMULTANEOUS:
-      # `_traverse_game_tree` does not take into account this option.
+      # The traversals of `TraversalEngine` do not take into account this option.
       raise ValueError("Simulatenous games are not supported.")
     self._session = session
     self._batch_size_advantage = batch_size_advantage
@@ -166,6 +119,11 @@ class DeepCFRSolver(policy.Policy):
     self._num_actions = game.num_distinct_actions()
     self._iteration = 1
     self._environment_steps = 0
+    self._num_traversal_workers = num_traversal_workers
+    self._traversal_engine = TraversalEngine(game, np.random.randint(2**31))
+    self._traversal_workers = None
+    # tabular policy of the game with its info state tensors, built on first use
+    self._tabular_states = None
 
     # Create required TensorFlow placeholders to perform the Q-network updates.
     self._info_state_ph = tf.placeholder(
@@ -191,7 +149,10 @@ class DeepCFRSolver(policy.Policy):
               name="advantage_ph_" + str(p)))
 
     # Define strategy network, loss & memory.
-    self._strategy_memories = ReservoirBuffer(memory_capacity)
+    self._strategy_memories = ReservoirBuffer(
+        memory_capacity, StrategyMemory,
+        shapes={"info_state": [self._embedding_size],
+                "strategy_action_probs": [self._num_actions]})
     self._policy_network = simple_nets.MLP(self._embedding_size,
                                            list(policy_network_layers),
                                            self._num_actions)
@@ -208,7 +169,11 @@ class DeepCFRSolver(policy.Policy):
 
     # Define advantage network, loss & memory. (One per player)
     self._advantage_memories = [
-        ReservoirBuffer(memory_capacity) for _ in range(self._num_players)
+        ReservoirBuffer(
+          memory_capacity, AdvantageMemory,
+          shapes={"info_state": [self._embedding_size],
+                  "advantage": [self._num_actions]},
+          dtypes={"action": np.int64}) for _ in range(self._num_players)
     ]
     self._advantage_networks = [
         simple_nets.MLP(self._embedding_size, list(advantage_network_layers),
@@ -256,13 +221,19 @@ class DeepCFRSolver(policy.Policy):
             for var in self._advantage_networks[player].variables
         ]))
 
-  def solve(self, game):
-    """Solution logic for Deep CFR."""
+  def solve(self, game, evaluator=None):
+    """Solution logic for Deep CFR.
+
+    Args:
+      game: Open Spiel game.
+      evaluator: (evaluation.EvaluationService or None) Background evaluator of
+        the average policy snapshots. Without one, exploitability is computed
+        in place.
+    """
     advantage_losses = collections.defaultdict(list)
     for it in range(self._num_iterations):
       for p in range(self._num_players):
-        for _ in range(self._num_traversals):
-          self._traverse_game_tree(self._root_node, p)
+        self._run_traversals(p)
         if self._reinitialize_advantage_networks:
           # Re-initialize advantage network for player and train from scratch.
           self.reinitialize_advantage_network(p)
@@ -271,96 +242,73 @@ class DeepCFRSolver(policy.Policy):
       episodes = it * self._num_traversals
       if episodes % 10000 == 0:
         # evaluation
-        average_policy = policy.tabular_policy_from_callable(game, self.action_probabilities)
-        conv = exploitability.exploitability(game, average_policy)
-        logging.info("Deep CFR in '%d' - Exploitability: %s", episodes, conv)
-        with open("DCFR_leduc.txt", 'a+') as f:
-          f.write("{}: {}\n".format(episodes, conv))
-
+        average_policy = self.tabular_average_policy()
+        if evaluator is None:
+          self._log_exploitability(
+              episodes, exploitability.exploitability(game, average_policy))
+        else:
+          evaluator.submit(episodes, average_policy)
+          for report in evaluator.poll():
+            self._log_exploitability(report.step, report.exploitability)
+
+    if evaluator is not None:
+      for report in evaluator.wait():
+        self._log_exploitability(report.step, report.exploitability)
+    self.close_traversal_workers()
     # Train policy network.
     policy_loss = self._learn_strategy_network()
     return self._policy_network, advantage_losses, policy_loss
 
+  def _log_exploitability(self, episodes, conv):
+    logging.info("Deep CFR in '%d' - Exploitability: %s", episodes, conv)
+    with open("DCFR_leduc.txt", 'a+') as f:
+      f.write("{}: {}\n".format(episodes, conv))
+
   def get_environment_steps(self):
     return self._environment_steps
 
-  def _traverse_game_tree(self, state, player):
-    """Performs a traversal of the game tree.
-    Over a traversal the advantage and strategy memories are populated with
-    computed advantage values and matched regrets respectively.
-    Args:
-      state: Current OpenSpiel game state.
-      player: (int) Player index for this traversal.
-    Returns:
-      Recursively returns expected payoffs for each action.
+  def close_traversal_workers(self):
+    if self._traversal_workers is not None:
+      self._traversal_workers.close()
+      self._traversal_workers = None
+
+  def _run_traversals(self, player):
+    """Runs `num_traversals` concurrent traversals for `player`.
+
+    Stores the resulting advantage and strategy memories.
     """
-    self._environment_steps += 1
-    expected_payoff = collections.defaultdict(float)
-    if state.is_terminal():
-      # Terminal state get returns.
-      return state.returns()[player]
-    elif state.is_chance_node():
-      # If this is a chance node, sample an action
-      action = np.random.choice([i[0] for i in state.chance_outcomes()])
-      return self._traverse_game_tree(state.child(action), player)
-    elif state.current_player() == player:
-      sampled_regret = collections.defaultdict(float)
-      # Update the policy over the info set & actions via regret matching.
-      _, strategy = self._sample_action_from_advantage(state, player)
-      for action in state.legal_actions():
-        expected_payoff[action] = self._traverse_game_tree(
-            state.child(action), player)
-      cfv = 0
-      for a_ in state.legal_actions():
-        cfv += strategy[a_] * expected_payoff[a_]
-      for action in state.legal_actions():
-        sampled_regret[action] = expected_payoff[action]
-        sampled_regret[action] -= cfv
-      sampled_regret_arr = [0] * self._num_actions
-      for action in sampled_regret:
-        sampled_regret_arr[action] = sampled_regret[action]
-      self._advantage_memories[player].add(
-          AdvantageMemory(state.information_state_tensor(), self._iteration,
-                          sampled_regret_arr, action))
-      return cfv
+    if self._num_traversal_workers:
+      if self._traversal_workers is None:
+        self._traversal_workers = TraversalWorkers(
+            self._game, self._num_traversal_workers, np.random.randint(2**31))
+      advantage_batches, strategy_batches, steps = self._traversal_workers.run(
+          player, self._iteration, self._num_traversals, self._query_advantages)
     else:
-      other_player = state.current_player()
-      _, strategy = self._sample_action_from_advantage(state, other_player)
-      # Recompute distribution dor numerical errors.
-      probs = np.array(strategy)
-      probs /= probs.sum()
-      sampled_action = np.random.choice(range(self._num_actions), p=probs)
-      self._strategy_memories.add(
-          StrategyMemory(
-              state.information_state_tensor(other_player), self._iteration,
-              strategy))
-      return self._traverse_game_tree(state.child(sampled_action), player)
-
-  def _sample_action_from_advantage(self, state, player):
-    """Returns an info state policy by applying regret-matching.
+      engine = self._traversal_engine
+      engine.start(player, self._iteration, self._num_traversals)
+      while not engine.done:
+        engine.answer(self._query_advantages(*engine.queries()[:2]))
+      advantage_batch, strategy_batch = engine.memories()
+      advantage_batches, strategy_batches = [advantage_batch], [strategy_batch]
+      steps = engine.environment_steps
+    for batch in advantage_batches:
+      self._advantage_memories[player].add_batch(batch)
+    for batch in strategy_batches:
+      self._strategy_memories.add_batch(batch)
+    self._environment_steps += steps
+
+  def _query_advantages(self, players, info_states):
+    """Advantages of each info state under the network of its player.
+
     Args:
-      state: Current OpenSpiel game state.
-      player: (int) Player index over which to compute regrets.
+      players: [batch] player whose network answers each row.
+      info_states: [batch, embedding_size] information state tensors.
     Returns:
-      1. (list) Advantage values for info state actions indexed by action.
-      2. (list) Matched regrets, prob for actions indexed by action.
+      [batch, num_actions] advantages, from a single session run.
     """
-    info_state = state.information_state_tensor(player)
-    legal_actions = state.legal_actions(player)
-    advantages_full = self._session.run(
-        self._advantage_outputs[player],
-        feed_dict={self._info_state_ph: np.expand_dims(info_state, axis=0)})[0]
-    advantages = [max(0., advantage) for advantage in advantages_full]
-    cumulative_regret = np.sum([advantages[action] for action in legal_actions])
-    matched_regrets = np.array([0.] * self._num_actions)
-
-    if cumulative_regret > 0.:
-      for action in legal_actions:
-        matched_regrets[action] = advantages[action] / cumulative_regret
-    else:
-      matched_regrets[max(legal_actions, key=lambda a: advantages_full[a])] = 1
-
-    return advantages, matched_regrets
+    outputs = self._session.run(
+        self._advantage_outputs, feed_dict={self._info_state_ph: info_states})
+    return np.stack(outputs)[players, np.arange(len(players))]
 
   def action_probabilities(self, state):
     """Returns action probabilities dict for a single batch."""
@@ -373,6 +321,42 @@ class DeepCFRSolver(policy.Policy):
         self._action_probs, feed_dict={self._info_state_ph: info_state_vector})
     return {action: probs[0][action] for action in legal_actions}
 
+  def _tabular_info_states(self):
+    """Returns a `TabularPolicy` of the game, its info state tensors and players."""
+    if self._tabular_states is None:
+      tabular = policy.TabularPolicy(self._game)
+      info_states = np.array(
+          [s.information_state_tensor() for s in tabular.states], np.float32)
+      players = np.array([s.current_player() for s in tabular.states], np.int64)
+      self._tabular_states = tabular, info_states, players
+    return self._tabular_states
+
+  def tabular_average_policy(self):
+    """Returns the strategy network as a `TabularPolicy`.
+
+    Equal to `policy.tabular_policy_from_callable(game, self.action_probabilities)`
+    but computed with one forward over all info states.
+    """
+    tabular, info_states, _ = self._tabular_info_states()
+    probs = self._session.run(
+        self._action_probs, feed_dict={self._info_state_ph: info_states})
+    average_policy = tabular.__copy__(copy_action_probability_array=False)
+    average_policy.action_probability_array = probs * tabular.legal_actions_mask
+    return average_policy
+
+  def tabular_regret_matching_policy(self):
+    """Returns the current strategy of the advantage networks as a `TabularPolicy`.
+
+    Every info state gets the regret matched advantages of its acting player,
+    with all states evaluated in one session run.
+    """
+    tabular, info_states, players = self._tabular_info_states()
+    advantages = self._query_advantages(players, info_states)
+    current_policy = tabular.__copy__(copy_action_probability_array=False)
+    current_policy.action_probability_array = matched_regrets(
+        advantages, tabular.legal_actions_mask)
+    return current_policy
+
   def _learn_advantage_network(self, player):
     """Compute the loss on sampled transitions and perform a Q-network update.
     If there are not enough elements in the buffer, no loss is computed and
@@ -390,24 +374,17 @@ class DeepCFRSolver(policy.Policy):
         samples = self._advantage_memories[player].sample(
             self._batch_size_advantage)
       else:
-        samples = self._advantage_memories[player]
-      info_states = []
-      advantages = []
-      iterations = []
-      for s in samples:
-        info_states.append(s.info_state)
-        advantages.append(s.advantage)
-        iterations.append([s.iteration])
+        samples = self._advantage_memories[player].data
       # Ensure some samples have been gathered.
-      if not info_states:
+      if not len(samples.info_state):
         return None
 
       loss_advantages, _ = self._session.run(
           [self._loss_advantages[player], self._learn_step_advantages[player]],
           feed_dict={
-              self._info_state_ph: np.array(info_states),
-              self._advantage_ph[player]: np.array(advantages),
-              self._iter_ph: np.array(iterations),
+              self._info_state_ph: samples.info_state,
+              self._advantage_ph[player]: samples.advantage,
+              self._iter_ph: samples.iteration[:, None],
           })
     return loss_advantages
 
@@ -423,20 +400,13 @@ class DeepCFRSolver(policy.Policy):
           return None
         samples = self._strategy_memories.sample(self._batch_size_strategy)
       else:
-        samples = self._strategy_memories
-      info_states = []
-      action_probs = []
-      iterations = []
-      for s in samples:
-        info_states.append(s.info_state)
-        action_probs.append(s.strategy_action_probs)
-        iterations.append([s.iteration])
+        samples = self._strategy_memories.data
 
       loss_strategy, _ = self._session.run(
           [self._loss_policy, self._learn_step_policy],
           feed_dict={
-              self._info_state_ph: np.array(info_states),
-              self._action_probs_ph: np.array(np.squeeze(action_probs)),
-              self._iter_ph: np.array(iterations),
+              self._info_state_ph: samples.info_state,
+              self._action_probs_ph: samples.strategy_action_probs,
+              self._iter_ph: samples.iteration[:, None],
           })
     return loss_strategy
@@ -0,0 +1,250 @@
+"""Concurrent game tree traversals for Deep CFR.
+
+A traversal is written as a generator that pauses at every decision node whose
+strategy comes from an advantage network, yielding the query and receiving the
+regret matched strategy. `TraversalEngine` advances many such traversals side by
+side so all of their pending queries are answered with one network forward.
+Engines run in the learner process or, through `TraversalWorkers`, in worker
+processes that only hold `pyspiel` states and exchange queries and memories with
+the learner over pipes.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import multiprocessing
+import numpy as np
+
+import pyspiel
+
+AdvantageMemory = collections.namedtuple(
+    "AdvantageMemory", "info_state iteration advantage action")
+
+StrategyMemory = collections.namedtuple(
+    "StrategyMemory", "info_state iteration strategy_action_probs")
+
+
+def stack_memories(memories, element_type):
+  """Stacks a list of records into one `element_type` of arrays."""
+  if not memories:
+    return element_type(*[np.zeros([0])] * len(element_type._fields))
+  return element_type(*[np.array(column) for column in zip(*memories)])
+
+
+def matched_regrets(advantages, legal_actions_mask):
+  """Regret matching over a batch of advantage rows.
+
+  Args:
+    advantages: [batch, num_actions] advantage network outputs.
+    legal_actions_mask: [batch, num_actions] 1 for legal actions.
+  Returns:
+    [batch, num_actions] strategies. Rows without positive legal regret put all
+    mass on the legal action with the largest advantage.
+  """
+  positive = np.maximum(advantages, 0.) * legal_actions_mask
+  cumulative_regret = positive.sum(axis=1, keepdims=True)
+  greedy = np.argmax(np.where(legal_actions_mask > 0, advantages, -np.inf), axis=1)
+  strategy = np.zeros_like(positive)
+  strategy[np.arange(len(greedy)), greedy] = 1.
+  has_regret = cumulative_regret[:, 0] > 0.
+  strategy[has_regret] = positive[has_regret] / cumulative_regret[has_regret]
+  return strategy
+
+
+class TraversalEngine(object):
+  """Advances many external sampling traversals of one player in lockstep."""
+
+  def __init__(self, game, seed=None):
+    self._game = game
+    self._num_actions = game.num_distinct_actions()
+    self._rng = np.random.RandomState(seed)
+    self._traversals = []
+    self._queries = []
+    self.advantage_memories = []
+    self.strategy_memories = []
+    self.environment_steps = 0
+
+  def start(self, player, iteration, num_traversals):
+    """Starts `num_traversals` traversals and runs them to their first query."""
+    self.advantage_memories = []
+    self.strategy_memories = []
+    self.environment_steps = 0
+    root = self._game.new_initial_state()
+    self._traversals = [
+        self._traverse(root.clone(), player, iteration)
+        for _ in range(num_traversals)
+    ]
+    self._queries = [None] * num_traversals
+    self._advance([None] * num_traversals)
+
+  @property
+  def done(self):
+    return not self._traversals
+
+  def memories(self):
+    """Returns the advantage and strategy memories of the last run, stacked."""
+    return (stack_memories(self.advantage_memories, AdvantageMemory),
+            stack_memories(self.strategy_memories, StrategyMemory))
+
+  def queries(self):
+    """Returns (players, info_states, legal_actions_mask) of the pending queries."""
+    players = np.array([q[0] for q in self._queries], np.int64)
+    info_states = np.array([q[1] for q in self._queries], np.float32)
+    legal_actions_mask = np.zeros([len(self._queries), self._num_actions])
+    for i, q in enumerate(self._queries):
+      legal_actions_mask[i, q[2]] = 1.
+    return players, info_states, legal_actions_mask
+
+  def answer(self, advantages):
+    """Resumes every paused traversal with the advantages of its query."""
+    _, _, legal_actions_mask = self.queries()
+    self._advance(list(matched_regrets(advantages, legal_actions_mask)))
+
+  def _advance(self, strategies):
+    traversals, queries = [], []
+    for traversal, strategy in zip(self._traversals, strategies):
+      try:
+        queries.append(traversal.send(strategy))
+        traversals.append(traversal)
+      except StopIteration:
+        pass
+    self._traversals, self._queries = traversals, queries
+
+  def _traverse(self, state, player, iteration):
+    """External sampling traversal of the game tree for `player`, as a generator.
+
+    Populates the advantage and strategy memories with the sampled regrets and
+    the strategies of the other players. Yields `(player, info_state,
+    legal_actions)` at every decision node, receives the regret matched strategy
+    and returns the expected payoff of `state` for `player`.
+    """
+    self.environment_steps += 1
+    if state.is_terminal():
+      # Terminal state get returns.
+      return state.returns()[player]
+    elif state.is_chance_node():
+      # If this is a chance node, sample an action
+      outcomes = [i[0] for i in state.chance_outcomes()]
+      action = outcomes[self._rng.randint(len(outcomes))]
+      return (yield from self._traverse(state.child(action), player, iteration))
+    elif state.current_player() == player:
+      legal_actions = state.legal_actions()
+      info_state = state.information_state_tensor()
+      strategy = yield player, info_state, legal_actions
+      expected_payoff = {}
+      for action in legal_actions:
+        expected_payoff[action] = yield from self._traverse(
+            state.child(action), player, iteration)
+      cfv = 0
+      for a_ in legal_actions:
+        cfv += strategy[a_] * expected_payoff[a_]
+      sampled_regret_arr = [0] * self._num_actions
+      for action in legal_actions:
+        sampled_regret_arr[action] = expected_payoff[action] - cfv
+      self.advantage_memories.append(
+          AdvantageMemory(info_state, iteration, sampled_regret_arr, action))
+      return cfv
+    else:
+      other_player = state.current_player()
+      info_state = state.information_state_tensor(other_player)
+      strategy = yield other_player, info_state, state.legal_actions(other_player)
+      # Recompute distribution dor numerical errors.
+      probs = np.array(strategy)
+      probs /= probs.sum()
+      sampled_action = self._rng.choice(self._num_actions, p=probs)
+      self.strategy_memories.append(
+          StrategyMemory(info_state, iteration, strategy))
+      return (yield from self._traverse(
+          state.child(sampled_action), player, iteration))
+
+
+def _traversal_worker(game_string, connection, seed):
+  """Worker process loop: traverses on request, sends queries and memories."""
+  engine = TraversalEngine(pyspiel.load_game(game_string), seed)
+  while True:
+    request = connection.recv()
+    if request is None:
+      break
+    engine.start(*request)
+    while not engine.done:
+      connection.send(("query", engine.queries()[:2]))
+      engine.answer(connection.recv())
+    connection.send(("done", engine.memories() + (engine.environment_steps,)))
+  connection.close()
+
+
+class TraversalWorkers(object):
+  """A pool of traversal worker processes driven by one learner.
+
+  `run` splits the traversals of an iteration over the workers. Every round it
+  collects the pending queries of all busy workers, answers them with a single
+  call to `query_fn` and sends each worker its slice back.
+  """
+
+  def __init__(self, game, num_workers, seed=None):
+    rng = np.random.RandomState(seed)
+    # spawn rather than fork, so workers do not inherit the learner's session and
+    # threads. They still re-import `__main__` (and TensorFlow if the main script
+    # imports it) but never build a graph or run a session.
+    context = multiprocessing.get_context("spawn")
+    self._connections = []
+    self._processes = []
+    for _ in range(num_workers):
+      parent, child = context.Pipe()
+      process = context.Process(
+          target=_traversal_worker,
+          args=(str(game), child, rng.randint(2**31)),
+          daemon=True)
+      process.start()
+      child.close()
+      self._connections.append(parent)
+      self._processes.append(process)
+
+  def run(self, player, iteration, num_traversals, query_fn):
+    """Runs the traversals of `player`.
+
+    Args:
+      player: (int) traversing player.
+      iteration: (int) Deep CFR iteration stored with the memories.
+      num_traversals: (int) traversals over all workers.
+      query_fn: maps (players, info_states) to [batch, num_actions] advantages.
+    Returns:
+      Lists of stacked advantage and strategy memories, one batch per worker,
+      and the environment steps.
+    """
+    split = np.array_split(np.arange(num_traversals), len(self._connections))
+    busy = []
+    for connection, share in zip(self._connections, split):
+      if len(share):
+        connection.send((player, iteration, len(share)))
+        busy.append(connection)
+    advantage_memories, strategy_memories, environment_steps = [], [], 0
+    while busy:
+      waiting, players, info_states = [], [], []
+      for connection in busy:
+        kind, message = connection.recv()
+        if kind == "done":
+          advantage_memories.append(message[0])
+          strategy_memories.append(message[1])
+          environment_steps += message[2]
+        else:
+          waiting.append(connection)
+          players.append(message[0])
+          info_states.append(message[1])
+      if waiting:
+        advantages = query_fn(np.concatenate(players), np.concatenate(info_states))
+        ends = np.cumsum([len(p) for p in players])[:-1]
+        for connection, rows in zip(waiting, np.split(advantages, ends)):
+          connection.send(rows)
+      busy = waiting
+    return advantage_memories, strategy_memories, environment_steps
+
+  def close(self):
+    for connection in self._connections:
+      connection.send(None)
+      connection.close()
+    for process in self._processes:
+      process.join()
+    self._connections, self._processes = [], []
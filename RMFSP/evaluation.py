@@ -0,0 +1,222 @@
+"""Head-to-head evaluation of tabulated policies, sharded over worker processes.
+
+The policies to evaluate are `policies.AgentPolicies`, so each worker only receives their
+probability tables and plays many games in lockstep on its own `rl_environment.Environment`
+instances, answering the pending decisions of all games with one table gather.
+
+`EvaluationService` computes NashConv and random-bot matches of such tables in a background
+process, so training only pays for the tabulation of the snapshot.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import multiprocessing
+import queue
+
+import numpy as np
+
+from open_spiel.python import policy
+from open_spiel.python import rl_environment
+import pyspiel
+import best_response
+
+EvalResult = collections.namedtuple(
+    "EvalResult", "mean_reward win_rate mean_reward_ci win_rate_ci rewards")
+
+EvalReport = collections.namedtuple(
+    "EvalReport", "step info nash_conv exploitability random_bots")
+
+
+def _policy_table(policies):
+    """(info state tensors, action probabilities) of every info state of `policies`"""
+    return np.asarray(policies.info_states, np.float32), np.array(policies.tabulate())
+
+
+class _TableLookup(object):
+    def __init__(self, table):
+        info_states, self.probs = table
+        self.rows = {info_state.tobytes(): i for i, info_state in enumerate(info_states)}
+
+    def __call__(self, info_states):
+        return self.probs[[self.rows[np.asarray(s, np.float32).tobytes()] for s in info_states]]
+
+
+def _play_shard(game_string, seat, table, opponent_table, num_episodes, batch_size, seed):
+    """Plays `num_episodes` games with the `table` policy in `seat`, `batch_size` at a time.
+
+    Returns the reward of `seat` in every game.
+    """
+    rng = np.random.RandomState(seed)
+    lookup = _TableLookup(table)
+    opponent = None if opponent_table is None else _TableLookup(opponent_table)
+    envs = [rl_environment.Environment(game_string) for _ in range(min(batch_size, num_episodes))]
+    num_actions = envs[0].action_spec()["num_actions"]
+    rewards = []
+    while len(rewards) < num_episodes:
+        games = envs[:num_episodes - len(rewards)]
+        time_steps = [env.reset() for env in games]
+        episode_rewards = np.zeros(len(games))
+        live = list(range(len(games)))
+        while live:
+            players = np.array([time_steps[i].observations["current_player"] for i in live])
+            info_states = [time_steps[i].observations["info_state"][p] for i, p in zip(live, players)]
+            probs = np.zeros([len(live), num_actions])
+            for j, (i, p) in enumerate(zip(live, players)):
+                probs[j, time_steps[i].observations["legal_actions"][p]] = 1.0  # random bot
+            own = np.nonzero(players == seat)[0]
+            if len(own):
+                probs[own] = lookup([info_states[j] for j in own])
+            if opponent is not None and len(own) < len(live):
+                other = np.nonzero(players != seat)[0]
+                probs[other] = opponent([info_states[j] for j in other])
+            # sample every pending decision at once
+            cum = np.cumsum(probs, axis=1)
+            actions = (cum <= rng.random_sample([len(live), 1]) * cum[:, -1:]).sum(axis=1)
+            still_live = []
+            for i, action in zip(live, actions):
+                time_steps[i] = games[i].step([action])
+                episode_rewards[i] += time_steps[i].rewards[seat]
+                if not time_steps[i].last():
+                    still_live.append(i)
+            live = still_live
+        rewards.extend(episode_rewards)
+    return np.array(rewards)
+
+
+def play_head_to_head(env, policies, num_episodes, opponent_policies=None, num_workers=1,
+                      batch_size=256, seed=None, z=1.96):
+    """Plays `policies` in every seat against `opponent_policies` (uniform random bots if None).
+
+    Args:
+        env: `rl_environment.Environment` of the game.
+        policies: `policies.AgentPolicies` to evaluate.
+        num_episodes: games per seat.
+        opponent_policies: `policies.AgentPolicies` of the opponents, or None for random bots.
+        num_workers: worker processes; 0 plays in this process.
+        batch_size: games advanced in lockstep per worker.
+        seed: seed of the shard seeds.
+        z: normal quantile of the confidence intervals.
+
+    Returns:
+        An `EvalResult` of per-seat arrays: mean reward, win rate (ties count as losses), the
+        half-widths of their confidence intervals and the rewards of every game.
+    """
+    table = _policy_table(policies)
+    opponent_table = None if opponent_policies is None else _policy_table(opponent_policies)
+    return _head_to_head(str(env.game), env.game.num_players(), table, opponent_table,
+                         num_episodes, num_workers, batch_size, seed, z)
+
+
+def _head_to_head(game_string, num_players, table, opponent_table, num_episodes, num_workers,
+                  batch_size, seed, z):
+    rng = np.random.RandomState(seed)
+    shards = []
+    for seat in range(num_players):
+        for episodes in np.array_split(np.arange(num_episodes), max(num_workers, 1)):
+            if len(episodes):
+                shards.append((game_string, seat, table, opponent_table, len(episodes), batch_size,
+                               rng.randint(2 ** 31)))
+    if num_workers:
+        # spawned workers never touch the TensorFlow sessions of the agents
+        with multiprocessing.get_context("spawn").Pool(num_workers) as pool:
+            results = pool.starmap(_play_shard, shards)
+    else:
+        results = [_play_shard(*shard) for shard in shards]
+
+    rewards = [np.concatenate([r for shard, r in zip(shards, results) if shard[1] == seat])
+               for seat in range(num_players)]
+    mean_reward = np.array([r.mean() for r in rewards])
+    win_rate = np.array([(r > 0).mean() for r in rewards])
+    mean_reward_ci = np.array([z * r.std() / np.sqrt(len(r)) for r in rewards])
+    win_rate_ci = z * np.sqrt(win_rate * (1 - win_rate) / num_episodes)
+    return EvalResult(mean_reward, win_rate, mean_reward_ci, win_rate_ci, rewards)
+
+
+def eval_against_random_bots(env, policies, num_episodes, num_workers=1, **kwargs):
+    """Evaluates `policies` against uniform random bots for `num_episodes` per seat."""
+    return play_head_to_head(env, policies, num_episodes, num_workers=num_workers, **kwargs)
+
+
+def _evaluation_worker(game_string, num_episodes, batch_size, seed, z, snapshots, reports):
+    game = pyspiel.load_game(game_string)
+    num_players = game.num_players()
+    tabular = policy.TabularPolicy(game)
+    info_states = np.array([s.information_state_tensor() for s in tabular.states], np.float32)
+    compiled = best_response.compiled_game(game)
+    rng = np.random.RandomState(seed)
+    while True:
+        snapshot = snapshots.get()
+        if snapshot is None:
+            break
+        step, info, probs = snapshot
+        nash_conv = compiled.nash_conv(probs)
+        random_bots = None
+        if num_episodes:
+            random_bots = _head_to_head(game_string, num_players, (info_states, probs), None,
+                                        num_episodes, 0, batch_size, rng.randint(2 ** 31), z)
+        # the games trained here are zero-sum, so exploitability is NashConv per player
+        reports.put(EvalReport(step, info, nash_conv, nash_conv / num_players, random_bots))
+
+
+class EvaluationService(object):
+    """Evaluates policy snapshots in a background process.
+
+    `submit` tabulates the policy (for `AgentPolicies` this includes the `cum_probs` of
+    NFSP_ARM agents) and queues the table; the worker computes NashConv, exploitability and,
+    if `num_episodes` > 0, a random-bot match of `num_episodes` games per seat. Finished
+    `EvalReport`s are collected with `poll`, `wait` or `close`, tagged with the submitted step
+    and keyword info.
+    """
+
+    def __init__(self, game, num_episodes=1000, batch_size=256, seed=None, z=1.96):
+        context = multiprocessing.get_context("spawn")
+        self._snapshots = context.Queue()
+        self._reports = context.Queue()
+        self._pending = 0
+        self._process = context.Process(
+            target=_evaluation_worker,
+            args=(str(game), num_episodes, batch_size, np.random.RandomState(seed).randint(2 ** 31),
+                  z, self._snapshots, self._reports),
+            daemon=True)
+        self._process.start()
+
+    @property
+    def pending(self):
+        """number of submitted snapshots without a collected report"""
+        return self._pending
+
+    def submit(self, step, policies, **info):
+        """Queues the current action probabilities of `policies` (an `AgentPolicies` or a
+        `TabularPolicy` of the game) for evaluation."""
+        tabulate = getattr(policies, "tabulate", None)
+        probs = tabulate() if tabulate is not None else policies.action_probability_array
+        self._snapshots.put((step, info, np.array(probs)))
+        self._pending += 1
+
+    def poll(self):
+        """Returns the reports finished so far, without blocking."""
+        reports = []
+        while self._pending:
+            try:
+                reports.append(self._reports.get_nowait())
+            except queue.Empty:
+                break
+            self._pending -= 1
+        return reports
+
+    def wait(self):
+        """Blocks until every submitted snapshot is evaluated and returns the reports."""
+        reports = []
+        while self._pending:
+            reports.append(self._reports.get())
+            self._pending -= 1
+        return reports
+
+    def close(self):
+        """Returns the outstanding reports and stops the worker."""
+        reports = self.wait()
+        self._snapshots.put(None)
+        self._process.join()
+        return reports
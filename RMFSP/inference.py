@@ -0,0 +1,163 @@
+"""NumPy-only inference of exported NFSP and NFSP_ARM agents.
+
+`nfsp.NFSP.export_inference` and `nfsp_arm.NFSP.export_inference` write the weights of the
+average-policy and Q MLPs (and, for NFSP_ARM, the cumulative probabilities of the average
+policy) to one `.npz` file. `load` rebuilds an `InferenceAgent` from it without TensorFlow,
+with the `batch_action_probs`/`policy_version`/`temp_mode_as` interface of the training
+agents, so it can stand in for them in `policies.AgentPolicies` and in evaluation workers.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import contextlib
+
+import numpy as np
+
+from open_spiel.python import rl_agent
+
+NETWORKS = ("avg", "q")
+
+
+def mlp_layers(network):
+    """The [(w, b), ...] variables of the layers of a `snt.nets.MLP`, to fetch for `save`."""
+    return [(layer.w, layer.b) for layer in network.layers]
+
+
+def save(path, kind, player_id, num_actions, networks, **arrays):
+    """Writes an inference file.
+
+    Args:
+        path: output `.npz` path.
+        kind: "nfsp" or "nfsp_arm".
+        player_id: player of the agent.
+        num_actions: number of distinct actions of the game.
+        networks: dict from a name of `NETWORKS` to the [(w, b), ...] layers of its MLP.
+        **arrays: extra arrays, e.g. the `AveragePolicyTable` of NFSP_ARM as `cum_keys` and
+            `cum_probs`.
+    """
+    for name, layers in networks.items():
+        for i, (w, b) in enumerate(layers):
+            arrays["{}_{}_w".format(name, i)] = w
+            arrays["{}_{}_b".format(name, i)] = b
+    np.savez(path, kind=kind, player_id=player_id, num_actions=num_actions, **arrays)
+
+
+class MLP(object):
+    """Dense ReLU network with a linear output layer, as `snt.nets.MLP`."""
+
+    def __init__(self, layers):
+        self.layers = layers
+
+    def __call__(self, x):
+        x = np.asarray(x, np.float32)
+        for w, b in self.layers[:-1]:
+            x = np.maximum(x.dot(w) + b, 0)
+        w, b = self.layers[-1]
+        return x.dot(w) + b
+
+
+def _normalize(probs, legal_actions_mask):
+    """Rows of `probs` summing to one; rows without mass become uniform over legal actions."""
+    probs_sum = probs.sum(axis=1, keepdims=True)
+    uniform = legal_actions_mask / legal_actions_mask.sum(axis=1, keepdims=True)
+    return np.where(probs_sum > 0, probs / np.where(probs_sum > 0, probs_sum, 1), uniform)
+
+
+class InferenceAgent(object):
+    """Evaluation-only agent of an exported NFSP (`kind` "nfsp") or NFSP_ARM agent.
+
+    The best response of NFSP is greedy in the DQN Q values; the one of NFSP_ARM is the
+    regret-matching policy of the ARM values. The average policy of NFSP is the softmax of
+    the average network; the one of NFSP_ARM is the normalized cumulative probabilities,
+    falling back to the ARM policy for unseen info states without accumulating them.
+    """
+
+    def __init__(self, kind, player_id, num_actions, networks, cum_probs=None):
+        self.kind = kind
+        self.player_id = player_id
+        self.num_actions = num_actions
+        self._networks = networks
+        self._cum_probs = cum_probs
+        self._mode = "average_policy"
+        # exported weights never change
+        self.policy_version = 0
+
+    @contextlib.contextmanager
+    def temp_mode_as(self, mode):
+        """Temporarily switches to `mode`, a `MODE` member of nfsp/nfsp_arm or its name."""
+        previous_mode = self._mode
+        self._mode = getattr(mode, "name", mode)
+        yield
+        self._mode = previous_mode
+
+    @property
+    def mode(self):
+        return self._mode
+
+    def _best_response_probs(self, info_states, legal_actions_mask):
+        q_values = self._networks["q"](info_states)
+        if self.kind == "nfsp_arm":
+            # the last output of the ARM network is the state value
+            action_values = np.maximum(
+                q_values[:, :self.num_actions] - q_values[:, self.num_actions:], 0) * legal_actions_mask
+            return _normalize(action_values, legal_actions_mask)
+        legal_q_values = np.where(legal_actions_mask > 0, q_values, -np.inf)
+        probs = np.zeros(legal_actions_mask.shape)
+        probs[np.arange(len(probs)), np.argmax(legal_q_values, axis=1)] = 1.0
+        return probs
+
+    def batch_action_probs(self, info_states, legal_actions_mask):
+        """Action probabilities of the current mode for a batch of info states."""
+        info_states = np.asarray(info_states, np.float32).reshape([len(legal_actions_mask), -1])
+        legal_actions_mask = np.asarray(legal_actions_mask, np.float64)
+        if self._mode == "best_response":
+            return self._best_response_probs(info_states, legal_actions_mask)
+        if self.kind == "nfsp":
+            logits = self._networks["avg"](info_states)
+            probs = np.exp(logits - logits.max(axis=1, keepdims=True)) * legal_actions_mask
+            return probs / probs.sum(axis=1, keepdims=True)
+        rows, cum_probs = self._cum_probs
+        rows = np.array([rows.get(s.tobytes(), -1) for s in info_states], np.int64)
+        known = rows >= 0
+        legal_p_values = np.zeros(legal_actions_mask.shape)
+        legal_p_values[known] = cum_probs[rows[known]] * legal_actions_mask[known]
+        p_values_sum = legal_p_values.sum(axis=1, keepdims=True)
+        accumulated = p_values_sum[:, 0] > 0
+        probs = np.zeros(legal_actions_mask.shape)
+        probs[accumulated] = legal_p_values[accumulated] / p_values_sum[accumulated]
+        if not accumulated.all():
+            probs[~accumulated] = self._best_response_probs(info_states[~accumulated],
+                                                            legal_actions_mask[~accumulated])
+        return probs
+
+    def step(self, time_step, is_evaluation=True):
+        """Samples an action of the current mode; the agent does not learn."""
+        if time_step.last():
+            return None
+        info_state = time_step.observations["info_state"][self.player_id]
+        legal_actions = time_step.observations["legal_actions"][self.player_id]
+        legal_actions_mask = np.zeros([1, self.num_actions])
+        legal_actions_mask[0, legal_actions] = 1.0
+        probs = self.batch_action_probs([info_state], legal_actions_mask)[0]
+        action = np.random.choice(len(probs), p=probs)
+        return rl_agent.StepOutput(action=action, probs=probs)
+
+
+def load(path):
+    """Returns the `InferenceAgent` of a file written by `save`."""
+    with np.load(path) as data:
+        networks = {}
+        for name in NETWORKS:
+            layers = []
+            while "{}_{}_w".format(name, len(layers)) in data:
+                i = len(layers)
+                layers.append((data["{}_{}_w".format(name, i)], data["{}_{}_b".format(name, i)]))
+            if layers:
+                networks[name] = MLP(layers)
+        cum_probs = None
+        if "cum_keys" in data:
+            rows = {key.tobytes(): i for i, key in enumerate(data["cum_keys"])}
+            cum_probs = (rows, data["cum_probs"])
+        return InferenceAgent(str(data["kind"]), int(data["player_id"]), int(data["num_actions"]),
+                              networks, cum_probs)
@@ -2,17 +2,13 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-from abc import ABC
-
 from absl import app
 from absl import flags
 from absl import logging
 import tensorflow as tf
 
-from open_spiel.python import policy
 from open_spiel.python import rl_environment
 from open_spiel.python.algorithms import exploitability
-from open_spiel.python.algorithms import nfsp
 from open_spiel.python.algorithms import random_agent
 import arm_tf
 import numpy as np
@@ -20,7 +16,8 @@ import matplotlib.pyplot as plt
 import datetime
 import time
 import nfsp_arm
-import pickle
+from policies import NFSPPolicies, ARMPolicies
+from evaluation import EvaluationService
 
 FLAGS = flags.FLAGS
 
@@ -42,128 +39,6 @@ flags.DEFINE_float("anticipatory_param", 0.5,  # 0.1 origin
                    "Prob of using the rl best response as episode policy.")
 
 
-class NFSPPolicies(policy.Policy, ABC):
-    """Joint policy to be evaluated."""
-
-    def __init__(self, env, nfsp_policies, mode):
-        game = env.game
-        player_ids = [0, 1]
-        super(NFSPPolicies, self).__init__(game, player_ids)
-        self._policies = nfsp_policies
-        self._mode = mode
-        self._obs = {"info_state": [None, None], "legal_actions": [None, None]}
-
-    def action_probabilities(self, state, player_id=None):
-        cur_player = state.current_player()
-        legal_actions = state.legal_actions(cur_player)
-
-        self._obs["current_player"] = cur_player
-        self._obs["info_state"][cur_player] = (
-            state.information_state_tensor(cur_player))
-        self._obs["legal_actions"][cur_player] = legal_actions
-
-        info_state = rl_environment.TimeStep(
-            observations=self._obs, rewards=None, discounts=None, step_type=None)
-
-        # if cur_player == 0:
-        with self._policies[cur_player].temp_mode_as(self._mode):
-            p = self._policies[cur_player].step(info_state, is_evaluation=True).probs
-            prob_dict = {action: p[action] for action in legal_actions}
-        # else:
-        #     p = self._policies[cur_player].step(info_state, is_evaluation=True).probs
-
-        # print(prob_dict)
-        return prob_dict
-
-
-class ARMPolicies(policy.Policy, ABC):
-    """Joint policy to be evaluated."""
-
-    def __init__(self, env, arm_policies, mode):
-        game = env.game
-        player_ids = [0, 1]
-        super(ARMPolicies, self).__init__(game, player_ids)
-        self._policies = arm_policies
-        self._mode = mode
-        self._obs = {"info_state": [None, None], "legal_actions": [None, None]}
-
-    def action_probabilities(self, state, player_id=None):
-        cur_player = state.current_player()
-        legal_actions = state.legal_actions(cur_player)
-
-        self._obs["current_player"] = cur_player
-        self._obs["info_state"][cur_player] = (
-            state.information_state_tensor(cur_player))
-        self._obs["legal_actions"][cur_player] = legal_actions
-
-        info_state = rl_environment.TimeStep(
-            observations=self._obs, rewards=None, discounts=None, step_type=None)
-
-        p = self._policies[cur_player].step(info_state, is_evaluation=True).probs
-        prob_dict = {action: p[action] for action in legal_actions}
-        return prob_dict
-
-
-def eval_against_random_bots(env, trained_agents, random_agents, num_episodes):
-    """Evaluates `trained_agents` against `random_agents` for `num_episodes`."""
-    num_players = len(trained_agents)
-    sum_episode_rewards = np.zeros(num_players)
-    win_rate = np.zeros(num_players)
-    for player_pos in range(num_players):
-        count_vic = 0
-        cur_agents = random_agents[:]
-        cur_agents[player_pos] = trained_agents[player_pos]
-        for _ in range(num_episodes):
-            time_step = env.reset()
-            episode_rewards = 0
-            while not time_step.last():
-                player_id = time_step.observations["current_player"]
-                if player_pos == player_id:
-                    with cur_agents[player_id].temp_mode_as(nfsp_arm.MODE.average_policy):
-                        agent_output = cur_agents[player_id].step(time_step, is_evaluation=True)
-                else:
-                    agent_output = cur_agents[player_id].step(time_step, is_evaluation=True)
-                action_list = [agent_output.action]
-                time_step = env.step(action_list)
-                episode_rewards += time_step.rewards[player_pos]
-            if episode_rewards > 0:
-                episode_rewards = 1.0
-                count_vic = count_vic + 1
-            elif episode_rewards < 0:
-                episode_rewards = -1.0
-            elif episode_rewards == 0:
-                episode_rewards = 0
-                count_vic = count_vic + 1
-            sum_episode_rewards[player_pos] += episode_rewards
-            win_rate[player_pos] = count_vic
-    return sum_episode_rewards / num_episodes, win_rate / num_episodes
-
-
-def eval_against_random_bots_nfsp_arm(env, trained_agents, random_agents, num_episodes):
-    """Evaluates `trained_agents` against `random_agents` for `num_episodes`."""
-    num_players = len(trained_agents)
-    sum_episode_rewards = np.zeros(num_players)
-    for player_pos in range(num_players):
-        cur_agents = random_agents[:]
-        cur_agents[player_pos] = trained_agents[player_pos]
-        for _ in range(num_episodes):
-            time_step = env.reset()
-            episode_rewards = 0
-            while not time_step.last():
-                player_id = time_step.observations["current_player"]
-                if hasattr(cur_agents[player_id], 'tag') and cur_agents[player_id].tag() == "nfsp_arm":
-                    with cur_agents[player_id].temp_mode_as(nfsp_arm.MODE.average_policy):
-                        agent_output = cur_agents[player_id].step(time_step, is_evaluation=True)
-                else:
-                    with cur_agents[player_id].temp_mode_as(nfsp.MODE.average_policy):
-                        agent_output = cur_agents[player_id].step(time_step, is_evaluation=True)
-                action_list = [agent_output.action]
-                time_step = env.step(action_list)
-                episode_rewards += time_step.rewards[player_pos]
-            sum_episode_rewards[player_pos] += episode_rewards
-    return sum_episode_rewards / num_episodes
-
-
 def main(unused_argv):
     start_time = time.time()
     game = "leduc_poker"
@@ -232,7 +107,28 @@ def main(unused_argv):
 
         exploit = []
         exploit_iter = []
-        exploit_arm = []
+        # exploitability and random-bot matches run in a background process
+        evaluator = EvaluationService(env.game, num_episodes=1000)
+
+        def log_report(report):
+            info = report.info
+            if "iteration" in info:
+                print("Iteration {} NFSP_ARM Exploitability: {}".format(info["iteration"], report.exploitability))
+                exploit_iter.append(report.exploitability)
+                with open("log/{}_iter_ex.txt".format(file), 'a+') as f:
+                    f.write("{}: {}\n".format(report.step, report.exploitability))
+                return
+            result = report.random_bots
+            r_mean = (result.mean_reward, result.win_rate)
+            print("{} NFSP_ARM Exploitability AVG {}".format(report.step, report.exploitability))
+            print("Against Random_Bots: ", r_mean, "+-", (result.mean_reward_ci, result.win_rate_ci))
+            print("_____________________________________________")
+            exploit.append(report.exploitability)
+            with open("log/{}_ex.txt".format(file), 'a+') as f:
+                f.write("{}, {}, {}: {}\n".format(report.step, info["step_counter"], info["cost"], report.exploitability))
+            with open("log/{}_ex(arm).txt".format(file), 'a+') as f:
+                f.write("{}, {}: {}\n".format(report.step, info["cost"], r_mean))
+
         print('start training nsfp_arm...')
         file = 'nsfp_agents_1_15_nfsp_arm'
         step_counter = 0
@@ -256,11 +152,8 @@ def main(unused_argv):
             if (ep + 1) % 500000 == 0:
                 saver.save(sess, "./Model_NFSP_ARM_LD_1116/model.ckpt", global_step=ep + 1)
 
-                with open('./Model_NFSP_ARM_LD_1116/agent_0' + str(ep + 1) + '.pkl', 'wb') as f:
-                    pickle.dump(agents[0].cum_prob, f, pickle.HIGHEST_PROTOCOL)
-
-                with open('./Model_NFSP_ARM_LD_1116/agent_1' + str(ep + 1) + '.pkl', 'wb') as f:
-                    pickle.dump(agents[1].cum_prob, f, pickle.HIGHEST_PROTOCOL)
+                agents[0].cum_prob.save('./Model_NFSP_ARM_LD_1116/agent_0' + str(ep + 1) + '.npz')
+                agents[1].cum_prob.save('./Model_NFSP_ARM_LD_1116/agent_1' + str(ep + 1) + '.npz')
 
             if (ep + 1) % FLAGS.eval_every == 0:
                 ep_time = time.time()
@@ -271,27 +164,11 @@ def main(unused_argv):
                 # q_pluses_all = [agent.q_plus_all for agent in nfsp_agents]
                 print("Losses: {}".format(losses))
                 # print("Advantages: {}".format(q_pluses_all))
-                expl = exploitability.exploitability(env.game, expl_policies_avg)
-                # add arm
-                expl_arm = None
-                # expl_arm = exploitability.exploitability(env.game, expl_policies_avg_1)
-                print("{} NFSP_ARM Exploitability AVG {}".format(ep + 1, expl))
-                # print("{} ARM Exploitability AVG {}".format(ep + 1, expl_arm))
-                random_agents = [
-                    random_agent.RandomAgent(player_id=idx, num_actions=num_actions)
-                    for idx in range(num_players)
-                ]
-                r_mean = eval_against_random_bots(env, agents, random_agents, 1000)
-                print("Against Random_Bots: ", r_mean)
-                print("_____________________________________________")
-                exploit.append(expl)
-                exploit_arm.append(expl_arm)
                 with open("log/{}_loss.txt".format(file), 'a+') as f:
                     f.write("{}: {}\n".format(cost, losses))
-                with open("log/{}_ex.txt".format(file), 'a+') as f:
-                    f.write("{}, {}: {}\n".format(step_counter, cost, expl))
-                with open("log/{}_ex(arm).txt".format(file), 'a+') as f:
-                    f.write("{}: {}\n".format(cost, r_mean))
+                evaluator.submit(ep + 1, expl_policies_avg, step_counter=step_counter, cost=cost)
+                for report in evaluator.poll():
+                    log_report(report)
 
                 # with open("log/{}_q_plus.txt".format(file), 'a+') as f:
                 #     f.write("{}\n".format(q_pluses))
@@ -328,6 +205,9 @@ def main(unused_argv):
             #         # print("{}: [{}]{}".format(ep, agent.player_id, arm_loss))
             #         agent._replay_buffer.clear()
 
+        for report in evaluator.close():
+            log_report(report)
+
         plt.figure()
         plt.plot(exploit)
         plt.plot(exploit_iter)
@@ -335,11 +215,8 @@ def main(unused_argv):
 
         saver.save(sess, "./Model_NFSP_ARM_1218/model.ckpt")
 
-        with open('./Model_NFSP_ARM_1218/agent_0.pkl', 'wb') as f:
-            pickle.dump(agents[0].cum_prob, f, pickle.HIGHEST_PROTOCOL)
-
-        with open('./Model_NFSP_ARM_1218/agent_1.pkl', 'wb') as f:
-            pickle.dump(agents[1].cum_prob, f, pickle.HIGHEST_PROTOCOL)
+        agents[0].cum_prob.save('./Model_NFSP_ARM_1218/agent_0.npz')
+        agents[1].cum_prob.save('./Model_NFSP_ARM_1218/agent_1.npz')
 
         # for i in range(1000):
         #     r_mean = eval_against_random_bots_nfsp_arm(env, nfsp_agents, arm_agents, 1000)
@@ -2,20 +2,18 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-from abc import ABC
-
 from absl import app
 from absl import flags
 from absl import logging
 import tensorflow as tf
 
-from open_spiel.python import policy
 from open_spiel.python import rl_environment
 from open_spiel.python.algorithms import exploitability
 # from open_spiel.python.algorithms import nfsp
 import arm_tf
 import nfsp_arm
 import nfsp
+from policies import NFSPPolicies
 
 import matplotlib.pyplot as plt
 
@@ -36,35 +34,6 @@ flags.DEFINE_float("anticipatory_param", 0.5,
                    "Prob of using the rl best response as episode policy.")
 
 
-class NFSPPolicies(policy.Policy, ABC):
-    """Joint policy to be evaluated."""
-
-    def __init__(self, env, nfsp_policies, mode):
-        game = env.game
-        player_ids = [0, 1]
-        super(NFSPPolicies, self).__init__(game, player_ids)
-        self._policies = nfsp_policies
-        self._mode = mode
-        self._obs = {"info_state": [None, None], "legal_actions": [None, None]}
-
-    def action_probabilities(self, state, player_id=None):
-        cur_player = state.current_player()
-        legal_actions = state.legal_actions(cur_player)
-
-        self._obs["current_player"] = cur_player
-        self._obs["info_state"][cur_player] = (
-            state.information_state_tensor(cur_player))
-        self._obs["legal_actions"][cur_player] = legal_actions
-
-        info_state = rl_environment.TimeStep(
-            observations=self._obs, rewards=None, discounts=None, step_type=None)
-
-        with self._policies[cur_player].temp_mode_as(self._mode):
-            p = self._policies[cur_player].step(info_state, is_evaluation=True).probs
-            prob_dict = {action: p[action] for action in legal_actions}
-        return prob_dict
-
-
 def main(unused_argv):
     game = "leduc_poker"
     num_players = 2
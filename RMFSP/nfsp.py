@@ -23,7 +23,6 @@ from __future__ import print_function
 
 import collections
 import contextlib
-import random
 import enum
 import numpy as np
 import sonnet as snt
@@ -31,6 +30,8 @@ import tensorflow as tf
 
 from open_spiel.python import rl_agent
 from open_spiel.python.algorithms import dqn
+import inference
+from reservoir_buffer import ReservoirBuffer
 
 Transition = collections.namedtuple(
     "Transition", "info_state action_probs legal_actions_mask")
@@ -71,12 +72,19 @@ class NFSP(rl_agent.AbstractAgent):
     self._anticipatory_param = anticipatory_param
     self._min_buffer_size_to_learn = min_buffer_size_to_learn
 
-    self._reservoir_buffer = ReservoirBuffer(reservoir_buffer_capacity)
+    self._reservoir_buffer = ReservoirBuffer(
+        reservoir_buffer_capacity, Transition,
+        shapes={"info_state": [state_representation_size],
+                "action_probs": [num_actions],
+                "legal_actions_mask": [num_actions]})
     self._prev_timestep = None
     self._prev_action = None
 
     # Step counter to keep track of learning.
     self._step_counter = 0
+    # Bumped on every training step, the dqn may learn inside its own step. See
+    # `policies.AgentPolicies`.
+    self.policy_version = 0
 
     # Inner RL agent
     kwargs.update({
@@ -157,6 +165,22 @@ class NFSP(rl_agent.AbstractAgent):
     action = np.random.choice(len(probs), p=probs)
     return action, probs
 
+  def batch_action_probs(self, info_states, legal_actions_mask):
+    """Probabilities of `step(..., is_evaluation=True)` in the current mode for a batch."""
+    if self._mode == MODE.best_response:
+      # greedy over the legal q values, as the dqn acts with epsilon 0
+      q_values = self._session.run(
+          self._rl_agent.q_values,
+          feed_dict={self._rl_agent.info_state_ph: info_states})
+      legal_q_values = np.where(legal_actions_mask > 0, q_values, -np.inf)
+      probs = np.zeros(legal_actions_mask.shape)
+      probs[np.arange(len(probs)), np.argmax(legal_q_values, axis=1)] = 1.0
+      return probs
+    action_probs = self._session.run(
+        self._avg_policy_probs, feed_dict={self._info_state_ph: info_states})
+    probs = action_probs * legal_actions_mask
+    return probs / probs.sum(axis=1, keepdims=True)
+
   @property
   def mode(self):
     return self._mode
@@ -196,6 +220,7 @@ class NFSP(rl_agent.AbstractAgent):
 
     if not is_evaluation:
       self._step_counter += 1
+      self.policy_version += 1
 
       if self._step_counter % self._learn_every == 0:
         self._last_sl_loss_value = self._learn()
@@ -247,71 +272,21 @@ class NFSP(rl_agent.AbstractAgent):
       return None
 
     transitions = self._reservoir_buffer.sample(self._batch_size)
-    info_states = [t.info_state for t in transitions]
-    action_probs = [t.action_probs for t in transitions]
-    legal_actions_mask = [t.legal_actions_mask for t in transitions]
 
     loss, _ = self._session.run(
         [self._loss, self._learn_step],
         feed_dict={
-            self._info_state_ph: info_states,
-            self._action_probs_ph: action_probs,
-            self._legal_actions_mask_ph: legal_actions_mask,
+            self._info_state_ph: transitions.info_state,
+            self._action_probs_ph: transitions.action_probs,
+            self._legal_actions_mask_ph: transitions.legal_actions_mask,
         })
     return loss
 
-
-class ReservoirBuffer(object):
-  """Allows uniform sampling over a stream of data.
-
-  This class supports the storage of arbitrary elements, such as observation
-  tensors, integer actions, etc.
-
-  See https://en.wikipedia.org/wiki/Reservoir_sampling for more details.
-  """
-
-  def __init__(self, reservoir_buffer_capacity):
-    self._reservoir_buffer_capacity = reservoir_buffer_capacity
-    self._data = []
-    self._add_calls = 0
-
-  def add(self, element):
-    """Potentially adds `element` to the reservoir buffer.
-
-    Args:
-      element: data to be added to the reservoir buffer.
-    """
-    if len(self._data) < self._reservoir_buffer_capacity:
-      self._data.append(element)
-    else:
-      idx = np.random.randint(0, self._add_calls + 1)
-      if idx < self._reservoir_buffer_capacity:
-        self._data[idx] = element
-    self._add_calls += 1
-
-  def sample(self, num_samples):
-    """Returns `num_samples` uniformly sampled from the buffer.
-
-    Args:
-      num_samples: `int`, number of samples to draw.
-
-    Returns:
-      An iterable over `num_samples` random elements of the buffer.
-
-    Raises:
-      ValueError: If there are less than `num_samples` elements in the buffer
-    """
-    if len(self._data) < num_samples:
-      raise ValueError("{} elements could not be sampled from size {}".format(
-          num_samples, len(self._data)))
-    return random.sample(self._data, num_samples)
-
-  def clear(self):
-    self._data = []
-    self._add_calls = 0
-
-  def __len__(self):
-    return len(self._data)
-
-  def __iter__(self):
-    return iter(self._data)
+  def export_inference(self, path):
+    """Writes the average-policy and Q network weights for `inference.load`."""
+    # the dqn keeps its network private; its layers are plain sonnet variables
+    networks = self._session.run({
+        "avg": inference.mlp_layers(self._avg_network),
+        "q": inference.mlp_layers(self._rl_agent._q_network),
+    })
+    inference.save(path, "nfsp", self.player_id, self._num_actions, networks)
@@ -4,7 +4,6 @@ from __future__ import print_function
 
 import collections
 import contextlib
-import random
 import enum
 import numpy as np
 import sonnet as snt
@@ -13,6 +12,8 @@ import tensorflow as tf
 from open_spiel.python import rl_agent
 from open_spiel.python.algorithms import dqn
 import arm_tf
+import inference
+from reservoir_buffer import ReservoirBuffer
 
 Transition = collections.namedtuple(
     "Transition", "info_state action_probs legal_actions_mask")
@@ -42,6 +43,7 @@ class NFSP(rl_agent.AbstractAgent):
                  min_buffer_size_to_learn=3000,
                  learn_every=64,
                  optimizer_str="adam",
+                 retained_iterations=1,
                  **kwargs):
         """Initialize the `NFSP` agent."""
         self.player_id = player_id
@@ -53,7 +55,12 @@ class NFSP(rl_agent.AbstractAgent):
         self._anticipatory_param = anticipatory_param
         self._min_buffer_size_to_learn = min_buffer_size_to_learn
 
-        self._reservoir_buffer = ReservoirBuffer(reservoir_buffer_capacity)
+        self._reservoir_buffer = ReservoirBuffer(
+            reservoir_buffer_capacity, Transition,
+            shapes={"info_state": [state_representation_size],
+                    "action_probs": [num_actions],
+                    "legal_actions_mask": [num_actions]},
+            dtypes={"action_probs": np.float64})
         self._prev_timestep = None
         self._prev_action = None
         self.q_plus = 0.
@@ -61,7 +68,9 @@ class NFSP(rl_agent.AbstractAgent):
 
         # Step counter to keep track of learning.
         self._step_counter = 0
-        self._cum_probs = {}
+        self._cum_probs = AveragePolicyTable(num_actions)
+        # Bumped whenever the policy of either mode changes, see `policies.AgentPolicies`.
+        self.policy_version = 0
 
         # Inner RL agent
         kwargs.update({
@@ -77,6 +86,7 @@ class NFSP(rl_agent.AbstractAgent):
             "epsilon_decay_duration": int(3e6),
             "epsilon_start": 0.06,
             "epsilon_end": 0.001,
+            "retained_iterations": retained_iterations,
         }
 
         self._rl_agent = arm_tf.ARM(session, player_id, state_representation_size,
@@ -174,10 +184,41 @@ class NFSP(rl_agent.AbstractAgent):
 
     @property
     def rl_buffer_len(self):
-        return len(self._rl_agent.replay_buffer)
+        return self._rl_agent.new_transitions
 
     def restore_cum_probs(self, cum):
+        """`cum` is an `AveragePolicyTable` or a path written by `AveragePolicyTable.save`."""
+        if not isinstance(cum, AveragePolicyTable):
+            cum = AveragePolicyTable.load(cum)
         self._cum_probs = cum
+        self.policy_version += 1
+
+    def batch_action_probs(self, info_states, legal_actions_mask):
+        """Probabilities of `step(..., is_evaluation=True)` in the current mode for a batch.
+
+    As in `step`, average policy queries of info states without accumulated probabilities
+    are answered by the rl agent, whose answers are accumulated into the table.
+    """
+        if self._mode == MODE.best_response:
+            return self._rl_agent.batch_action_probs(info_states, legal_actions_mask)
+        rows = self._cum_probs.rows(info_states)
+        probs = np.zeros(legal_actions_mask.shape)
+        known = np.nonzero(rows >= 0)[0]
+        legal_p_values = self._cum_probs.cum_probs[rows[known]] * legal_actions_mask[known]
+        p_values_sum = legal_p_values.sum(axis=1, keepdims=True)
+        accumulated = p_values_sum[:, 0] > 0
+        probs[known[accumulated]] = legal_p_values[accumulated] / p_values_sum[accumulated]
+
+        fallback = np.ones(len(rows), bool)
+        fallback[known[accumulated]] = False
+        if fallback.any():
+            rl_probs = self._rl_agent.batch_action_probs(info_states[fallback], legal_actions_mask[fallback])
+            probs[fallback] = rl_probs
+            empty = rows[fallback] >= 0
+            self._cum_probs.cum_probs[rows[fallback][empty]] += rl_probs[empty] * 10
+            if not empty.all():
+                self._cum_probs.add_batch(info_states[fallback][~empty], rl_probs[~empty])
+        return probs
 
     def step(self, time_step, is_evaluation=False):
         """Returns the action to be taken and updates the Q-networks if needed.
@@ -201,53 +242,32 @@ class NFSP(rl_agent.AbstractAgent):
                 info_state = time_step.observations["info_state"][self.player_id]
                 legal_actions = time_step.observations["legal_actions"][self.player_id]
                 ret_probs = np.zeros(self._num_actions)
-                info_state = np.reshape(info_state, [1, -1])
                 # print("In ap: ", info_state)
 
-                if str(info_state) in self._cum_probs:
-                    action_values = self._cum_probs[str(info_state)]
+                row = self._cum_probs.row(info_state)
+                if row is not None:
+                    action_values = self._cum_probs.cum_probs[row]
                     legal_p_values = action_values[legal_actions]
                     p_values_sum = np.sum(legal_p_values)
                     if p_values_sum:
                         action_prob = legal_p_values / p_values_sum
-                        for action in legal_actions:
-                            ret_probs[action] = action_values[action] / p_values_sum
+                        ret_probs[legal_actions] = action_prob
 
                         chosed_legal_action = np.random.choice(range(action_prob.shape[0]), p=action_prob.ravel())
                         action = legal_actions[chosed_legal_action]
                         agent_output = rl_agent.StepOutput(action=action, probs=ret_probs)
                     else:  # rl_output or 1/n? ignore
-                        # print("In Else_2")
-                        # print("in else_3")
                         # action, probs = self._act(info_state, legal_actions)
                         # agent_output = rl_agent.StepOutput(action=action, probs=probs)
                         agent_output = self._rl_agent.step(time_step, is_evaluation)
                         if agent_output is not None:
-                            # print("Not none")
                             ### avg_strategy
-                            info_state = time_step.observations["info_state"][self.player_id]
-                            info_state = np.reshape(info_state, [1, -1])
-                            probabilities = agent_output.probs
-                            if str(info_state) not in self._cum_probs.keys():
-                                self._cum_probs[str(info_state)] = probabilities
-                            else:
-                                for i in range(self._num_actions):
-                                    self._cum_probs[str(info_state)][i] += probabilities[i] * 10
+                            self._cum_probs.cum_probs[row] += agent_output.probs * 10
                 else:
-                    # print("In Else")
                     agent_output = self._rl_agent.step(time_step, is_evaluation=True)
                     if agent_output is not None:
-                        # print("Not none")
                         ### avg_strategy
-                        info_state = time_step.observations["info_state"][self.player_id]
-                        info_state = np.reshape(info_state, [1, -1])
-                        probabilities = agent_output.probs
-                        if str(info_state) not in self._cum_probs.keys():
-                            self._cum_probs[str(info_state)] = probabilities
-                        else:
-                            # print("In else_3")
-                            for i in range(self._num_actions):
-                                self._cum_probs[str(info_state)][i] += probabilities[i]
+                        self._cum_probs.add(info_state, agent_output.probs)
 
             if self._prev_timestep and not is_evaluation:
                 self._rl_agent.add_transition(self._prev_timestep, self._prev_action, time_step)
@@ -298,38 +318,39 @@ class NFSP(rl_agent.AbstractAgent):
         legal_actions_mask = np.zeros(self._num_actions)
         legal_actions_mask[legal_actions] = 1.0
         info_state = time_step.observations["info_state"][self.player_id]
-        info_state_2 = np.reshape(info_state, [1, -1])
-        # print(info_state, info_state_2)
         transition = Transition(
-            info_state=info_state_2,  # (time_step.observations["info_state"][self.player_id][:])
+            info_state=info_state,
             action_probs=agent_output.probs,
             legal_actions_mask=legal_actions_mask)
         self._reservoir_buffer.add(transition)
 
     def learn(self):
         # print("Min buffer: ", self._min_buffer_size_to_learn)
-        if len(self._rl_agent.replay_buffer) < self._min_buffer_size_to_learn:
+        if self._rl_agent.new_transitions < self._min_buffer_size_to_learn:
             return None
         # update rl_agent
         loss = self._rl_agent.learn()
+        self.policy_version += 1
 
         # update average policy
-        for element in self._reservoir_buffer.data:
-            info_state = element.info_state
-            action_probs = element.action_probs
-            legal_actions_mask = element.legal_actions_mask
-            info_state_2 = np.reshape(info_state, [1, -1])
-            # print(info_state, info_state_2)
-            probabilities = action_probs
-            if str(info_state) not in self._cum_probs.keys():
-                self._cum_probs[str(info_state)] = probabilities
-            else:
-                for i in range(self._num_actions):
-                    self._cum_probs[str(info_state)][i] += probabilities[i]
+        if len(self._reservoir_buffer):
+            data = self._reservoir_buffer.data
+            self._cum_probs.add_batch(data.info_state, data.action_probs)
         self._reservoir_buffer.clear()
 
         return loss
 
+    def export_inference(self, path):
+        """Writes the average-policy and ARM network weights and the cumulative probabilities
+        of the average policy for `inference.load`."""
+        networks = self._session.run({
+            "avg": inference.mlp_layers(self._avg_network),
+            "q": inference.mlp_layers(self._rl_agent.q_network),
+        })
+        keys, cum_probs = self._cum_probs.arrays()
+        inference.save(path, "nfsp_arm", self.player_id, self._num_actions, networks,
+                       cum_keys=keys, cum_probs=cum_probs)
+
     def param_out(self):
         print(self._rl_agent.step_counter, len(self._rl_agent.replay_buffer), self.mode, self._br_count, self._ap_count)
 
@@ -337,57 +358,143 @@ class NFSP(rl_agent.AbstractAgent):
         return "nfsp_arm"
 
 
-class ReservoirBuffer(object):
-    """Allows uniform sampling over a stream of data.
-
-  This class supports the storage of arbitrary elements, such as observation
-  tensors, integer actions, etc.
+class AveragePolicyTable(object):
+    """Cumulative action probabilities of the average policy, one row per info state.
 
-  See https://en.wikipedia.org/wiki/Reservoir_sampling for more details.
+  Info states are keyed by the bytes of their float32 tensor, which is exact and does not
+  depend on how numpy prints the array. Rows are found through a sorted index of 64 bit
+  hashes of the keys; a stored key that shares the hash of a different info state is
+  caught by comparing the bytes, two new info states of one batch sharing a hash (about
+  n^2 / 2^65 for n distinct states) would be merged.
   """
 
-    def __init__(self, reservoir_buffer_capacity):
-        self._reservoir_buffer_capacity = reservoir_buffer_capacity
-        self.data = []
-        self._add_calls = 0
-
-    def add(self, element):
-        """Potentially adds `element` to the reservoir buffer.
+    def __init__(self, num_actions, capacity=1024):
+        self._size = 0
+        # [capacity, key bytes] info state keys, allocated with the first info state
+        self._keys = None
+        # hashes of the stored keys in ascending order and the row of each of them
+        self._hashes = np.zeros([0], np.uint64)
+        self._hash_rows = np.zeros([0], np.int64)
+        self._multipliers = None
+        self.cum_probs = np.zeros([capacity, num_actions])
+
+    @staticmethod
+    def key(info_state):
+        return np.asarray(info_state, np.float32).tobytes()
+
+    def _hash(self, info_states):
+        """64 bit hashes of the rows of a [n, state_size] float32 array."""
+        if info_states.shape[1] % 2:
+            info_states = np.concatenate([info_states, np.zeros([len(info_states), 1], np.float32)], axis=1)
+        words = info_states.view(np.uint64)
+        if self._multipliers is None:
+            # odd random multipliers of a multilinear hash over the 8 byte words of a key
+            self._multipliers = np.random.RandomState(0).randint(
+                1, 2 ** 62, size=words.shape[1]).astype(np.uint64) | np.uint64(1)
+        # fold the high half of every word into its low bits first, products only carry upwards
+        mixed = words >> np.uint64(29)
+        mixed ^= words
+        return mixed @ self._multipliers
+
+    def _lookup(self, info_states, hashes):
+        """Rows of info states with the given `hashes`, -1 for those never accumulated."""
+        positions = np.minimum(np.searchsorted(self._hashes, hashes), max(self._size - 1, 0))
+        rows = np.full([len(hashes)], -1, np.int64)
+        if self._size:
+            found = self._hashes[positions] == hashes
+            rows[found] = self._hash_rows[positions[found]]
+            assert (self._keys[rows[found]] == info_states[found].view(np.uint8)).all(), \
+                "info states with the same hash"
+        return rows
+
+    def _insert(self, info_states, hashes):
+        """Appends rows for the new `info_states` with their ascending `hashes`, returns them."""
+        keys = info_states.view(np.uint8)
+        if self._keys is None:
+            self._keys = np.zeros([self.cum_probs.shape[0], keys.shape[1]], np.uint8)
+        rows = np.arange(self._size, self._size + len(keys))
+        capacity = self.cum_probs.shape[0]
+        while capacity < rows[-1] + 1:
+            capacity *= 2
+        if capacity > self.cum_probs.shape[0]:
+            self.cum_probs = np.concatenate(
+                [self.cum_probs, np.zeros([capacity - len(self.cum_probs), self.cum_probs.shape[1]])])
+            self._keys = np.concatenate(
+                [self._keys, np.zeros([capacity - len(self._keys), keys.shape[1]], np.uint8)])
+        self._keys[rows] = keys
+        positions = np.searchsorted(self._hashes, hashes)
+        self._hashes = np.insert(self._hashes, positions, hashes)
+        self._hash_rows = np.insert(self._hash_rows, positions, rows)
+        self._size += len(keys)
+        return rows
+
+    def _states(self, info_states):
+        return np.ascontiguousarray(info_states, np.float32).reshape([len(info_states), -1])
+
+    def rows(self, info_states):
+        """Returns the rows of `info_states`, -1 for those never accumulated."""
+        info_states = self._states(info_states)
+        return self._lookup(info_states, self._hash(info_states))
+
+    def row(self, info_state):
+        """Returns the row of `info_state`, or None if it was never accumulated."""
+        row = self.rows([info_state])[0]
+        return None if row < 0 else row
+
+    def add(self, info_state, probs):
+        self.add_batch([info_state], np.reshape(probs, [1, -1]))
+
+    def add_batch(self, info_states, probs):
+        """Accumulates `probs[i]` into the row of `info_states[i]` for all i at once.
+
+    Info states are grouped by hash with one sort, so the cost is a few passes over the
+    batch whatever the number of distinct info states.
 
     Args:
-      element: data to be added to the reservoir buffer.
+      info_states: [n, state_size] info state tensors.
+      probs: [n, num_actions] action probabilities.
     """
-        if len(self.data) < self._reservoir_buffer_capacity:
-            self.data.append(element)
-        else:
-            idx = np.random.randint(0, self._add_calls + 1)
-            if idx < self._reservoir_buffer_capacity:
-                self.data[idx] = element
-        self._add_calls += 1
-
-    def sample(self, num_samples):
-        """Returns `num_samples` uniformly sampled from the buffer.
-
-    Args:
-      num_samples: `int`, number of samples to draw.
-
-    Returns:
-      An iterable over `num_samples` random elements of the buffer.
-
-    Raises:
-      ValueError: If there are less than `num_samples` elements in the buffer
-    """
-        if len(self.data) < num_samples:
-            raise ValueError("{} elements could not be sampled from size {}".format(
-                num_samples, len(self.data)))
-        return random.sample(self.data, num_samples)
-
-    def clear(self):
-        self.data = []
-        self._add_calls = 0
+        info_states = self._states(info_states)
+        unique, inverse = np.unique(self._hash(info_states), return_inverse=True)
+        inverse = inverse.ravel()
+        first = np.empty([len(unique)], np.int64)
+        first[inverse] = np.arange(len(inverse))
+        rows = self._lookup(info_states[first], unique)
+        new = rows < 0
+        if new.any():
+            rows[new] = self._insert(info_states[first[new]], unique[new])
+        probs = np.asarray(probs, np.float64)
+        self.cum_probs[rows] += np.stack(
+            [np.bincount(inverse, probs[:, action], len(unique)) for action in range(probs.shape[1])], axis=1)
+
+    def arrays(self):
+        """Returns the packed info state keys and their cumulative probs."""
+        if not self._size:
+            return np.zeros([0, 0], np.uint8), self.cum_probs[:0]
+        return self._keys[:self._size], self.cum_probs[:self._size]
+
+    def save(self, path):
+        """Writes the table as the two arrays of `arrays`."""
+        keys, cum_probs = self.arrays()
+        np.savez(path, keys=keys, cum_probs=cum_probs)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        keys, cum_probs = data["keys"], data["cum_probs"]
+        table = cls(cum_probs.shape[1], max(len(keys), 1))
+        if len(keys):
+            info_states = np.ascontiguousarray(keys).view(np.float32)
+            hashes = table._hash(info_states)
+            table._insert(info_states, hashes)
+            # rows stay in file order, the index is sorted by hash
+            order = np.argsort(hashes)
+            table._hashes, table._hash_rows = hashes[order], order
+            table.cum_probs[:len(keys)] = cum_probs
+        return table
+
+    def __contains__(self, info_state):
+        return self.row(info_state) is not None
 
     def __len__(self):
-        return len(self.data)
-
-    def __iter__(self):
-        return iter(self.data)
+        return self._size
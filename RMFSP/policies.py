@@ -0,0 +1,75 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import contextlib
+
+import numpy as np
+
+from open_spiel.python import policy
+
+
+class AgentPolicies(policy.Policy):
+    """Joint policy of RL agents, evaluated over every info state of the game at once.
+
+    All info states are enumerated once through a `TabularPolicy`. The action probabilities
+    of each player are computed with one `batch_action_probs` call of its agent and kept until
+    the `policy_version` of an agent changes, so exploitability walks are served from the
+    table instead of one forward per visited history.
+    """
+
+    def __init__(self, env, agents, mode=None):
+        game = env.game
+        player_ids = list(range(game.num_players()))
+        super(AgentPolicies, self).__init__(game, player_ids)
+        self._policies = agents
+        self._mode = mode
+        self._tabular = policy.TabularPolicy(game)
+        self._info_states = np.array([s.information_state_tensor() for s in self._tabular.states])
+        players = np.array([s.current_player() for s in self._tabular.states])
+        self._player_rows = [np.nonzero(players == p)[0] for p in player_ids]
+        self._versions = None
+
+    def _agent_mode(self, agent):
+        if self._mode is None:
+            return contextlib.suppress()
+        return agent.temp_mode_as(self._mode)
+
+    @property
+    def info_states(self):
+        """info state tensors of the table rows"""
+        return self._info_states
+
+    def invalidate(self):
+        """Forces a rebuild, e.g. after agent parameters were restored outside the agents."""
+        self._versions = None
+
+    def tabulate(self):
+        """Returns the [num_states, num_actions] probability table of the current agents."""
+        versions = [agent.policy_version for agent in self._policies]
+        if versions != self._versions:
+            probs = self._tabular.action_probability_array
+            for agent, rows in zip(self._policies, self._player_rows):
+                with self._agent_mode(agent):
+                    probs[rows] = agent.batch_action_probs(self._info_states[rows],
+                                                           self._tabular.legal_actions_mask[rows])
+            self._versions = versions
+        return self._tabular.action_probability_array
+
+    def action_probabilities(self, state, player_id=None):
+        probs = self.tabulate()[self._tabular.state_index(state)]
+        return {action: probs[action] for action in state.legal_actions(state.current_player())}
+
+
+class NFSPPolicies(AgentPolicies):
+    """Joint policy to be evaluated, with the agents temporarily switched to `mode`."""
+
+    def __init__(self, env, nfsp_policies, mode):
+        super(NFSPPolicies, self).__init__(env, nfsp_policies, mode)
+
+
+class ARMPolicies(AgentPolicies):
+    """Joint policy to be evaluated; ARM agents have a single mode."""
+
+    def __init__(self, env, arm_policies, mode=None):
+        super(ARMPolicies, self).__init__(env, arm_policies)
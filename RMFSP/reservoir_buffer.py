@@ -0,0 +1,120 @@
+"""Reservoir buffer over namedtuple records stored as preallocated columns.
+
+Shared by the NFSP, NFSP_ARM and Deep CFR memories.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import random
+
+import numpy as np
+
+
+class ReservoirBuffer(object):
+  """Allows uniform sampling over a stream of records.
+
+  Every field of `element_type` is kept in one column preallocated for the whole
+  capacity (pages are only committed once rows are written). Records can be
+  inserted one at a time or as a batch of stacked fields, and `sample` and `data`
+  return `element_type` tuples of ready-to-feed arrays.
+
+  See https://en.wikipedia.org/wiki/Reservoir_sampling for more details.
+  """
+
+  def __init__(self, reservoir_buffer_capacity, element_type, shapes,
+               dtypes=None):
+    """Creates the columns.
+
+    Args:
+      reservoir_buffer_capacity: `int`, maximum number of records kept.
+      element_type: namedtuple class of the records.
+      shapes: dict from field name to the shape of one record's field, e.g. the
+        information state tensor shape; missing fields are scalars.
+      dtypes: dict from field name to dtype, `np.float32` by default.
+    """
+    self._reservoir_buffer_capacity = int(reservoir_buffer_capacity)
+    self._element_type = element_type
+    dtypes = dtypes or {}
+    self._columns = [
+        np.zeros((self._reservoir_buffer_capacity,) + tuple(shapes.get(f, ())),
+                 dtypes.get(f, np.float32)) for f in element_type._fields
+    ]
+    self._size = 0
+    self._add_calls = 0
+
+  def add(self, element):
+    """Potentially adds `element` to the reservoir buffer.
+
+    Args:
+      element: an `element_type` record.
+    """
+    if self._size < self._reservoir_buffer_capacity:
+      idx = self._size
+      self._size += 1
+    else:
+      idx = np.random.randint(0, self._add_calls + 1)
+    if idx < self._reservoir_buffer_capacity:
+      for column, value in zip(self._columns, element):
+        column[idx] = value
+    self._add_calls += 1
+
+  def add_batch(self, elements):
+    """Adds a batch of records as if `add` was called on each in order.
+
+    Args:
+      elements: an `element_type` of arrays stacked along the first axis.
+    """
+    num = len(elements[0])
+    if num == 0:
+      return
+    fill = min(num, self._reservoir_buffer_capacity - self._size)
+    rows = np.arange(self._size, self._size + fill)
+    # the k-th record past the capacity replaces a random slot with probability
+    # capacity / (add_calls + 1) at its own add call
+    add_calls = self._add_calls + np.arange(fill, num)
+    slots = (np.random.random_sample(num - fill) * (add_calls + 1)).astype(np.int64)
+    replaced = np.nonzero(slots < self._reservoir_buffer_capacity)[0]
+    # a slot written twice keeps the later record
+    slots, last = np.unique(slots[replaced][::-1], return_index=True)
+    sources = np.concatenate([np.arange(fill), fill + replaced[::-1][last]])
+    rows = np.concatenate([rows, slots])
+    for column, values in zip(self._columns, elements):
+      column[rows] = np.asarray(values)[sources]
+    self._size += fill
+    self._add_calls += num
+
+  @property
+  def data(self):
+    """An `element_type` of views over the stored records."""
+    return self._element_type(*[c[:self._size] for c in self._columns])
+
+  def sample(self, num_samples):
+    """Returns `num_samples` uniformly sampled from the buffer.
+
+    Args:
+      num_samples: `int`, number of samples to draw.
+
+    Returns:
+      An `element_type` of arrays with `num_samples` random records.
+
+    Raises:
+      ValueError: If there are less than `num_samples` elements in the buffer
+    """
+    if self._size < num_samples:
+      raise ValueError("{} elements could not be sampled from size {}".format(
+          num_samples, self._size))
+    # without replacement in O(num_samples); np.random.choice permutes the buffer
+    idx = np.array(random.sample(range(self._size), num_samples), np.int64)
+    return self._element_type(*[c[idx] for c in self._columns])
+
+  def clear(self):
+    self._size = 0
+    self._add_calls = 0
+
+  def __len__(self):
+    return self._size
+
+  def __iter__(self):
+    return (self._element_type(*row) for row in zip(*self.data))
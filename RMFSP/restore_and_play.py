@@ -2,26 +2,25 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-from abc import ABC
-
 from absl import app
 from absl import flags
 from absl import logging
 import tensorflow as tf
 
-from open_spiel.python import policy
 from open_spiel.python import rl_environment
-from open_spiel.python.algorithms import exploitability
 # from open_spiel.python.algorithms import nfsp
-from open_spiel.python.algorithms import random_agent
 import arm_tf
 import numpy as np
 import matplotlib.pyplot as plt
 import datetime
+import os
 import time
 import nfsp_arm
-import pickle
 import nfsp
+from policies import NFSPPolicies, ARMPolicies
+from evaluation import play_head_to_head
+import best_response
+import inference
 
 FLAGS = flags.FLAGS
 
@@ -43,136 +42,6 @@ flags.DEFINE_float("anticipatory_param", 0.5,  # 0.1 origin
                    "Prob of using the rl best response as episode policy.")
 
 
-class NFSPPolicies(policy.Policy, ABC):
-    """Joint policy to be evaluated."""
-
-    def __init__(self, env, nfsp_policies, mode):
-        game = env.game
-        player_ids = [0, 1]
-        super(NFSPPolicies, self).__init__(game, player_ids)
-        self._policies = nfsp_policies
-        self._mode = mode
-        self._obs = {"info_state": [None, None], "legal_actions": [None, None]}
-
-    def action_probabilities(self, state, player_id=None):
-        cur_player = state.current_player()
-        legal_actions = state.legal_actions(cur_player)
-
-        self._obs["current_player"] = cur_player
-        self._obs["info_state"][cur_player] = (
-            state.information_state_tensor(cur_player))
-        self._obs["legal_actions"][cur_player] = legal_actions
-
-        info_state = rl_environment.TimeStep(
-            observations=self._obs, rewards=None, discounts=None, step_type=None)
-
-        # if cur_player == 0:
-        with self._policies[cur_player].temp_mode_as(self._mode):
-            # print(self._policies[cur_player].mode)
-            p = self._policies[cur_player].step(info_state, is_evaluation=True).probs
-        # else:
-        #     p = self._policies[cur_player].step(info_state, is_evaluation=True).probs
-        prob_dict = {action: p[action] for action in legal_actions}
-        # print(prob_dict)
-        return prob_dict
-
-
-class ARMPolicies(policy.Policy, ABC):
-    """Joint policy to be evaluated."""
-
-    def __init__(self, env, arm_policies, mode):
-        game = env.game
-        player_ids = [0, 1]
-        super(ARMPolicies, self).__init__(game, player_ids)
-        self._policies = arm_policies
-        self._mode = mode
-        self._obs = {"info_state": [None, None], "legal_actions": [None, None]}
-
-    def action_probabilities(self, state, player_id=None):
-        cur_player = state.current_player()
-        legal_actions = state.legal_actions(cur_player)
-
-        self._obs["current_player"] = cur_player
-        self._obs["info_state"][cur_player] = (
-            state.information_state_tensor(cur_player))
-        self._obs["legal_actions"][cur_player] = legal_actions
-
-        info_state = rl_environment.TimeStep(
-            observations=self._obs, rewards=None, discounts=None, step_type=None)
-
-        p = self._policies[cur_player].step(info_state, is_evaluation=True).probs
-        prob_dict = {action: p[action] for action in legal_actions}
-        return prob_dict
-
-
-def eval_against_random_bots(env, trained_agents, random_agents, num_episodes):
-    """Evaluates `trained_agents` against `random_agents` for `num_episodes`."""
-    num_players = len(trained_agents)
-    sum_episode_rewards = np.zeros(num_players)
-    win_rate = np.zeros(num_players)
-    for player_pos in range(num_players):
-        count_vic = 0
-        cur_agents = random_agents[:]
-        cur_agents[player_pos] = trained_agents[player_pos]
-        for _ in range(num_episodes):
-            time_step = env.reset()
-            episode_rewards = 0
-            while not time_step.last():
-                player_id = time_step.observations["current_player"]
-                if player_pos == player_id:
-                    with cur_agents[player_id].temp_mode_as(nfsp_arm.MODE.average_policy):
-                        agent_output = cur_agents[player_id].step(time_step, is_evaluation=True)
-                else:
-                    agent_output = cur_agents[player_id].step(time_step, is_evaluation=True)
-                action_list = [agent_output.action]
-                time_step = env.step(action_list)
-                episode_rewards += time_step.rewards[player_pos]
-            if episode_rewards > 0:
-                episode_rewards = 1.0
-                count_vic = count_vic + 1
-            elif episode_rewards < 0:
-                episode_rewards = -1.0
-            elif episode_rewards == 0:
-                episode_rewards = 0
-                count_vic = count_vic + 1
-            sum_episode_rewards[player_pos] += episode_rewards
-            win_rate[player_pos] = count_vic
-    return sum_episode_rewards / num_episodes, win_rate / num_episodes
-
-
-def eval_against_random_bots_nfsp_arm(env, trained_agents, random_agents, num_episodes):
-    """Evaluates `trained_agents` against `random_agents` for `num_episodes`."""
-    num_players = len(trained_agents)
-    sum_episode_rewards = np.zeros(num_players)
-    for player_pos in range(num_players):
-        cur_agents = random_agents[:]
-        cur_agents[player_pos] = trained_agents[player_pos]
-        for _ in range(num_episodes):
-            time_step = env.reset()
-            episode_rewards = 0
-            while not time_step.last():
-                player_id = time_step.observations["current_player"]
-                if hasattr(cur_agents[player_id], 'tag') and cur_agents[player_id].tag() == "nfsp_arm":
-                    with cur_agents[player_id].temp_mode_as(nfsp_arm.MODE.average_policy):
-                        agent_output = cur_agents[player_id].step(time_step, is_evaluation=True)
-                else:
-                    # print(cur_agents[player_id])
-                    with cur_agents[player_id].temp_mode_as(nfsp.MODE.average_policy):
-                        agent_output = cur_agents[player_id].step(time_step, is_evaluation=True)
-                action_list = [agent_output.action]
-                time_step = env.step(action_list)
-                episode_rewards += time_step.rewards[player_pos]
-            # log every episode_rewards
-            if hasattr(cur_agents[0], 'tag') and cur_agents[0].tag() == "nfsp_arm":
-                with open('log/main_nfsp_arm_0_vs_nfsp1_every.txt', 'a+') as f:
-                    f.write('{}\n'.format(episode_rewards))
-            else:
-                with open('log/main_nfsp_arm_1_vs_nfsp0_every.txt', 'a+') as f:
-                    f.write('{}\n'.format(episode_rewards))
-            sum_episode_rewards[player_pos] += episode_rewards
-    return sum_episode_rewards / num_episodes
-
-
 class ImportNFSP:
     """  Importing and running isolated TF graph """
 
@@ -209,12 +78,6 @@ class ImportNFSP:
             # BY NAME:
             # self.activation = self.graph.get_operation_by_name('activation_opt').outputs[0]
 
-    def step(self, cur_player, data):
-        """ Running the activation operation previously imported """
-        # The 'x' corresponds to name of input placeholder
-        return 1
-        # return self.sess.run(self.activation, feed_dict={"x:0": data})
-
 
 class ImportNFSP_ARM:
     """  Importing and running isolated TF graph """
@@ -250,11 +113,23 @@ class ImportNFSP_ARM:
             # BY NAME:
             # self.activation = self.graph.get_operation_by_name('activation_opt').outputs[0]
 
-    def step(self, cur_player, data):
-        """ Running the activation operation previously imported """
-        # The 'x' corresponds to name of input placeholder
-        return 1
-        # return self.sess.run(self.activation, feed_dict={"x:0": data})
+
+def load_inference_agents(import_graph, info_state_size, num_actions, hidden_layers_sizes, loc,
+                          cum_probs=None, num_players=2):
+    """Loads the agents of checkpoint `loc` with `inference.load`.
+
+    The TF graph of `import_graph` is only built the first time, to export the agents next to
+    the checkpoint (`cum_probs` are the `AveragePolicyTable` files of NFSP_ARM agents).
+    """
+    paths = ["{}.agent_{}.npz".format(loc, idx) for idx in range(num_players)]
+    if not all(os.path.exists(path) for path in paths):
+        imported = import_graph(info_state_size, num_actions, hidden_layers_sizes, loc)
+        for idx, (agent, path) in enumerate(zip(imported.agents, paths)):
+            if cum_probs is not None:
+                agent.restore_cum_probs(cum_probs[idx])
+            agent.export_inference(path)
+        imported.sess.close()
+    return [inference.load(path) for path in paths]
 
 
 def main(unused_argv):
@@ -286,32 +161,30 @@ def main(unused_argv):
     }
 
     hidden_layers_sizes_nfsp = [64]
-    agents_nfsp = ImportNFSP(info_state_size, num_actions, hidden_layers_sizes_nfsp, './Model_NFSP/model.ckpt-13500000')
-    expl_policies_avg_nfsp = NFSPPolicies(env, agents_nfsp.agents, nfsp.MODE.average_policy)
-    expl_2 = exploitability.exploitability(env.game, expl_policies_avg_nfsp)
-
-    agents = ImportNFSP_ARM(info_state_size, num_actions, hidden_layers_sizes, "./Model_NFSP_ARM_2/model.ckpt")
-    expl_policies_avg = NFSPPolicies(env, agents.agents, nfsp_arm.MODE.average_policy)
-
-    f_cum0 = open('./Model_NFSP_ARM_2/agent_0.pkl', 'rb')
-    a0_cum_prob = pickle.load(f_cum0)
-    f_cum0.close()
-
-    f_cum1 = open('./Model_NFSP_ARM_2/agent_1.pkl', 'rb')
-    a1_cum_prob = pickle.load(f_cum1)
-    f_cum1.close()
+    agents_nfsp = load_inference_agents(ImportNFSP, info_state_size, num_actions, hidden_layers_sizes_nfsp,
+                                        './Model_NFSP/model.ckpt-13500000')
+    expl_policies_avg_nfsp = NFSPPolicies(env, agents_nfsp, nfsp.MODE.average_policy)
+    expl_2 = best_response.exploitability(env.game, expl_policies_avg_nfsp)
 
-    agents.agents[0].restore_cum_probs(a0_cum_prob)
-    agents.agents[1].restore_cum_probs(a1_cum_prob)
+    agents = load_inference_agents(ImportNFSP_ARM, info_state_size, num_actions, hidden_layers_sizes,
+                                   "./Model_NFSP_ARM_2/model.ckpt",
+                                   ['./Model_NFSP_ARM_2/agent_0.npz', './Model_NFSP_ARM_2/agent_1.npz'])
+    expl_policies_avg = NFSPPolicies(env, agents, nfsp_arm.MODE.average_policy)
 
-    expl = exploitability.exploitability(env.game, expl_policies_avg)
+    expl = best_response.exploitability(env.game, expl_policies_avg)
 
     print(expl)
     print(expl_2)
 
     for i in range(100):
-        r_mean = eval_against_random_bots_nfsp_arm(env, agents.agents, agents_nfsp.agents, 1000)
-        logging.info("Mean episode rewards: %s, ", r_mean)
+        result = play_head_to_head(env, expl_policies_avg, 1000, opponent_policies=expl_policies_avg_nfsp)
+        r_mean = result.mean_reward
+        logging.info("Mean episode rewards: %s +- %s, ", r_mean, result.mean_reward_ci)
+        # log every episode_rewards
+        with open('log/main_nfsp_arm_0_vs_nfsp1_every.txt', 'a+') as f:
+            f.write(''.join('{}\n'.format(r) for r in result.rewards[0]))
+        with open('log/main_nfsp_arm_1_vs_nfsp0_every.txt', 'a+') as f:
+            f.write(''.join('{}\n'.format(r) for r in result.rewards[1]))
         with open('log/main_nfsp_arm_0_vs_nfsp1_v1.txt', 'a+') as f:
             f.write('{}\n'.format(r_mean[0]))
         with open('log/main_nfsp0_vs_nfsp_arm_1_v1.txt', 'a+') as f:
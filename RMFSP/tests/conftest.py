@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules of RMFSP import each other flat
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
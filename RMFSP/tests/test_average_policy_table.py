@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+pytest.importorskip('sonnet')
+pytest.importorskip('open_spiel')
+from nfsp_arm import AveragePolicyTable
+
+
+@pytest.mark.parametrize('state_size', [6, 7])
+def test_add_batch_matches_per_state_sums(state_size):
+    rng = np.random.RandomState(0)
+    states = (rng.rand(50, state_size) < 0.4).astype(np.float32)
+    table = AveragePolicyTable(3, capacity=4)
+    expected = {}
+    for _ in range(4):
+        idcs = rng.randint(len(states), size=200)
+        probs = rng.rand(200, 3)
+        table.add_batch(states[idcs], probs)
+        for i, p in zip(idcs, probs):
+            key = states[i].tobytes()
+            expected[key] = expected.get(key, 0) + p
+    assert len(table) == len(expected)
+    for key, cum in expected.items():
+        np.testing.assert_allclose(table.cum_probs[table.row(np.frombuffer(key, np.float32))], cum)
+    assert table.row(np.full(state_size, 2, np.float32)) is None
+
+
+def test_save_and_load_keep_rows(tmpdir):
+    rng = np.random.RandomState(1)
+    states = rng.rand(20, 6).astype(np.float32)
+    table = AveragePolicyTable(2)
+    table.add_batch(states, rng.rand(20, 2))
+    path = str(tmpdir.join('table.npz'))
+    table.save(path)
+    loaded = AveragePolicyTable.load(path)
+    np.testing.assert_array_equal(loaded.rows(states), table.rows(states))
+    for saved, restored in zip(table.arrays(), loaded.arrays()):
+        np.testing.assert_array_equal(saved, restored)
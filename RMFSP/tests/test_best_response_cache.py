@@ -0,0 +1,18 @@
+import os
+
+import pytest
+
+pytest.importorskip('open_spiel')
+import best_response
+
+
+def test_cache_of_another_format_version_is_rebuilt(tmpdir, monkeypatch):
+    cache_dir = str(tmpdir)
+    best_response.CompiledGame("kuhn_poker", cache_dir=cache_dir)
+    monkeypatch.setattr(best_response, 'FORMAT_VERSION', best_response.FORMAT_VERSION + 1)
+    compiled = []
+    compile_game = best_response._compile
+    monkeypatch.setattr(best_response, '_compile', lambda game: compiled.append(game) or compile_game(game))
+    best_response.CompiledGame("kuhn_poker", cache_dir=cache_dir)
+    assert len(compiled) == 1
+    assert len(os.listdir(cache_dir)) == 2
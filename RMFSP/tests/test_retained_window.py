@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+from buffer import ReplayBuffer
+
+STATE_SIZE = 4
+NUM_ACTIONS = 2
+
+
+def add_episodes(buffer, episodes, length=3):
+    for _ in range(episodes):
+        for step in range(length):
+            obs = np.random.rand(STATE_SIZE)
+            done = step == length - 1
+            buffer.add(obs, obs, np.random.randint(NUM_ACTIONS), float(done), done, np.ones(NUM_ACTIONS))
+
+
+def test_size_counts_rows_added_after_vectorize():
+    buffer = ReplayBuffer(16)
+    add_episodes(buffer, 2)
+    buffer.vectorize(n_step_size=2, gamma=0.9)
+    add_episodes(buffer, 3)
+    assert buffer.size == 15
+    buffer.discard(6)
+    assert buffer.size == len(buffer) == 9
+
+
+def test_learn_keeps_running_with_retained_iterations():
+    tf = pytest.importorskip('tensorflow')
+    pytest.importorskip('sonnet')
+    pytest.importorskip('open_spiel')
+    import arm_tf
+
+    with tf.Graph().as_default(), tf.compat.v1.Session() as session:
+        agent = arm_tf.ARM(session, 0, STATE_SIZE, NUM_ACTIONS, [8], iterations=5, batch_size=4,
+                           retained_iterations=2)
+        agent._min_buffer_size_to_learn = 12
+        session.run(tf.compat.v1.global_variables_initializer())
+        for learn in range(4):
+            add_episodes(agent.replay_buffer, 4)
+            assert agent.new_transitions == 12
+            assert agent.learn() is not None, 'learn %d did not run' % learn
+            assert agent.new_transitions == 0
+            # the rows of this call are kept for the next one, older ones are dropped
+            assert agent.replay_buffer.size == 12
+
+
+def test_invalidated_targets_keep_the_segments():
+    tf = pytest.importorskip('tensorflow')
+    pytest.importorskip('sonnet')
+    pytest.importorskip('open_spiel')
+    import arm_tf
+
+    with tf.Graph().as_default(), tf.compat.v1.Session() as session:
+        agent = arm_tf.ARM(session, 0, STATE_SIZE, NUM_ACTIONS, [8], iterations=5, batch_size=4,
+                           retained_iterations=3)
+        agent._min_buffer_size_to_learn = 12
+        session.run(tf.compat.v1.global_variables_initializer())
+        for learn in range(4):
+            add_episodes(agent.replay_buffer, 4)
+            agent.invalidate_target_cache()
+            assert agent.new_transitions == 12
+            assert agent.learn() is not None
+            # the two newest segments are kept, the oldest one is the one discarded
+            assert agent.replay_buffer.size == 12 * min(learn + 1, 2)